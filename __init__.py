@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-14 09:30:12
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-14 16:02:45
+# @File Name: __init__.py
+
+"""
+Submodules are imported on first access, so that
+
+    import skmldb
+    skmldb.tree.DecisionTreeClassifier(...)
+
+only pays for the modules it uses. NumPy and pandas are only imported by
+the modules working on arrays (arrays, metrics, calibration, compiled,
+linear_model, classifier, grid_search) or inside the functions needing
+them.
+"""
+
+import sys
+import types
+import importlib
+
+__all__ = [
+    "arrays",
+    "cache",
+    "calibration",
+    "classifier",
+    "compiled",
+    "connection",
+    "cross_validation",
+    "ensemble",
+    "exception",
+    "feature_set",
+    "feature_spec",
+    "grid_search",
+    "linear_model",
+    "metrics",
+    "pipeline",
+    "procedures",
+    "random",
+    "runstats",
+    "scoring",
+    "tracing",
+    "tree",
+    "utils"
+]
+
+
+class _LazyModule(types.ModuleType):
+    """
+    The package module, importing a submodule the first time it is used as
+    an attribute. Module level __getattr__ only exists from Python 3.7.
+    """
+    def __getattr__(self, name):
+        if name not in __all__:
+            raise AttributeError("module {} has no attribute {}".format(
+                self.__name__, name))
+        module = importlib.import_module("." + name, self.__name__)
+        setattr(self, name, module)
+        return module
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(__all__))
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# Keeps the original module alive, Python 2 clears the globals of a
+# module once it is garbage collected
+_module._original = sys.modules[__name__]
+sys.modules[__name__] = _module
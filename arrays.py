@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-05-30 10:05:17
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-05-30 16:22:40
+# @File Name: arrays.py
+
+import re
+import json
+import codecs
+import threading
+from .tracing import tracer
+from .connection import conn, bind
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+mldb = conn
+
+_DONE = object()
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_DELIMITERS = ",] \t\n\r"
+
+
+def iter_json_array(chunks):
+    """
+    Yield the elements of a JSON array one at a time, from the chunks of
+    bytes of its text. Only the element being decoded is held in memory, not
+    the whole text nor the whole array.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    state = "start"
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        if chunk is None:
+            final = True
+            text = utf8.decode(b"", final=True)
+        else:
+            text = utf8.decode(chunk)
+        buffer = buffer[position:] + text
+        position = 0
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if state == "start":
+                if buffer[position] != "[":
+                    raise ValueError("expected a JSON array")
+                position += 1
+                state = "first"
+            elif state in ("first", "element"):
+                if state == "first" and buffer[position] == "]":
+                    return
+                try:
+                    element, end = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    if final:
+                        raise
+                    # Cut in the middle, wait for the next chunk
+                    break
+                if not final and (end == len(buffer) or
+                                  buffer[end] not in _DELIMITERS):
+                    # A number cut after 1 or 1.5e may go on in the next
+                    # chunk
+                    break
+                yield element
+                position = end
+                state = "separator"
+            else:
+                if buffer[position] == "]":
+                    return
+                if buffer[position] != ",":
+                    raise ValueError("expected , or ] at {!r}".format(
+                        buffer[position:position + 20]))
+                position += 1
+                state = "element"
+    raise ValueError("JSON array cut short")
+
+
+def _chunks(response, chunk_size):
+    iter_content = getattr(response, "iter_content", None)
+    if iter_content is not None:
+        return iter_content(chunk_size)
+    content = response.content
+    if not isinstance(content, bytes):
+        content = content.encode("utf-8")
+    return (content[i:i + chunk_size]
+            for i in range(0, len(content), chunk_size))
+
+
+def iter_table(query, chunk_size=65536):
+    """
+    Run a query and return the column names and an iterator over the rows
+    as lists, decoded as the response is read. The row names are dropped.
+
+    With a connection that has get_stream, like PooledConnection, the body
+    is read from the socket chunk by chunk and memory stays proportional to
+    a chunk. pymldb's Connection reads the whole body first, only the rows
+    are then decoded one at a time.
+    """
+    params = {"q": query, "format": "table", "rowNames": "false"}
+    if hasattr(mldb.current(), "get_stream"):
+        response = mldb.connection.get_stream("/v1/query", **params)
+    else:
+        response = mldb.connection.get("/v1/query", **params)
+    if response.status_code != 200:
+        raise Exception("could not run query.\n{}".format(response.content))
+
+    def close():
+        # Gives the socket back to the pool of a streamed response
+        if hasattr(response, "close"):
+            response.close()
+
+    def rows():
+        try:
+            for row in elements:
+                yield row
+        finally:
+            close()
+
+    elements = iter_json_array(_chunks(response, chunk_size))
+    columns = next(elements, None)
+    if columns is None:
+        # Empty result, rows() still closes like a generator of rows
+        close()
+        columns = []
+    return columns, rows()
+
+
+def query_table(query):
+    """
+    Run a query and return the column names and the rows as lists, without
+    going through a DataFrame. The row names are dropped.
+    """
+    columns, rows = iter_table(query)
+    with tracer.span("parse json"):
+        return columns, list(rows)
+
+
+def to_arrays(columns, rows, names=None, dtype=None):
+    """
+    Turn the result of query_table into a dict of 1d arrays, of float64 by
+    default. Nulls become NaN. Columns missing from the result are all NaN.
+    """
+    import numpy as np
+
+    if dtype is None:
+        dtype = np.float64
+    if names is None:
+        names = columns
+    matrix = np.array(rows, dtype=dtype).reshape(len(rows), len(columns))
+    index = dict((c, i) for i, c in enumerate(columns))
+    arrays = {}
+    for name in names:
+        if name in index:
+            arrays[name] = matrix[:, index[name]]
+        else:
+            arrays[name] = np.full(len(rows), np.nan)
+    return arrays
+
+
+def query_arrays(query, names=None, dtype=None, block_rows=10000):
+    """
+    Run a query and return its columns as a dict of NumPy arrays. The rows
+    are converted block_rows at a time as the response is decoded, so the
+    rows are never all held as Python lists.
+
+    Paramters:
+        query: string
+
+            SQL query. Every selected value must be numeric or null.
+
+        names: array of strings (default None)
+
+            Columns to return. Defaults to all the columns of the result.
+
+        dtype: NumPy dtype (default None)
+
+            Type of the arrays, float64 when None
+
+        block_rows: int (default=10000)
+
+            Rows converted to arrays at a time
+    """
+    import numpy as np
+
+    columns, rows = iter_table(query)
+    if names is None:
+        names = columns
+    blocks = []
+    block = []
+    with tracer.span("parse json"):
+        for row in rows:
+            block.append(row)
+            if len(block) == block_rows:
+                blocks.append(to_arrays(columns, block, names, dtype))
+                block = []
+    if block or not blocks:
+        blocks.append(to_arrays(columns, block, names, dtype))
+    if len(blocks) == 1:
+        return blocks[0]
+    return dict(
+        (name, np.concatenate([b[name] for b in blocks])) for name in names)
+
+
+def iter_pages(query, page_size=10000, prefetch=2):
+    """
+    Yield the result of a query page by page as (columns, rows). The query
+    runs once and its result is streamed (see iter_table), a background
+    thread cuts it in pages of page_size rows and stays up to prefetch pages
+    ahead of the consumer, so the next page is read while the current one is
+    processed. The pages follow the order of the query.
+    """
+    pages = Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def fetch():
+        try:
+            columns, rows = iter_table(query)
+            try:
+                page = []
+                for row in rows:
+                    page.append(row)
+                    if len(page) == page_size:
+                        pages.put((columns, page))
+                        page = []
+                        if stop.is_set():
+                            return
+                if page:
+                    pages.put((columns, page))
+            finally:
+                rows.close()
+            pages.put(_DONE)
+        except Exception as e:
+            pages.put(e)
+
+    thread = threading.Thread(target=bind(fetch))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                break
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop.set()
+        # Unblock the thread if it waits on a full queue
+        while thread.is_alive():
+            if not pages.empty():
+                pages.get()
+            thread.join(0.01)
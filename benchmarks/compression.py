@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-16 10:14:37
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-16 15:52:20
+# @File Name: compression.py
+
+"""
+Bytes on the wire and latency with and without compression, against the
+local stand-in server on a link of limited bandwidth. The modes are:
+
+    plain      nothing compressed
+    responses  Accept-Encoding: gzip, the server compresses the responses
+    both       responses, and request bodies compressed with gzip
+
+Scenarios: a large query, a small query and the PUT of a transform
+selecting many features.
+
+    python -m skmldb.benchmarks.compression --bandwidth 1e6 --latency 0.02
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from skmldb.connection import conn, using_connection, PooledConnection
+from skmldb.procedures import Transform
+from skmldb.benchmarks.fake_mldb import FakeMLDB, synthetic_dataset
+
+MODES = {
+    "plain": {"accept_encoding": None},
+    "responses": {"accept_encoding": "gzip, deflate"},
+    "both": {"accept_encoding": "gzip, deflate", "compress": "gzip"}
+}
+
+
+def scenario_large_query():
+    conn.connection.query("SELECT * FROM bench", format="table")
+
+
+def scenario_small_query():
+    conn.connection.query("SELECT * FROM bench LIMIT 10", format="table")
+
+
+def scenario_transform():
+    features = ", ".join(
+        "\"feature_%d\" AS f%d" % (i, i) for i in range(2000))
+    conn.connection.put("/v1/procedures/bench_transform", Transform(
+        inputData="SELECT %s FROM bench LIMIT 10" % features,
+        outputDataset="bench_out")())
+
+
+SCENARIOS = ["large_query", "small_query", "transform"]
+
+
+def measure(server, scenario, mode, repeat):
+    connection = PooledConnection(server.uri, notebook=False, **MODES[mode])
+    operation = globals()["scenario_" + scenario]
+    latencies = []
+    with using_connection(connection):
+        # Opens the socket, not measured
+        operation()
+        bytes_in, bytes_out = server.bytes_in, server.bytes_out
+        for i in range(repeat):
+            start = time.time()
+            operation()
+            latencies.append(time.time() - start)
+    connection.close()
+    return {
+        "scenario": scenario,
+        "mode": mode,
+        "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+        "sent": (server.bytes_in - bytes_in) / repeat,
+        "received": (server.bytes_out - bytes_out) / repeat
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS,
+                        choices=SCENARIOS)
+    parser.add_argument("--rows", type=int, default=5000,
+                        help="rows of the large query")
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--bandwidth", type=float, default=1e6,
+                        help="bytes per second of the link")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="round trip time in seconds")
+    args = parser.parse_args()
+
+    with FakeMLDB(latency=args.latency, bandwidth=args.bandwidth,
+                  compress=True) as server:
+        server.datasets["bench"] = synthetic_dataset(args.rows, args.columns)
+        print("{:<12} {:<10} {:>10} {:>12} {:>12} {:>9}".format(
+            "scenario", "mode", "p50 ms", "sent B", "received B", "speedup"))
+        for scenario in args.scenarios:
+            plain = None
+            for mode in ["plain", "responses", "both"]:
+                result = measure(server, scenario, mode, args.repeat)
+                plain = plain or result["p50_ms"]
+                print("{:<12} {:<10} {:>10.1f} {:>12.0f} {:>12.0f} {:>8.2f}x"
+                      .format(scenario, mode, result["p50_ms"],
+                              result["sent"], result["received"],
+                              plain / result["p50_ms"]))
+
+
+if __name__ == "__main__":
+    main()
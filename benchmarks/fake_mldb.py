@@ -0,0 +1,640 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-05-19 14:02:11
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-05-19 16:38:45
+# @File Name: fake_mldb.py
+
+"""
+Local stand-in for an MLDB server. It implements the routes this package
+uses, keeps datasets and functions in memory and answers with deterministic
+fake results. SQL is not evaluated: queries and transforms only look at the
+FROM dataset, the aliases of the select list, rowHash() splits and
+LIMIT/OFFSET, which is enough to exercise the client.
+
+classifier.train makes a small fake_model on the features of the training
+data. The details route of the function returns it in the layout
+compiled.py reads, and applying the function scores with it, so compiled
+models can be checked with CompiledForest.verify. That layout is the one
+the client expects, it was not recorded from a running MLDB.
+"""
+
+import os
+import re
+import csv
+import json
+import math
+import time
+import zlib
+import datetime
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+_FROM = re.compile(r"\bFROM\s+([\w]+)", re.IGNORECASE)
+_SPLIT = re.compile(r"rowHash\(\)\s*%\s*100\s*(<|>=)\s*(\d+)", re.IGNORECASE)
+_ALIAS = re.compile(r"\bAS\s+(\w+)", re.IGNORECASE)
+_AGGREGATE = re.compile(r"\b(count|sum|max|min|avg)\s*\(", re.IGNORECASE)
+_LIMIT = re.compile(r"\bLIMIT\s+(\d+)", re.IGNORECASE)
+_WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+_FEATURES = re.compile(r"\{(.*?)\}\s+as\s+features", re.IGNORECASE | re.DOTALL)
+_OFFSET = re.compile(r"\bOFFSET\s+(\d+)", re.IGNORECASE)
+# Function applied to a row literal, as sent by scoring.apply_function_many
+_APPLY = re.compile(
+    r'"(?:[^"]|"")+"\(\{\{(.*?)\} AS features\}\)\[score\] AS "(\d+)"')
+_FIELD = re.compile(
+    r"(NULL|true|false|'(?:[^']|'')*'|[-+\w.]+) AS \"((?:[^\"]|\"\")*)\"")
+
+_POINT = {
+    "pr": {"recall": 0.75, "precision": 0.6, "f": 0.6667},
+    "mcc": 0.45,
+    "gain": 1.5,
+    "threshold": 0.5,
+    "counts": {
+        "falseNegatives": 25.,
+        "truePositives": 75.,
+        "trueNegatives": 350.,
+        "falsePositives": 50.
+    }
+}
+
+
+def fake_score(features):
+    """Deterministic score in ]0, 1[ computed from the numeric features"""
+    total = 0.
+    for value in features.values():
+        try:
+            total += float(value)
+        except (TypeError, ValueError):
+            pass
+    return 1. / (1. + math.exp(-total))
+
+
+def fake_model(features, n_trees=None):
+    """
+    Trained model in the layout of the details route of a classifier
+    function. Each tree has two levels of splits on features < 0.5, its root
+    sends missing values to their own leaf. n_trees None is a single
+    decision tree, else a committee of n_trees trees.
+    """
+    features = list(features) or ["x0"]
+
+    def leaf(value):
+        return {"pred": [1. - value, value]}
+
+    def tree(k):
+        def split(j, low, high):
+            return {
+                "split": {"feature": features[j % len(features)], "op": "<",
+                          "value": 0.5},
+                "true": leaf(low), "false": leaf(high), "missing": None}
+        root = split(k, 0, 0)
+        root["true"] = split(k + 1, 0.1, 0.3)
+        root["false"] = split(k + 2, 0.6, 0.9)
+        root["missing"] = leaf(0.5)
+        return {"type": "decision_tree", "tree": root}
+
+    if n_trees is None:
+        return tree(0)
+    return {
+        "type": "committee",
+        "classifiers": [tree(k) for k in range(n_trees)],
+        "weights": [1. / n_trees] * n_trees,
+        "bias": 0.
+    }
+
+
+def model_score(model, features):
+    """Score of a row with a model of fake_model"""
+    if "classifiers" in model:
+        return sum(w * model_score(m, features) for m, w in zip(
+            model["classifiers"], model["weights"])) + model["bias"]
+    node = model["tree"]
+    while "split" in node:
+        value = features.get(node["split"]["feature"])
+        if value is None:
+            node = node["missing"] or node["false"]
+        elif float(value) < node["split"]["value"]:
+            node = node["true"]
+        else:
+            node = node["false"]
+    return node["pred"][-1]
+
+
+def _value(i, j):
+    """Deterministic cell value in [0, 1["""
+    return ((i * 7919 + j * 104729) % 1000) / 1000.
+
+
+def synthetic_dataset(rows, columns):
+    """A label column and columns x0..xn, with row names r0..rn"""
+    names = ["label"] + ["x%d" % j for j in range(columns)]
+    return {
+        "columns": names,
+        "rows": [["r%d" % i, i % 2] + [_value(i, j) for j in range(columns)]
+                 for i in range(rows)]
+    }
+
+
+def _sql_value(literal):
+    if literal == "NULL":
+        return None
+    if literal in ("true", "false"):
+        return literal == "true"
+    if literal.startswith("'"):
+        return literal[1:-1].replace("''", "'")
+    return _number(literal)
+
+
+def _number(value):
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Status line, headers and body in one write. Written apart, the
+    # delayed ACK of the client holds kept-alive responses for 40 ms.
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, content=None):
+        server = self.server
+        body = b"" if content is None else json.dumps(content).encode("utf-8")
+        encoding = None
+        if server.compress and len(body) >= server.compress_min_size:
+            accepted = self.headers.get("Accept-Encoding") or ""
+            encoding = "gzip" if "gzip" in accepted else \
+                "deflate" if "deflate" in accepted else None
+        if encoding is not None:
+            compressor = zlib.compressobj(
+                6, zlib.DEFLATED, _WBITS[encoding])
+            body = compressor.compress(body) + compressor.flush()
+        server.transfer(len(body), "out")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return None
+        body = self.rfile.read(length)
+        self.server.transfer(length, "in")
+        encoding = self.headers.get("Content-Encoding")
+        if encoding in _WBITS:
+            body = zlib.decompress(body, _WBITS[encoding])
+        return json.loads(body.decode("utf-8"))
+
+    def _handle(self, method):
+        server = self.server
+        server.count(method)
+        body = self._body()
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlparse(self.path)
+        if server.should_fail(method, url.path):
+            self._send(500, {"error": "injected failure"})
+            return
+        parts = url.path.strip("/").split("/")
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if len(parts) < 3 and parts != ["v1", "query"]:
+            self._send(404, {"error": "route not found: " + url.path})
+            return
+        handler = getattr(self, "_%s_%s" % (method.lower(), parts[1]), None)
+        if handler is None:
+            self._send(404, {"error": "route not found: " + url.path})
+            return
+        try:
+            code, content = handler(parts[2:], query, body)
+        except Exception as e:
+            code, content = 400, {"error": "{}: {}".format(
+                type(e).__name__, e)}
+        self._send(code, content)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    # /v1/query
+
+    def _get_query(self, parts, query, body):
+        if body:
+            query.update(body)
+        columns, rows = self.server.query(query["q"])
+        row_names = str(query.get("rowNames", "true")).lower() != "false"
+        if query.get("format") == "aos":
+            return 200, [
+                dict(([("_rowName", r[0])] if row_names else []) +
+                     list(zip(columns, r[1:])))
+                for r in rows]
+        if row_names:
+            return 200, [["_rowName"] + columns] + rows
+        return 200, [columns] + [r[1:] for r in rows]
+
+    # /v1/datasets
+
+    def _get_datasets(self, parts, query, body):
+        dataset = self.server.datasets.get(parts[0])
+        if dataset is None:
+            return 404, {"error": "dataset not found: " + parts[0]}
+        if len(parts) > 1 and parts[1] == "columns":
+            return 200, dataset["columns"]
+        return 200, {
+            "id": parts[0],
+            "status": {
+                "rowCount": len(dataset["rows"]),
+                "columnCount": len(dataset["columns"])
+            }
+        }
+
+    def _put_datasets(self, parts, query, body):
+        server = self.server
+        if body.get("type") == "merged":
+            dataset = {"columns": [], "rows": []}
+            for part in body["params"]["datasets"]:
+                source = server.datasets[part["id"]]
+                dataset["columns"] = dataset["columns"] or source["columns"]
+                dataset["rows"].extend(source["rows"])
+        else:
+            dataset = {"columns": [], "rows": []}
+        server.datasets[parts[0]] = dataset
+        return 201, {"id": parts[0], "config": body}
+
+    def _delete_datasets(self, parts, query, body):
+        self.server.datasets.pop(parts[0], None)
+        return 204, None
+
+    # /v1/functions
+
+    def _get_functions(self, parts, query, body):
+        if len(parts) > 1 and parts[1] == "application":
+            # Any function name scores, the load tests do not train first
+            features = json.loads(query["input"])["features"]
+            function = self.server.functions.get(parts[0], {})
+            if "model" in function:
+                return 200, {"output": {
+                    "score": model_score(function["model"], features)}}
+            return 200, {"output": {"score": fake_score(features)}}
+        function = self.server.functions.get(parts[0])
+        if function is None:
+            return 404, {"error": "function not found: " + parts[0]}
+        if len(parts) > 1 and parts[1] == "details":
+            if "model" not in function:
+                return 400, {"error": "function has no details: " + parts[0]}
+            return 200, {"model": function["model"]}
+        return 200, {"id": parts[0], "config": dict(
+            (k, v) for k, v in function.items() if k != "model")}
+
+    def _put_functions(self, parts, query, body):
+        function = dict(body)
+        url = body.get("params", {}).get("modelFileUrl") or ""
+        if url.startswith("file://") and \
+                not os.path.exists(url[len("file://"):]):
+            return 400, {"error": "could not open model file " + url}
+        if body.get("type") == "classifier" and url in self.server.models:
+            function["model"] = self.server.models[url]
+        self.server.functions[parts[0]] = function
+        return 201, {"id": parts[0], "config": body}
+
+    def _delete_functions(self, parts, query, body):
+        self.server.functions.pop(parts[0], None)
+        return 204, None
+
+    # /v1/procedures
+
+    def _put_procedures(self, parts, query, body):
+        server = self.server
+        server.procedures[parts[0]] = body
+        params = body.get("params", {})
+        if params.get("runOnCreation") is False:
+            return 201, {"id": parts[0], "config": body}
+        run = server.run_procedure(body)
+        return 201, {"id": parts[0], "config": body,
+                     "status": {"firstRun": run}}
+
+    def _post_procedures(self, parts, query, body):
+        procedure = self.server.procedures.get(parts[0])
+        if procedure is None:
+            return 404, {"error": "procedure not found: " + parts[0]}
+        run = self.server.run_procedure(procedure)
+        self.server.runs[(parts[0], run["id"])] = run
+        return 201, run
+
+    def _get_procedures(self, parts, query, body):
+        if len(parts) == 3 and parts[1] == "runs":
+            run = self.server.runs.get((parts[0], parts[2]))
+            if run is None:
+                return 404, {"error": "run not found: " + parts[2]}
+            return 200, run
+        if parts[0] not in self.server.procedures:
+            return 404, {"error": "procedure not found: " + parts[0]}
+        return 200, {"id": parts[0], "config": self.server.procedures[parts[0]]}
+
+    def _delete_procedures(self, parts, query, body):
+        self.server.procedures.pop(parts[0], None)
+        return 204, None
+
+
+def _output_id(output):
+    if isinstance(output, dict):
+        return output["id"]
+    return output
+
+
+class FakeMLDB(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server answering like MLDB. Use as a context manager or
+    call start and stop.
+
+    Paramters:
+        port: int (default=0)
+
+            Port to listen to. 0 picks a free port.
+
+        latency: float (default=0)
+
+            Time in seconds added to every request
+
+        rows, columns: int (default=1000, 10)
+
+            Size of the datasets created by procedures without a source
+            dataset, e.g. rtbopt.import
+
+        query_rows: int (default None)
+
+            When set, every query returns this many rows whatever the size of
+            the dataset
+
+        failure_rate: float (default=0)
+
+            Fraction of the requests matching failure_pattern answered with a
+            500. Failures are spread evenly, every 1 / failure_rate requests.
+
+        failure_pattern: string (default None)
+
+            Regular expression matched against "METHOD /path". All requests
+            when None.
+
+        bandwidth: float (default None)
+
+            Bytes per second of the link, each body adds its transfer time
+            to the request. Unlimited when None.
+
+        compress: bool (default False)
+
+            Compress the responses of at least compress_min_size bytes when
+            the client accepts gzip or deflate. Compressed requests are
+            always accepted.
+
+    bytes_in and bytes_out count the bodies as they were on the wire.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, rows=1000, columns=10,
+                 query_rows=None, failure_rate=0., failure_pattern=None,
+                 bandwidth=None, compress=False, compress_min_size=1024):
+        HTTPServer.__init__(self, ("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.rows = rows
+        self.columns = columns
+        self.query_rows = query_rows
+        self.failure_rate = failure_rate
+        self.failure_pattern = None if failure_pattern is None else \
+            re.compile(failure_pattern)
+        self.bandwidth = bandwidth
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.requests = {}
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.datasets = {}
+        self.functions = {}
+        self.procedures = {}
+        self.runs = {}
+        # Model of each file written by classifier.train
+        self.models = {}
+        self._matching = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def uri(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def count(self, method):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def transfer(self, size, direction):
+        with self._lock:
+            if direction == "in":
+                self.bytes_in += size
+            else:
+                self.bytes_out += size
+        if self.bandwidth:
+            time.sleep(size / float(self.bandwidth))
+
+    def should_fail(self, method, path):
+        if not self.failure_rate:
+            return False
+        if self.failure_pattern is not None and \
+                not self.failure_pattern.search(method + " " + path):
+            return False
+        with self._lock:
+            n = self._matching
+            self._matching += 1
+            fail = int((n + 1) * self.failure_rate) > int(n * self.failure_rate)
+            if fail:
+                self.failures += 1
+        return fail
+
+    def query(self, q):
+        """Columns and rows (row name first) of a query"""
+        applied = _APPLY.findall(q)
+        if applied:
+            function = self.functions.get(
+                q.split('"')[1].replace('""', '"'), {})
+            scores = []
+            for row, alias in applied:
+                features = dict(
+                    (name.replace('""', '"'), _sql_value(literal))
+                    for literal, name in _FIELD.findall(row))
+                scores.append(
+                    model_score(function["model"], features)
+                    if "model" in function else fake_score(features))
+            return [alias for row, alias in applied], [["result"] + scores]
+        match = _FROM.search(q)
+        dataset = self.datasets.get(match.group(1)) if match else None
+        if dataset is None:
+            dataset = {"columns": [], "rows": []}
+        rows = dataset["rows"]
+        if self.query_rows is not None:
+            rows = synthetic_dataset(
+                self.query_rows, len(dataset["columns"]) or self.columns
+            )["rows"]
+        rows = self._split(q, rows)
+
+        select = q[:match.start()] if match else q
+        aliases = [a for a in _ALIAS.findall(select)]
+        if _AGGREGATE.search(select):
+            values = []
+            for alias in aliases:
+                if alias in ("rows", "count"):
+                    values.append(len(rows))
+                elif alias == "latest":
+                    values.append({"ts": "2016-06-01T00:00:00Z"})
+                else:
+                    values.append(sum(
+                        r[1] for r in rows if isinstance(r[1], (int, float))))
+            return aliases, [["result"] + values]
+
+        offset = _OFFSET.search(q)
+        limit = _LIMIT.search(q)
+        start = int(offset.group(1)) if offset else 0
+        rows = rows[start:]
+        if limit:
+            rows = rows[:int(limit.group(1))]
+        if aliases:
+            return aliases, [
+                [r[0]] + [r[1] if a == "label" else _value(i, j)
+                          for j, a in enumerate(aliases)]
+                for i, r in enumerate(rows)]
+        return dataset["columns"], rows
+
+    def _split(self, sql, rows):
+        match = _SPLIT.search(sql)
+        if match is None:
+            return rows
+        op, k = match.group(1), int(match.group(2))
+        if op == "<":
+            return [r for i, r in enumerate(rows) if i % 100 < k]
+        return [r for i, r in enumerate(rows) if i % 100 >= k]
+
+    def _import_text(self, params):
+        path = params["dataFileUrl"]
+        if path.startswith("file://"):
+            path = path[len("file://"):]
+        with open(path) as f:
+            reader = csv.reader(f, delimiter=str(params.get("delimiter", ",")))
+            header = next(reader)
+            rows = [["r%d" % i] + [_number(v) for v in line]
+                    for i, line in enumerate(reader)]
+        return {"columns": header, "rows": rows}
+
+    def _train(self, params):
+        """fake_model on the features of the training data"""
+        match = _FEATURES.search(params.get("trainingData", ""))
+        features = []
+        if match is not None:
+            features = [
+                f.strip().strip('"').replace('""', '"')
+                for f in match.group(1).split(",")
+                if f.strip() and "*" not in f]
+        configuration = params.get("configuration") or {}
+        algorithm = configuration.get(params.get("algorithm"), {})
+        n_trees = algorithm.get("num_bags") if isinstance(
+            algorithm, dict) else None
+        return fake_model(features, n_trees)
+
+    def run_procedure(self, payload):
+        """Apply the effect of a procedure and return its run"""
+        kind = payload.get("type")
+        params = payload.get("params", {})
+        started = _now()
+        status = {}
+        output = None
+        if kind == "import.text":
+            output = self._import_text(params)
+        elif kind == "transform":
+            columns, rows = self.query(params["inputData"])
+            output = {"columns": columns, "rows": rows}
+        elif kind in ("classifier.train", "probabilizer.train"):
+            url = params.get("modelFileUrl", "")
+            if url.startswith("file://"):
+                path = url[len("file://"):]
+                directory = os.path.dirname(path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(path, "wb") as f:
+                    f.write(b"\0" * 1024)
+            function = {
+                "type": kind.split(".")[0],
+                "params": {"modelFileUrl": url}
+            }
+            if kind == "classifier.train":
+                function["model"] = self._train(params)
+                self.models[url] = function["model"]
+            if params.get("functionName"):
+                self.functions[params["functionName"]] = function
+        elif kind == "classifier.test":
+            status = {"auc": 0.8, "bestMcc": _POINT, "bestF": _POINT}
+            columns, rows = self.query(params["testingData"])
+            output = {"columns": columns, "rows": rows}
+        elif kind == "classifier.experiment":
+            status = {
+                "folds": [{"resultsTest": {"auc": 0.8 + 0.01 * i}}
+                          for i in range(max(1, params.get("kfold") or 1))]
+            }
+        elif "outputDataset" in params:
+            output = synthetic_dataset(self.rows, self.columns)
+
+        if output is not None and params.get("outputDataset"):
+            self.datasets[_output_id(params["outputDataset"])] = output
+        return {
+            "id": started,
+            "state": "finished",
+            "runStarted": started,
+            "runFinished": _now(),
+            "status": status
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-02 15:20:03
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-02 17:10:31
+# @File Name: feature_sql.py
+
+"""
+Size of the feature selection SQL for each compile method as the number of
+features grows. The synthetic dataset has columns in a few prefix groups and
+the features are most of the columns minus some scattered ones.
+
+With --mldb and --dataset, the statements are also sent to a real MLDB as
+SELECT {features} FROM dataset LIMIT 1 and the request time is reported.
+The dataset must have the columns f<group>_<i> for the largest size.
+
+    python -m skmldb.benchmarks.feature_sql --sizes 1000 20000
+"""
+
+import time
+import argparse
+
+from skmldb.feature_spec import compile_features
+
+
+def synthetic(n_features, groups=20, holes=0.01):
+    per_group = n_features // groups
+    columns = ["label"]
+    for g in range(groups):
+        columns.extend("f{}_{}".format(g, i) for i in range(per_group))
+    step = int(1 / holes) if holes else 0
+    features = [
+        c for i, c in enumerate(columns[1:])
+        if not step or i % step != step // 2 or i // per_group % 2]
+    return columns, features
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[100, 1000, 5000, 20000, 50000])
+    parser.add_argument("--mldb", default=None,
+                        help="URI of an MLDB server to time the queries")
+    parser.add_argument("--dataset", default=None)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    connection = None
+    if args.mldb is not None:
+        from pymldb import Connection
+        connection = Connection(args.mldb)
+
+    methods = ["list", "prefix", "excluding", "auto"]
+    print("{:>8} {:>10} {:>12} {:>10} {:>12}".format(
+        "features", "method", "sql bytes", "compile ms", "server ms"))
+    for size in args.sizes:
+        columns, features = synthetic(size)
+        for method in methods:
+            start = time.time()
+            sql = compile_features(
+                features, columns=columns, method=method, threshold=0)
+            compile_ms = (time.time() - start) * 1000
+            server_ms = float("nan")
+            if connection is not None and args.dataset is not None:
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.time()
+                    connection.get(
+                        "/v1/query",
+                        q="SELECT {%s} AS features FROM %s LIMIT 1" % (
+                            sql, args.dataset))
+                    timings.append(time.time() - start)
+                server_ms = min(timings) * 1000
+            print("{:>8} {:>10} {:>12} {:>10.2f} {:>12.2f}".format(
+                len(features), method, len(sql), compile_ms, server_ms))
+
+
+if __name__ == "__main__":
+    main()
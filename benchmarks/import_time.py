@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-14 13:51:09
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-14 16:20:33
+# @File Name: import_time.py
+
+"""
+Import time of the package and of its main modules, each timed in a fresh
+interpreter so nothing is already imported. Reported per module: median
+and best time in ms and whether NumPy and pandas got imported.
+
+    python -m skmldb.benchmarks.import_time --repeat 20
+
+Exits with status 1 when a module goes over its budget in ms, or imports
+NumPy or pandas when it should not. --scale multiplies the budgets for
+slower machines.
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+# Budget in ms and whether NumPy may be imported. pandas is never needed at
+# import time.
+BUDGETS = {
+    "skmldb": (5, False),
+    "skmldb.connection": (15, False),
+    "skmldb.utils": (25, False),
+    "skmldb.cross_validation": (40, False),
+    "skmldb.random": (40, False),
+    "skmldb.tree": (40, False),
+    "skmldb.ensemble": (40, False),
+    "skmldb.scoring": (30, False),
+    "skmldb.linear_model": (40, False),
+    "skmldb.classifier": (40, False),
+}
+
+_PROBE = """
+import sys, json, time
+start = time.time()
+import {module}
+seconds = time.time() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "numpy": "numpy" in sys.modules,
+    "pandas": "pandas" in sys.modules,
+    "modules": len(sys.modules)
+}}))
+"""
+
+
+def probe(module):
+    output = subprocess.check_output(
+        [sys.executable, "-c", _PROBE.format(module=module)])
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def measure(module, repeat):
+    runs = [probe(module) for i in range(repeat)]
+    times = sorted(r["seconds"] * 1000. for r in runs)
+    return {
+        "module": module,
+        "median_ms": times[len(times) // 2],
+        "best_ms": times[0],
+        "numpy": runs[-1]["numpy"],
+        "pandas": runs[-1]["pandas"],
+        "modules": runs[-1]["modules"]
+    }
+
+
+def check(result, scale):
+    """Reasons the result is over its budget, empty if it is not"""
+    budget, numpy_allowed = BUDGETS[result["module"]]
+    problems = []
+    if result["median_ms"] > budget * scale:
+        problems.append("{:.1f} ms over a budget of {:.1f} ms".format(
+            result["median_ms"], budget * scale))
+    if result["numpy"] and not numpy_allowed:
+        problems.append("imports numpy")
+    if result["pandas"]:
+        problems.append("imports pandas")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=sorted(BUDGETS),
+                        choices=sorted(BUDGETS))
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--scale", type=float, default=1.,
+                        help="factor applied to every budget")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    results = []
+    failed = False
+    print("{:<26} {:>10} {:>10} {:>6} {:>7} {:>8}  {}".format(
+        "module", "median ms", "best ms", "numpy", "pandas", "modules",
+        "budget"))
+    for module in args.modules:
+        try:
+            result = measure(module, args.repeat)
+        except subprocess.CalledProcessError:
+            print("{:<26} could not be imported".format(module))
+            failed = True
+            continue
+        problems = check(result, args.scale)
+        result["problems"] = problems
+        failed = failed or bool(problems)
+        results.append(result)
+        print("{:<26} {:>10.1f} {:>10.1f} {:>6} {:>7} {:>8}  {}".format(
+            module, result["median_ms"], result["best_ms"],
+            "yes" if result["numpy"] else "no",
+            "yes" if result["pandas"] else "no",
+            result["modules"], "; ".join(problems) or "ok"))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-05-19 14:40:27
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-05-19 16:39:12
+# @File Name: load_scoring.py
+
+"""
+Load test of score_one against the local stand-in server. Several client
+threads score rows as fast as they can and the batcher latencies are
+reported for a few batching windows.
+
+    python -m skmldb.benchmarks.load_scoring --clients 32 --latency 0.005
+"""
+
+import time
+import argparse
+import threading
+
+from pymldb import Connection
+from skmldb.connection import set_connection
+from skmldb.ensemble import RandomForestClassifier
+from skmldb.scoring import MicroBatcher
+from skmldb.benchmarks.fake_mldb import FakeMLDB
+
+
+def run(estimator, clients, rows_per_client, distinct_rows):
+    def client(i):
+        for j in range(rows_per_client):
+            estimator.score_one({"a": (i * rows_per_client + j) % distinct_rows})
+
+    threads = [
+        threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=200,
+                        help="rows scored by each client")
+    parser.add_argument("--distinct", type=int, default=1000,
+                        help="number of distinct rows")
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="latency of the fake server in seconds")
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument("--windows", type=float, nargs="+",
+                        default=[0, 0.001, 0.005])
+    args = parser.parse_args()
+
+    with FakeMLDB(latency=args.latency) as server:
+        set_connection(Connection(server.uri))
+        estimator = RandomForestClassifier(name="rf_load")
+        estimator.features = ["a"]
+
+        print("{:>8} {:>10} {:>9} {:>9} {:>9} {:>9}".format(
+            "window", "rows/s", "p50 ms", "p99 ms", "batches", "requests"))
+        for window in args.windows:
+            estimator.batcher = MicroBatcher(
+                estimator.name, window=window, pool_size=args.pool_size)
+            elapsed = run(estimator, args.clients, args.rows, args.distinct)
+            stats = estimator.batcher.latency_stats()
+            estimator.batcher.close()
+            print("{:>8} {:>10.0f} {:>9.2f} {:>9.2f} {:>9} {:>9}".format(
+                window, stats["count"] / elapsed, stats["p50"], stats["p99"],
+                stats["batches"], stats["requests"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-17 09:47:02
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-17 15:31:44
+# @File Name: streaming.py
+
+"""
+Peak memory of fetching a large query into NumPy arrays, against the local
+stand-in server. Each measure runs in its own process, the peak RSS growth
+is the one of the fetch. The ways of fetching are:
+
+    loads    json.loads of the whole body, then to_arrays, as before
+    pymldb   query_arrays on pymldb's Connection, which reads the whole body
+             but decodes the rows one at a time
+    stream   query_arrays on PooledConnection, decoding the body as it is
+             read from the socket
+
+    python -m skmldb.benchmarks.streaming --rows 100000 400000
+
+The arrays themselves take rows * (columns + 1) * 8 bytes, shown as
+"arrays MB".
+"""
+
+import json
+import time
+import argparse
+from multiprocessing import Pool
+
+from skmldb.benchmarks.fake_mldb import FakeMLDB, synthetic_dataset
+from skmldb.benchmarks.suite import peak_rss_mb
+
+MODES = ["loads", "pymldb", "stream"]
+
+QUERY = "SELECT * FROM bench"
+
+
+def _fetch(mode):
+    from skmldb.arrays import query_arrays, to_arrays
+    from skmldb.connection import conn
+
+    if mode == "loads":
+        response = conn.connection.get(
+            "/v1/query", q=QUERY, format="table", rowNames="false")
+        table = json.loads(response.content)
+        return to_arrays(table[0], table[1:])
+    return query_arrays(QUERY)
+
+
+def measure(args):
+    """Run in a child process"""
+    mode, uri = args
+    from pymldb import Connection
+    from skmldb.connection import set_connection, PooledConnection
+
+    if mode == "stream":
+        set_connection(PooledConnection(uri, notebook=False))
+    else:
+        set_connection(Connection(uri))
+    # Imports and first request out of the measure
+    from skmldb.arrays import query_arrays
+    query_arrays(QUERY + " LIMIT 10")
+
+    before = peak_rss_mb()
+    start = time.time()
+    arrays = _fetch(mode)
+    seconds = time.time() - start
+    return {
+        "mode": mode,
+        "seconds": seconds,
+        "peak_mb": peak_rss_mb() - before,
+        "arrays_mb": sum(a.nbytes for a in arrays.values()) / 1024. / 1024.
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+",
+                        default=[100000, 400000])
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    args = parser.parse_args()
+
+    print("{:>9} {:<8} {:>9} {:>14} {:>10}".format(
+        "rows", "mode", "seconds", "peak RSS+ MB", "arrays MB"))
+    with FakeMLDB() as server:
+        for rows in args.rows:
+            server.datasets["bench"] = synthetic_dataset(rows, args.columns)
+            for mode in args.modes:
+                pool = Pool(1)
+                try:
+                    result = pool.apply(measure, ((mode, server.uri),))
+                finally:
+                    pool.close()
+                    pool.join()
+                print("{:>9} {:<8} {:>9.2f} {:>14.1f} {:>10.1f}".format(
+                    rows, mode, result["seconds"], result["peak_mb"],
+                    result["arrays_mb"]))
+
+
+if __name__ == "__main__":
+    main()
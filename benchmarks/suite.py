@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-09 10:02:47
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-09 17:31:15
+# @File Name: suite.py
+
+"""
+Client overhead of the main entry points against the local stand-in server.
+Each scenario runs in its own process, so the peak RSS is the one of the
+scenario. Reported per scenario: operations and rows per second, latency
+percentiles in ms, failed operations and peak RSS in MB.
+
+    python -m skmldb.benchmarks.suite --rows 20000 --repeat 5 \\
+        --output run.json
+    python -m skmldb.benchmarks.suite --compare run.json --output new.json
+
+--compare prints the change of the p50 and of the throughput against a
+previous output file.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+from multiprocessing import Pool
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the RSS is not reported
+    resource = None
+
+import numpy as np
+import pandas as pd
+
+from pymldb import Connection
+from skmldb.connection import set_connection
+from skmldb.benchmarks.fake_mldb import FakeMLDB
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on OS X
+    if sys.platform == "darwin":
+        return peak / 1024. / 1024.
+    return peak / 1024.
+
+
+def _frame(rows, columns):
+    data = dict(
+        ("x%d" % j, np.arange(rows) * (j + 1) % 1000 / 1000.)
+        for j in range(columns))
+    data["label"] = np.arange(rows) % 2
+    return pd.DataFrame(data)
+
+
+class Context(object):
+    """What the scenarios share: the data and a scratch directory"""
+    def __init__(self, rows, columns, directory):
+        super(Context, self).__init__()
+        self.rows = rows
+        self.columns = columns
+        self.directory = directory
+        self.features = ["x%d" % j for j in range(columns)]
+
+    def dataset(self):
+        from skmldb.utils import dataset_from_dataframe
+        return dataset_from_dataframe(
+            _frame(self.rows, self.columns), "bench_source")
+
+    def split(self):
+        from skmldb.cross_validation import train_test_split
+        return train_test_split(
+            self.dataset(), train_name="bench_train", test_name="bench_test")
+
+    def fitted(self):
+        from skmldb.tree import DecisionTreeClassifier
+        train, test = self.split()
+        estimator = DecisionTreeClassifier(name="bench_dt")
+        estimator.fit(train, self.features, "label")
+        return estimator, test
+
+
+# Each scenario takes the context and returns (setup, operation, rows). The
+# operation is timed repeat times, after setup ran once.
+
+def scenario_dataset_from_dataframe(context):
+    from skmldb.utils import dataset_from_dataframe
+    df = _frame(context.rows, context.columns)
+    return None, lambda state: dataset_from_dataframe(df, "bench_df"), \
+        context.rows
+
+
+def scenario_to_csv(context):
+    from skmldb.utils import Dataset
+
+    def operation(name):
+        Dataset(name).to_csv(directory=context.directory)
+    return context.dataset, operation, context.rows
+
+
+def scenario_from_csv(context):
+    from skmldb.utils import Dataset
+
+    def setup():
+        name = context.dataset()
+        Dataset(name).to_csv(directory=context.directory)
+        return name
+
+    def operation(name):
+        Dataset(name).from_csv(directory=context.directory)
+    return setup, operation, context.rows
+
+
+def scenario_train_test_split(context):
+    from skmldb.cross_validation import train_test_split
+
+    def operation(name):
+        train_test_split(name, train_name="bench_a", test_name="bench_b")
+    return context.dataset, operation, context.rows
+
+
+def scenario_fit(context):
+    from skmldb.tree import DecisionTreeClassifier
+    from skmldb.cache import ModelCache, set_model_cache
+
+    set_model_cache(ModelCache(os.path.join(context.directory, "models")))
+
+    def operation(train):
+        from skmldb.cache import model_cache
+        # Every fit misses the cache
+        model_cache.clear()
+        DecisionTreeClassifier(name="bench_dt").fit(
+            train, context.features, "label")
+    return lambda: context.split()[0], operation, context.rows * 3 // 4
+
+
+def scenario_predict(context):
+    def operation(state):
+        estimator, test = state
+        estimator.predict(test, "bench_predictions")
+    return context.fitted, operation, context.rows // 4
+
+
+def scenario_test(context):
+    from skmldb.classifier import Test
+
+    def operation(state):
+        estimator, test = state
+        Test(test, estimator=estimator)
+    return context.fitted, operation, context.rows // 4
+
+
+def scenario_test_local(context):
+    from skmldb.classifier import Test
+
+    def operation(state):
+        estimator, test = state
+        Test(test, estimator=estimator, local=True)
+    return context.fitted, operation, context.rows // 4
+
+
+SCENARIOS = [
+    "dataset_from_dataframe",
+    "to_csv",
+    "from_csv",
+    "train_test_split",
+    "fit",
+    "predict",
+    "test",
+    "test_local"
+]
+
+
+def _error(e):
+    return "{}: {}".format(type(e).__name__, e)
+
+
+def run_scenario(args):
+    """
+    Run in a child process. Returns the result dict of the scenario. Errors
+    are returned as strings, the exceptions of pymldb do not pickle.
+    """
+    name, uri, rows, columns, repeat = args
+    set_connection(Connection(uri))
+    directory = tempfile.mkdtemp(prefix="skmldb_bench_")
+    rss_start = peak_rss_mb()
+    latencies = []
+    failures = 0
+    error = None
+    try:
+        context = Context(rows, columns, directory)
+        setup, operation, rows_per_op = globals()["scenario_" + name](context)
+        state = setup() if setup is not None else None
+        for i in range(repeat):
+            start = time.time()
+            try:
+                operation(state)
+            except Exception as e:
+                failures += 1
+                error = error or _error(e)
+                continue
+            latencies.append(time.time() - start)
+    except Exception as e:
+        # The setup failed, nothing was measured
+        failures = repeat
+        error = "setup: " + _error(e)
+        rows_per_op = None
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    result = {
+        "scenario": name,
+        "repeat": repeat,
+        "failures": failures,
+        "error": error,
+        "rows": rows_per_op,
+        "rss_start_mb": rss_start,
+        "peak_rss_mb": peak_rss_mb()
+    }
+    if latencies:
+        ms = np.array(latencies) * 1000.
+        total = sum(latencies)
+        result.update({
+            "ops_per_s": len(latencies) / total,
+            "rows_per_s": rows_per_op * len(latencies) / total,
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p90_ms": float(np.percentile(ms, 90)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "mean_ms": float(ms.mean())
+        })
+    return result
+
+
+def compare(results, baseline):
+    before = dict((r["scenario"], r) for r in baseline["results"])
+    print("\n{:<24} {:>12} {:>12}".format("scenario", "p50 change",
+                                            "rows/s change"))
+    for result in results:
+        old = before.get(result["scenario"])
+        if old is None or "p50_ms" not in old or "p50_ms" not in result:
+            continue
+        print("{:<24} {:>+11.1f}% {:>+11.1f}%".format(
+            result["scenario"],
+            100. * (result["p50_ms"] / old["p50_ms"] - 1),
+            100. * (result["rows_per_s"] / old["rows_per_s"] - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS,
+                        choices=SCENARIOS)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="latency of the fake server in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.)
+    parser.add_argument("--failure-pattern", default=None,
+                        help="regex on 'METHOD /path' of failing requests")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    args = parser.parse_args()
+
+    results = []
+    with FakeMLDB(latency=args.latency, failure_rate=args.failure_rate,
+                  failure_pattern=args.failure_pattern) as server:
+        print("{:<24} {:>9} {:>11} {:>9} {:>9} {:>9} {:>6} {:>8}".format(
+            "scenario", "ops/s", "rows/s", "p50 ms", "p90 ms", "p99 ms",
+            "fails", "RSS MB"))
+        for name in args.scenarios:
+            pool = Pool(1)
+            try:
+                result = pool.apply(run_scenario, ((
+                    name, server.uri, args.rows, args.columns,
+                    args.repeat),))
+            finally:
+                pool.close()
+                pool.join()
+            results.append(result)
+            print("{:<24} {:>9.1f} {:>11.0f} {:>9.2f} {:>9.2f} {:>9.2f} "
+                  "{:>6} {:>8.1f}".format(
+                      name, result.get("ops_per_s", 0),
+                      result.get("rows_per_s", 0),
+                      result.get("p50_ms", float("nan")),
+                      result.get("p90_ms", float("nan")),
+                      result.get("p99_ms", float("nan")),
+                      result["failures"], result["peak_rss_mb"] or 0))
+        requests = dict(server.requests)
+
+    output = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+        "server_requests": requests,
+        "results": results
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-15 14:08:51
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-15 18:40:17
+# @File Name: threads.py
+
+"""
+Stress test of connections selected per thread. Each of N threads drives
+its own stand-in server through using_connection: it imports a DataFrame,
+splits it and fits a decision tree, fits times. Reported for each N: fits
+per second, speedup over one thread and efficiency (speedup / N).
+
+Each server must only have seen the datasets of its thread, the run stops
+with an error otherwise.
+
+The servers run in this process and compete with the threads for the GIL,
+so --latency stands for the time MLDB spends on a request. With the
+default 50 ms the efficiency stays over 90% up to 8 threads.
+
+    python -m skmldb.benchmarks.threads --threads 1 2 4 8 16
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+from skmldb.connection import using_connection, PooledConnection
+from skmldb.cache import ModelCache, set_model_cache
+from skmldb.benchmarks.fake_mldb import FakeMLDB
+
+
+def _frame(rows, seed):
+    """Data of a fit, different for every seed so the model cache misses"""
+    state = np.random.RandomState(seed)
+    return pd.DataFrame({
+        "x0": state.rand(rows),
+        "x1": state.rand(rows),
+        "label": state.randint(0, 2, rows)
+    })
+
+
+def worker(index, server, fits, rows, errors):
+    from skmldb.utils import dataset_from_dataframe
+    from skmldb.cross_validation import train_test_split
+    from skmldb.tree import DecisionTreeClassifier
+
+    prefix = "w%d_" % index
+    try:
+        with using_connection(PooledConnection(server.uri, notebook=False)):
+            for k in range(fits):
+                source = dataset_from_dataframe(
+                    _frame(rows, index * 100003 + k), "%ssource_%d" % (
+                        prefix, k))
+                train, test = train_test_split(
+                    source, train_name="%strain_%d" % (prefix, k),
+                    test_name="%stest_%d" % (prefix, k))
+                DecisionTreeClassifier(name=prefix + "dt").fit(
+                    train, ["x0", "x1"], "label")
+    except Exception as e:
+        errors.append("thread {}: {}: {}".format(index, type(e).__name__, e))
+
+
+def run(n_threads, fits, rows, latency):
+    from skmldb.cache import model_cache
+
+    # The threads of a previous run fitted the same data
+    model_cache.clear()
+    servers = [FakeMLDB(latency=latency) for i in range(n_threads)]
+    for server in servers:
+        server.start()
+    errors = []
+    try:
+        threads = [
+            threading.Thread(target=worker, args=(i, servers[i], fits, rows,
+                                                  errors))
+            for i in range(n_threads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        seconds = time.time() - start
+        for i, server in enumerate(servers):
+            strangers = [
+                name for name in server.datasets
+                if not name.startswith("w%d_" % i)]
+            if strangers:
+                errors.append("server {} has datasets of other threads: {}"
+                              .format(i, ", ".join(sorted(strangers))))
+        requests = [sum(s.requests.values()) for s in servers]
+    finally:
+        for server in servers:
+            server.stop()
+    if errors:
+        raise RuntimeError("\n".join(errors))
+    return seconds, requests
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--fits", type=int, default=5,
+                        help="fits done by each thread")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="latency of the fake servers in seconds")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="skmldb_threads_")
+    cwd = os.getcwd()
+    # dataset_from_dataframe writes its CSV in the current directory
+    os.chdir(directory)
+    set_model_cache(ModelCache(os.path.join(directory, "models")))
+    try:
+        print("{:>8} {:>10} {:>10} {:>9} {:>11} {:>14}".format(
+            "threads", "seconds", "fits/s", "speedup", "efficiency",
+            "requests/srv"))
+        single = None
+        for n in args.threads:
+            seconds, requests = run(n, args.fits, args.rows, args.latency)
+            throughput = n * args.fits / seconds
+            if single is None:
+                single = throughput / n
+            speedup = throughput / single
+            print("{:>8} {:>10.2f} {:>10.1f} {:>9.2f} {:>10.0f}% {:>14}"
+                  .format(n, seconds, throughput, speedup,
+                          100. * speedup / n, min(requests)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
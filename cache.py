@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-05-24 10:20:38
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-05-24 18:11:54
+# @File Name: cache.py
+
+import os
+import json
+import time
+import hashlib
+import threading
+from .tracing import traced_method
+from .connection import conn
+
+mldb = conn
+
+# Parameters of the training procedure that do not change the model
+_IGNORED_PARAMS = ["modelFileUrl", "functionName", "runOnCreation"]
+
+# Type of the function created by each training procedure
+FUNCTION_TYPES = {
+    "classifier.train": "classifier",
+    "probabilizer.train": "probabilizer"
+}
+
+
+# Fingerprints of datasets whose content follows from the fingerprint of
+# another one, per connection, e.g. the dataset stored by a FeatureSet
+_derived = {}
+
+
+def register_fingerprint(dataset, fingerprint):
+    """
+    Use fingerprint for dataset instead of scanning it, until
+    register_fingerprint(dataset, None). Only for datasets written by this
+    package, like the one of a FeatureSet.
+    """
+    key = (id(mldb.current()), dataset)
+    if fingerprint is None:
+        _derived.pop(key, None)
+    else:
+        _derived[key] = fingerprint
+
+
+def dataset_fingerprint(dataset):
+    """
+    Cheap fingerprint of the content of a dataset: row count, a sum of the
+    row hashes and the latest timestamp. It changes when rows are added,
+    removed or recorded again.
+
+    Paramters:
+        dataset: string
+
+            Dataset name, or anything that can go in a FROM clause
+    """
+    fingerprint = _derived.get((id(mldb.current()), dataset))
+    if fingerprint is not None:
+        return fingerprint
+    response = mldb.connection.get(
+        "/v1/query",
+        q="""
+            SELECT
+                count(*) AS rows,
+                sum(rowHash() %% 1000003) AS names,
+                max(latest_timestamp({*})) AS latest
+            FROM %s
+        """ % dataset,
+        format="aos")
+    if response.status_code != 200:
+        raise Exception("could not fingerprint dataset.\n{}".format(
+            response.content))
+    content = json.loads(response.content)
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ModelCache(object):
+    """
+    Content addressed store for trained model files. The model path of a
+    training procedure is derived from its parameters (algorithm,
+    configuration, features, label) and from a fingerprint of the training
+    dataset. Training the same thing twice only recreates the function from
+    the model file written the first time.
+
+    The directory must be the same for MLDB and for this process, which is
+    the case when the notebook runs in the MLDB container. Otherwise the
+    model files are still unique but never reused. Whether a cached file is
+    still there is asked to MLDB, by loading it.
+    """
+    def __init__(self, directory=None, max_age=None, max_size=None):
+        """
+        Paramters:
+            directory: string (default None)
+
+                Where the model files are written. Defaults to skmldb_models
+                in the current directory.
+
+            max_age: float (default None)
+
+                Model files not used for that many seconds are evicted
+
+            max_size: int (default None)
+
+                Maximum total size in bytes of the model files. The least
+                recently used ones are evicted first.
+        """
+        super(ModelCache, self).__init__()
+        self._directory = directory
+        self.max_age = max_age
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        if self._directory is None:
+            self._directory = os.path.join(os.getcwd(), "skmldb_models")
+        return self._directory
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp = self._index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        os.rename(tmp, self._index_path)
+
+    def key(self, payload, dataset, fingerprint=None):
+        """
+        Key of a training payload on a dataset. fingerprint is the one of
+        the dataset when it is already known.
+        """
+        params = dict(
+            (k, v) for k, v in payload["params"].items()
+            if k not in _IGNORED_PARAMS)
+        description = json.dumps(
+            {"type": payload["type"], "params": params}, sort_keys=True)
+        digest = hashlib.sha1(description.encode("utf-8"))
+        if fingerprint is None:
+            fingerprint = dataset_fingerprint(dataset)
+        digest.update(fingerprint.encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".cls")
+
+    @traced_method
+    def train(self, name, payload, dataset, connection=None,
+              fingerprint=None):
+        """
+        Run a training procedure, or recreate its function from the cache.
+        The modelFileUrl of the payload is replaced by the content addressed
+        one.
+
+        Paramters:
+            name: string
+
+                Name of the procedure to create on a cache miss
+
+            payload: dict
+
+                Payload of the training procedure. Must have a functionName.
+
+            dataset: string
+
+                Dataset the training data is selected from
+
+            connection: MLDB connection (default None)
+
+                Server to train on. Defaults to the one of the connection
+                module. The fingerprint is always computed on the default
+                one.
+
+            fingerprint: string (default None)
+
+                Fingerprint of dataset, computed when not given. Fits
+                training several models on the same dataset pass it to
+                scan the dataset once.
+
+        Returns
+            The response of MLDB, for the procedure or for the function
+        """
+        key = self.key(payload, dataset, fingerprint)
+        path = self.path(key)
+        payload["params"]["modelFileUrl"] = "file://" + path
+
+        with self._lock:
+            indexed = key in self._load_index()
+
+        if connection is None:
+            connection = mldb.connection
+        response = None
+        if indexed:
+            # The file is read by MLDB, which may not see this disk. Loading
+            # it fails when it is gone.
+            try:
+                response = connection.put(
+                    "/v1/functions/" + payload["params"]["functionName"],
+                    {
+                        "type": FUNCTION_TYPES[payload["type"]],
+                        "params": {"modelFileUrl": "file://" + path}
+                    })
+            except Exception:
+                response = None
+            if response is not None and response.status_code != 201:
+                response = None
+        with self._lock:
+            if response is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if response is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            response = connection.put("/v1/procedures/" + name, payload)
+
+        if response.status_code == 201:
+            with self._lock:
+                index = self._load_index()
+                now = time.time()
+                entry = index.setdefault(key, {"created": now})
+                entry["last_used"] = now
+                entry["type"] = payload["type"]
+                self._save_index(index)
+            if self.max_age is not None or self.max_size is not None:
+                self.evict()
+        return response
+
+    def evict(self, max_age=None, max_size=None):
+        """
+        Remove model files unused for more than max_age seconds, then the
+        least recently used ones until the total size is under max_size
+        bytes. Defaults to the limits given at construction.
+
+        Returns
+            The list of evicted keys
+        """
+        max_age = self.max_age if max_age is None else max_age
+        max_size = self.max_size if max_size is None else max_size
+        now = time.time()
+        evicted = []
+        with self._lock:
+            index = self._load_index()
+            entries = []
+            for key, entry in index.items():
+                path = self.path(key)
+                if not os.path.exists(path):
+                    evicted.append(key)
+                    continue
+                if max_age is not None and now - entry["last_used"] > max_age:
+                    evicted.append(key)
+                    continue
+                entries.append((entry["last_used"], key, os.path.getsize(path)))
+            if max_size is not None:
+                entries.sort(reverse=True)
+                total = 0
+                for last_used, key, size in entries:
+                    total += size
+                    if total > max_size:
+                        evicted.append(key)
+            for key in evicted:
+                del index[key]
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+            self._save_index(index)
+        return evicted
+
+    def clear(self):
+        return self.evict(max_age=-1)
+
+    def stats(self):
+        """
+        Returns the number of hits and misses since this object was created,
+        the hit rate, the number of cached models and their total size
+        """
+        with self._lock:
+            index = self._load_index()
+            hits, misses = self.hits, self.misses
+        size = sum(
+            os.path.getsize(self.path(key)) for key in index
+            if os.path.exists(self.path(key)))
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": float(hits) / total if total else None,
+            "entries": len(index),
+            "size": size
+        }
+
+
+model_cache = ModelCache()
+
+
+def set_model_cache(cache):
+    global model_cache
+    model_cache.__dict__.update(cache.__dict__)
+    # Not shared with cache, which can still be used on its own
+    model_cache._lock = threading.Lock()
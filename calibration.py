@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-07 10:14:31
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-07 16:48:02
+# @File Name: calibration.py
+
+import numpy as np
+from .procedures import GLM_LINKS
+
+_EPS = 1e-10
+
+# Abramowitz and Stegun 7.1.26, |error| < 1.5e-7. Used both locally and in
+# SQL so the registered function gives the fitted probabilities.
+_ERF_P = 0.3275911
+_ERF_A = [0.254829592, -0.284496736, 1.421413741, -1.453152027, 1.061405429]
+
+
+def _erf(x):
+    z = np.abs(x)
+    t = 1. / (1. + _ERF_P * z)
+    poly = t * (_ERF_A[0] + t * (_ERF_A[1] + t * (
+        _ERF_A[2] + t * (_ERF_A[3] + t * _ERF_A[4]))))
+    return np.sign(x) * (1. - poly * np.exp(-z * z))
+
+
+def _erf_sql(x):
+    z = "abs(%s)" % x
+    t = "(1 / (1 + %r * %s))" % (_ERF_P, z)
+    poly = "%s * (%r + %s * (%r + %s * (%r + %s * (%r + %s * %r))))" % (
+        t, _ERF_A[0], t, _ERF_A[1], t, _ERF_A[2], t, _ERF_A[3], t, _ERF_A[4])
+    return "(CASE WHEN %s < 0 THEN -1 ELSE 1 END) * (1 - %s * exp(-%s * %s))" \
+        % (x, poly, z, z)
+
+
+def inverse_link(link, eta):
+    """Probability for the linear predictor eta"""
+    if link == "logit":
+        return 1. / (1. + np.exp(-eta))
+    if link == "probit":
+        return 0.5 * (1. + _erf(eta / np.sqrt(2.)))
+    if link == "comp_log_log":
+        return 1. - np.exp(-np.exp(eta))
+    if link == "linear":
+        return eta
+    if link == "log":
+        return np.exp(eta)
+    raise ValueError("link must be one of {}".format(list(GLM_LINKS)))
+
+
+def _derivative(link, eta, mu):
+    """d mu / d eta"""
+    if link == "logit":
+        return mu * (1. - mu)
+    if link == "probit":
+        return np.exp(-eta * eta / 2.) / np.sqrt(2. * np.pi)
+    if link == "comp_log_log":
+        return np.exp(eta - np.exp(eta))
+    if link == "linear":
+        return np.ones_like(eta)
+    return mu
+
+
+def _link(link, mu):
+    """eta for the probability mu, to start the iterations"""
+    if link == "logit":
+        return np.log(mu / (1. - mu))
+    if link == "probit":
+        # Logistic approximation of the inverse normal cdf
+        return np.log(mu / (1. - mu)) / 1.702
+    if link == "comp_log_log":
+        return np.log(-np.log(1. - mu))
+    if link == "linear":
+        return mu
+    return np.log(mu)
+
+
+def inverse_link_sql(link, eta):
+    """SQL computing the probability for the SQL linear predictor eta"""
+    if link == "logit":
+        return "1 / (1 + exp(-(%s)))" % eta
+    if link == "probit":
+        return "0.5 * (1 + %s)" % _erf_sql("((%s) / %r)" % (eta, np.sqrt(2.)))
+    if link == "comp_log_log":
+        return "1 - exp(-exp(%s))" % eta
+    if link == "linear":
+        return "(%s)" % eta
+    if link == "log":
+        return "exp(%s)" % eta
+    raise ValueError("link must be one of {}".format(list(GLM_LINKS)))
+
+
+def _clean(score, label, weight=None):
+    score = np.asarray(score, dtype=np.float64)
+    label = (np.nan_to_num(np.asarray(label, dtype=np.float64)) > 0) \
+        .astype(np.float64)
+    weight = np.ones_like(score) if weight is None else \
+        np.asarray(weight, dtype=np.float64)
+    keep = ~np.isnan(score)
+    return score[keep], label[keep], weight[keep]
+
+
+def fit_glm(score, label, link="logit", weight=None, max_iter=50, tol=1e-8):
+    """
+    Fit prob = inverse_link(a * score + b) by iteratively reweighted least
+    squares. Each iteration is a weighted 2x2 least squares problem solved
+    in closed form from sums over all the rows. The binomial variance is used
+    for every link except linear, which is plain least squares like the
+    probabilizer.train procedure.
+
+    Paramters:
+        score, label: arrays
+
+            Labels are positive when greater than 0
+
+        link: string (default=logit)
+
+        weight: array (default None)
+
+        max_iter: int (default=50)
+
+        tol: float (default=1e-8)
+
+            Stop when no coefficient moves by more than tol
+
+    Returns
+        (a, b)
+    """
+    if link not in GLM_LINKS:
+        raise ValueError("link must be one of {}".format(list(GLM_LINKS)))
+    score, label, weight = _clean(score, label, weight)
+    if len(score) == 0:
+        raise ValueError("no score to calibrate")
+
+    mean = np.clip(np.average(label, weights=weight), 1e-3, 1 - 1e-3)
+    a, b = 0., float(_link(link, mean))
+    for i in range(max_iter):
+        eta = a * score + b
+        mu = inverse_link(link, eta)
+        d = _derivative(link, eta, mu)
+        d = np.where(np.abs(d) < _EPS, _EPS, d)
+        if link == "linear":
+            variance = 1.
+        else:
+            clipped = np.clip(mu, _EPS, 1 - _EPS)
+            variance = clipped * (1 - clipped)
+        w = weight * d * d / variance
+        z = eta + (label - mu) / d
+
+        sw = w.sum()
+        sx = np.dot(w, score)
+        sxx = np.dot(w, score * score)
+        sz = np.dot(w, z)
+        sxz = np.dot(w, score * z)
+        determinant = sw * sxx - sx * sx
+        if abs(determinant) < _EPS * max(1., sw * sxx):
+            # Constant scores, only the intercept can be fitted
+            new_a, new_b = 0., sz / sw
+        else:
+            new_a = (sw * sxz - sx * sz) / determinant
+            new_b = (sxx * sz - sx * sxz) / determinant
+        done = max(abs(new_a - a), abs(new_b - b)) < tol
+        a, b = float(new_a), float(new_b)
+        if done:
+            break
+    return a, b
+
+
+def fit_isotonic(score, label, weight=None):
+    """
+    Non-decreasing step function of the score fitted by pool adjacent
+    violators. Rows are first summed per distinct score, so the loop runs
+    over distinct scores only.
+
+    Returns
+        (thresholds, values): the function is values[i] for
+        thresholds[i] <= score < thresholds[i + 1], values[0] below
+        thresholds[0] and values[-1] above thresholds[-1]
+    """
+    score, label, weight = _clean(score, label, weight)
+    if len(score) == 0:
+        raise ValueError("no score to calibrate")
+    unique, inverse = np.unique(score, return_inverse=True)
+    totals = np.bincount(inverse, weights=weight * label)
+    weights = np.bincount(inverse, weights=weight)
+
+    starts, sums, counts = [], [], []
+    for i in range(len(unique)):
+        starts.append(i)
+        sums.append(totals[i])
+        counts.append(weights[i])
+        # Merge with the previous block while it has a larger mean
+        while len(sums) > 1 and \
+                sums[-2] * counts[-1] >= sums[-1] * counts[-2]:
+            total, count = sums.pop(), counts.pop()
+            sums[-1] += total
+            counts[-1] += count
+            starts.pop()
+    thresholds = unique[starts]
+    values = np.array(sums) / np.array(counts)
+    return thresholds, values
+
+
+def predict_isotonic(thresholds, values, score):
+    index = np.searchsorted(thresholds, score, side="right") - 1
+    return values[np.clip(index, 0, len(values) - 1)]
+
+
+def isotonic_sql(thresholds, values, score="score"):
+    """
+    Step function as nested CASE expressions split at the middle threshold,
+    so a row goes through log2(steps) comparisons.
+    """
+    def build(lo, hi):
+        if lo == hi:
+            return repr(float(values[lo]))
+        mid = (lo + hi + 1) // 2
+        return "CASE WHEN %s < %r THEN %s ELSE %s END" % (
+            score, float(thresholds[mid]), build(lo, mid - 1), build(mid, hi))
+    return build(0, len(values) - 1)
@@ -7,19 +7,41 @@
 # @Last Modified time: 2016-05-17 09:24:28
 # @File Name: classifier.py
 
+import os
+import glob
 import json
-from utils import _create_output_dataset
-from exception import ArgumentError, ProcedureError
-from connection import conn
+import time
+import binascii
+from .utils import _create_output_dataset
+from .exception import ArgumentError, ProcedureError
+from .feature_set import resolve
+from .feature_spec import compile_features
+from .arrays import query_arrays
+from .tracing import traced, traced_method
+from .connection import conn, bind
 
 mldb = conn
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+_POINT_FIELDS = (
+    "recall", "precision", "f", "mcc", "gain", "threshold",
+    "falseNegatives", "truePositives", "trueNegatives", "falsePositives")
+
+
+class _BestPoint(object):
+    """
+    One point of the curve of a classifier.test. Only the values are kept,
+    arg rebuilds the dict of the response when needed.
+    """
+    __slots__ = _POINT_FIELDS
 
-class BestMCC(object):
-    """docstring for BestMCC"""
     def __init__(self, arg):
-        super(BestMCC, self).__init__()
-        self.arg = arg
+        super(_BestPoint, self).__init__()
         self.recall = arg["pr"]["recall"]
         self.precision = arg["pr"]["precision"]
         self.f = arg["pr"]["f"]
@@ -31,73 +53,316 @@ class BestMCC(object):
         self.trueNegatives = arg["counts"]["trueNegatives"]
         self.falsePositives = arg["counts"]["falsePositives"]
 
+    @property
+    def arg(self):
+        return {
+            "pr": {
+                "recall": self.recall,
+                "precision": self.precision,
+                "f": self.f
+            },
+            "mcc": self.mcc,
+            "gain": self.gain,
+            "threshold": self.threshold,
+            "counts": {
+                "falseNegatives": self.falseNegatives,
+                "truePositives": self.truePositives,
+                "trueNegatives": self.trueNegatives,
+                "falsePositives": self.falsePositives
+            }
+        }
+
     def __repr__(self):
-        r = "BestMCC\n"
-        r += "\trecall = {}\n".format(self.recall)
-        r += "\tprecision = {}\n".format(self.precision)
-        r += "\tf = {}\n".format(self.f)
-        r += "\tmcc = {}\n".format(self.mcc)
-        r += "\tgain = {}\n".format(self.gain)
-        r += "\tthreshold = {}\n".format(self.threshold)
-        r += "\tfalseNegatives = {}\n".format(self.falseNegatives)
-        r += "\ttruePositives = {}\n".format(self.truePositives)
-        r += "\ttrueNegatives = {}\n".format(self.trueNegatives)
-        r += "\tfalsePositives = {}\n".format(self.falsePositives)
+        r = type(self).__name__ + "\n"
+        for field in _POINT_FIELDS:
+            r += "\t{} = {}\n".format(field, getattr(self, field))
         return r
 
 
-class BestF(object):
-    """docstring for BestF"""
-    def __init__(self, arg):
-        super(BestF, self).__init__()
-        self.arg = arg
-        self.recall = arg["pr"]["recall"]
-        self.precision = arg["pr"]["precision"]
-        self.f = arg["pr"]["f"]
-        self.mcc = arg["mcc"]
-        self.gain = arg["gain"]
-        self.threshold = arg["threshold"]
-        self.falseNegatives = arg["counts"]["falseNegatives"]
-        self.truePositives = arg["counts"]["truePositives"]
-        self.trueNegatives = arg["counts"]["trueNegatives"]
-        self.falsePositives = arg["counts"]["falsePositives"]
+class BestMCC(_BestPoint):
+    """Point of the curve with the best Matthews correlation coefficient"""
+    __slots__ = ()
+
+
+class BestF(_BestPoint):
+    """Point of the curve with the best F score"""
+    __slots__ = ()
+
+
+class TestResult(object):
+    """
+    Result of Test. It unpacks like the (bestMCC, bestF, auc) tuple Test used
+    to return. The full curve is available as a metrics.Curve of NumPy
+    arrays (thresholds, tpr, fpr, precision, recall, mcc, f, counts). It is
+    fetched from the outputDataset of the procedure on first access, or
+    computed directly with a local Test.
+    """
+    __slots__ = ("bestMCC", "bestF", "auc", "outputDataset", "_curve")
+
+    def __init__(self, bestMCC, bestF, auc, outputDataset=None, curve=None):
+        super(TestResult, self).__init__()
+        self.bestMCC = bestMCC
+        self.bestF = bestF
+        self.auc = auc
+        self.outputDataset = outputDataset
+        self._curve = curve
+
+    @property
+    def curve(self):
+        if self._curve is None:
+            if self.outputDataset is None:
+                raise ArgumentError(
+                    "The curve is only available when Test is given an "
+                    "outputDataset or runs with local=True")
+            self._curve = fetch_curve(self.outputDataset)
+        return self._curve
+
+    def __iter__(self):
+        return iter((self.bestMCC, self.bestF, self.auc))
+
+    def __getitem__(self, i):
+        return (self.bestMCC, self.bestF, self.auc)[i]
+
+    def __len__(self):
+        return 3
 
     def __repr__(self):
-        r = "BestF\n"
-        r += "\trecall = {}\n".format(self.recall)
-        r += "\tprecision = {}\n".format(self.precision)
-        r += "\tf = {}\n".format(self.f)
-        r += "\tmcc = {}\n".format(self.mcc)
-        r += "\tgain = {}\n".format(self.gain)
-        r += "\tthreshold = {}\n".format(self.threshold)
-        r += "\tfalseNegatives = {}\n".format(self.falseNegatives)
-        r += "\ttruePositives = {}\n".format(self.truePositives)
-        r += "\ttrueNegatives = {}\n".format(self.trueNegatives)
-        r += "\tfalsePositives = {}\n".format(self.falsePositives)
-        return r
+        return "TestResult(auc={}, mcc={}, f={})".format(
+            self.auc, self.bestMCC.mcc, self.bestF.f)
+
+
+def fetch_curve(dataset):
+    """
+    Read the per threshold output dataset of a classifier.test procedure as
+    a metrics.Curve. An empty dataset gives a curve without thresholds, with
+    a NaN AUC and MCC.
+    """
+    from .metrics import Curve
+
+    arrays = query_arrays(
+        """
+        SELECT score, truePositives, falsePositives,
+               trueNegatives, falseNegatives
+        FROM %s
+        ORDER BY score DESC""" % dataset,
+        # An empty result has no columns
+        ["score", "truePositives", "falsePositives", "trueNegatives",
+         "falseNegatives"])
+    tp = arrays["truePositives"]
+    fp = arrays["falsePositives"]
+    if len(tp) == 0:
+        return Curve([], [], [], 0, 0)
+    return Curve(
+        arrays["score"], tp, fp,
+        tp[0] + arrays["falseNegatives"][0],
+        fp[0] + arrays["trueNegatives"][0])
+
+
+def _npz_path(path):
+    """path with the .npz suffix that np.savez adds when it is missing"""
+    if path is None or path.endswith(".npz"):
+        return path
+    return path + ".npz"
+
+
+class ResultArchive(object):
+    """
+    Columnar store for the results of many Test runs. Each metric is one
+    NumPy array with a value per run, and the curves are concatenated in
+    flat arrays with the offset of each run. Saved as a compressed .npz.
+    """
+    def __init__(self, path=None):
+        super(ResultArchive, self).__init__()
+        self.path = _npz_path(path)
+        self._columns = {"run": [], "auc": []}
+        for prefix in ["mcc", "f"]:
+            for field in _POINT_FIELDS:
+                self._columns[prefix + "_" + field] = []
+        self._curves = []
+        if self.path is not None and os.path.exists(self.path):
+            self._load(self.path)
+
+    def __len__(self):
+        return len(self._columns["run"])
+
+    def append(self, result, run=None, keep_curve=False):
+        """
+        Paramters:
+            result: TestResult
+
+            run: string (default None)
+
+                Name of the run. Defaults to its index.
+
+            keep_curve: boolean (default=False)
+
+                Store the full curve too. Fetches it if needed.
+        """
+        self._columns["run"].append(str(len(self) if run is None else run))
+        self._columns["auc"].append(result.auc)
+        for prefix, point in [("mcc", result.bestMCC), ("f", result.bestF)]:
+            for field in _POINT_FIELDS:
+                self._columns[prefix + "_" + field].append(
+                    getattr(point, field))
+        if keep_curve:
+            curve = result.curve
+            self._curves.append((
+                curve.thresholds[1:], curve.tp[1:], curve.fp[1:],
+                curve.positives, curve.negatives))
+        else:
+            self._curves.append(None)
+
+    def columns(self):
+        """The metrics as a dict of arrays, one value per run"""
+        import numpy as np
+
+        columns = {}
+        for name, values in self._columns.items():
+            if name == "run":
+                columns[name] = np.array(values)
+            else:
+                columns[name] = np.array(values, dtype=np.float64)
+        return columns
+
+    def to_frame(self):
+        import pandas as pd
+        columns = self.columns()
+        run = columns.pop("run")
+        return pd.DataFrame(columns, index=run)
+
+    def curve(self, i):
+        """The curve of run i, None if it was not kept"""
+        from .metrics import Curve
+
+        if self._curves[i] is None:
+            return None
+        return Curve(*self._curves[i])
+
+    def save(self, path=None):
+        import numpy as np
+
+        path = self.path if path is None else _npz_path(path)
+        arrays = self.columns()
+        offsets = [0]
+        parts = {"thresholds": [], "tp": [], "fp": []}
+        totals = []
+        for curve in self._curves:
+            if curve is None:
+                offsets.append(offsets[-1])
+                totals.append((np.nan, np.nan))
+                continue
+            thresholds, tp, fp, positives, negatives = curve
+            parts["thresholds"].append(thresholds)
+            parts["tp"].append(tp)
+            parts["fp"].append(fp)
+            offsets.append(offsets[-1] + len(thresholds))
+            totals.append((positives, negatives))
+        arrays["curve_offsets"] = np.array(offsets, dtype=np.int64)
+        arrays["curve_totals"] = np.array(
+            totals, dtype=np.float64).reshape(len(totals), 2)
+        for name, values in parts.items():
+            arrays["curve_" + name] = np.concatenate(values) if values \
+                else np.array([], dtype=np.float64)
+        np.savez_compressed(path, **arrays)
+
+    def _load(self, path):
+        import numpy as np
+
+        data = np.load(path)
+        for name in self._columns:
+            self._columns[name] = data[name].tolist()
+        offsets = data["curve_offsets"]
+        for i in range(len(offsets) - 1):
+            start, end = offsets[i], offsets[i + 1]
+            positives, negatives = data["curve_totals"][i]
+            if np.isnan(positives):
+                self._curves.append(None)
+                continue
+            self._curves.append((
+                data["curve_thresholds"][start:end],
+                data["curve_tp"][start:end],
+                data["curve_fp"][start:end],
+                positives, negatives))
 
 
-def Test(dataset, estimator=None, score=None, label=None, outputDataset=None):
+@traced
+def Test(
+        dataset,
+        estimator=None,
+        score=None,
+        label=None,
+        outputDataset=None,
+        local=False,
+        bins=None,
+        score_range=(0., 1.),
+        name=None):
+    """
+    Evaluate a binary classifier on a dataset, either with the estimator or
+    with a score expression and a label expression.
 
+    Parameters:
+        dataset: string or FeatureSet
+
+            Dataset name to use for testing
+
+        estimator: estimator object (default None)
+
+            Trained estimator. Its function gives the score and its label
+            the label.
+
+        score: string (default None)
+
+            Score expression, when no estimator is given
+
+        label: string (default None)
+
+            Label expression, when no estimator is given
+
+        outputDataset: string or OutputDataset (default None)
+
+            Where the classifier.test procedure writes the full curve. Not
+            available with local.
+
+        local: boolean (default=False)
+
+            Fetch the scores and labels and compute the metrics with NumPy
+            instead of running a classifier.test procedure. Saves the
+            procedure overhead when evaluating many times.
+
+        bins: int (default None)
+
+            With local, count the positive and negative rows of each bin
+            with a GROUP BY in MLDB and only fetch the counts, instead of
+            fetching every score. Memory stays constant whatever the number
+            of rows. See metrics.BinnedCounts for the error on the AUC.
+
+        score_range: (float, float) (default=(0, 1))
+
+            Range of the bins
+
+        name: string (default None)
+
+            Name of the classifier.test procedure. Defaults to the name of
+            the estimator or of the dataset followed by _test.
+
+    Returns
+        A TestResult, which unpacks as (BestMCC, BestF, auc)
+    """
+    dataset = resolve(dataset)[0]
     if estimator is not None:
-        testingData = """
-            SELECT
-                %(func)s({features:{"%(features)s"}})[score] as score,
-                %(label)s as label
-            FROM %(dataset)s""" % {
-                "func": estimator.name,
-                "features": '","'.join(estimator.features),
-                "label": estimator.label,
-                "dataset": dataset
-            }
+        score = _score_expression(estimator, dataset)
+        label = estimator.label
         proc_name = estimator.name
     elif score is not None:
         if label is None:
             msg = "If estimator is not provided, both score and label must \
             be provided"
             raise ArgumentError(msg)
+        proc_name = dataset
+    else:
+        raise ArgumentError("estimator or score must be provided")
 
-        testingData = """
+    testingData = """
             SELECT
                 %(score)s as score,
                 %(label)s as label
@@ -106,7 +371,12 @@ def Test(dataset, estimator=None, score=None, label=None, outputDataset=None):
                 "label": label,
                 "dataset": dataset
             }
-        proc_name = dataset
+
+    if local:
+        if outputDataset is not None:
+            raise ArgumentError("outputDataset is not available with local")
+        return _local_test(testingData, score, label, dataset, bins,
+                           score_range)
 
     params = {
         "testingData": testingData,
@@ -121,10 +391,12 @@ def Test(dataset, estimator=None, score=None, label=None, outputDataset=None):
     }
 
     if outputDataset is not None:
-        payload["outputDataset"] = _create_output_dataset(outputDataset)
+        params["outputDataset"] = _create_output_dataset(outputDataset)
 
+    if name is None:
+        name = proc_name + "_test"
     response = mldb.connection.put(
-        "/v1/procedures/" + proc_name + "_test",
+        "/v1/procedures/" + name,
         payload
         )
     if response.status_code != 201:
@@ -135,34 +407,628 @@ def Test(dataset, estimator=None, score=None, label=None, outputDataset=None):
     bestF = BestF(content["status"]["firstRun"]["status"]["bestF"])
     auc = content["status"]["firstRun"]["status"]["auc"]
 
-    return (bestMCC, bestF, auc)
+    return TestResult(
+        bestMCC, bestF, auc,
+        None if outputDataset is None else params["outputDataset"]["id"])
 
 
-def experiment(estimator, dataset, X, y, kfold=0, name=None):
-    if name is None:
-        name = estimator.name + "_xp"
+def _score_expression(estimator, dataset):
+    return "%(func)s({features:{%(features)s}})[score]" % {
+        "func": estimator.name,
+        "features": compile_features(estimator.features, dataset)
+    }
+
+
+@traced
+def TestMany(
+        dataset,
+        models,
+        label=None,
+        method="auto",
+        max_local_rows=10000000,
+        n_jobs=4,
+        bins=None,
+        score_range=(0., 1.)):
+    """
+    Evaluate several models on the same dataset.
+
+    Parameters:
+        dataset: string or FeatureSet
+
+            Dataset name to use for testing
+
+        models: list or dict
+
+            Estimators or score expressions. With a dict, the keys are the
+            model names. Otherwise estimators are named after their function
+            and score expressions after themselves.
+
+        label: string (default None)
+
+            Label expression. Defaults to the label of the estimators.
+
+        method: string (default=auto)
+
+            local: one query selects every score and the label, and the
+                metrics are computed with NumPy. The test set is read once.
+            server: one classifier.test procedure per model, n_jobs at a
+                time.
+            auto: local up to max_local_rows rows, server above.
+
+        max_local_rows: int (default=10000000)
+
+            Largest dataset evaluated locally with method auto
+
+        n_jobs: int (default=4)
+
+            Number of procedures running at the same time with server
+
+        bins: int (default None)
+
+            Bin the scores of each model with local. See Test.
+
+        score_range: (float, float) (default=(0, 1))
+
+            Range of the bins
+
+    Returns
+        A DataFrame indexed by model name with the auc, the best mcc and f
+        and their thresholds
+    """
+    import pandas as pd
+
+    if method not in ["auto", "local", "server"]:
+        raise ArgumentError("method must be one of auto, local or server")
+    dataset = resolve(dataset)[0]
+    if isinstance(models, dict):
+        names = list(models.keys())
+        models = [models[n] for n in names]
+    else:
+        names = [
+            m if isinstance(m, string_types) else m.name for m in models]
+    if label is None:
+        labels = set(
+            m.label for m in models if not isinstance(m, string_types))
+        if len(labels) != 1:
+            raise ArgumentError(
+                "label must be provided when the estimators do not all have "
+                "the same label")
+        label = labels.pop()
+
+    if method == "auto":
+        rows = query_arrays(
+            "SELECT count(*) AS rows FROM %s" % dataset)["rows"]
+        method = "local" if rows[0] <= max_local_rows else "server"
+
+    if method == "local":
+        from .metrics import roc_curve, BinnedCounts
+
+        scores = []
+        for i, model in enumerate(models):
+            if isinstance(model, string_types):
+                scores.append("%s AS s%d" % (model, i))
+            else:
+                scores.append("%s AS s%d" % (
+                    _score_expression(model, dataset), i))
+        arrays = query_arrays(
+            """
+            SELECT
+                %(scores)s,
+                %(label)s as label
+            FROM %(dataset)s""" % {
+                "scores": ",\n                ".join(scores),
+                "label": label,
+                "dataset": dataset
+            }, ["s%d" % i for i in range(len(models))] + ["label"])
+        results = []
+        for i in range(len(models)):
+            if bins is None:
+                curve = roc_curve(arrays["s%d" % i], arrays["label"])
+            else:
+                curve = BinnedCounts(bins, score_range).update(
+                    arrays["s%d" % i], arrays["label"]).curve()
+            results.append(_evaluate(curve))
+    else:
+        def test(args):
+            i, model = args
+            # Other TestMany calls on the dataset may run at the same time
+            test_name = _unique_name("%s_test_many_%d" % (dataset, i))
+            if isinstance(model, string_types):
+                return Test(dataset, score=model, label=label, name=test_name)
+            return Test(dataset, estimator=model, name=test_name)
+
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(n_jobs)
+        try:
+            results = pool.map(bind(test), list(enumerate(models)))
+        finally:
+            pool.close()
+            pool.join()
+
+    return pd.DataFrame(
+        [{
+            "auc": auc,
+            "mcc": bestMCC.mcc,
+            "mcc_threshold": bestMCC.threshold,
+            "f": bestF.f,
+            "f_threshold": bestF.threshold
+        } for bestMCC, bestF, auc in results],
+        index=names,
+        columns=["auc", "mcc", "mcc_threshold", "f", "f_threshold"])
+
+
+@traced
+def bootstrap_metrics(
+        score,
+        label=None,
+        n_boot=1000,
+        metrics=None,
+        dataset=None,
+        ci=0.95,
+        n_jobs=1,
+        random_state=None):
+    """
+    Confidence intervals of the AUC, best MCC and best F by bootstrap. The
+    scores and labels are fetched once and all replicates are computed
+    locally. See metrics.bootstrap.
+
+    Parameters:
+        score: array, string or estimator
+
+            Scores, or with dataset a score expression or a trained
+            estimator
+
+        label: array or string (default None)
+
+            Labels, or with dataset a label expression. Defaults to the label
+            of the estimator.
+
+        n_boot: int (default=1000)
+
+            Number of replicates
+
+        metrics: list of strings (default=["auc", "mcc", "f"])
+
+        dataset: string or FeatureSet (default None)
+
+            Dataset to select score and label from
+
+        ci: float (default=0.95)
+
+            Coverage of the intervals
+
+        n_jobs: int (default=1)
+
+            Number of processes
+
+        random_state: int (default None)
+
+    Returns
+        A dict with estimate, std, low, high and replicates for each metric
+    """
+    from .metrics import bootstrap, BOOTSTRAP_METRICS
+
+    if metrics is None:
+        metrics = BOOTSTRAP_METRICS
+    if dataset is not None:
+        dataset = resolve(dataset)[0]
+        if not isinstance(score, string_types):
+            if label is None:
+                label = score.label
+            score = _score_expression(score, dataset)
+        if label is None:
+            raise ArgumentError("label must be provided with a score expression")
+        arrays = query_arrays(
+            """
+            SELECT
+                %(score)s as score,
+                %(label)s as label
+            FROM %(dataset)s""" % {
+                "score": score,
+                "label": label,
+                "dataset": dataset
+            }, ["score", "label"])
+        score, label = arrays["score"], arrays["label"]
+    elif label is None:
+        raise ArgumentError("label must be provided")
+    return bootstrap(
+        score, label, n_boot, metrics, ci=ci, n_jobs=n_jobs,
+        random_state=random_state)
+
+
+def _evaluate(curve):
+    return TestResult(
+        BestMCC(curve.point(curve.best("mcc"))),
+        BestF(curve.point(curve.best("f"))),
+        curve.auc(),
+        curve=curve)
+
+
+def _local_test(testingData, score, label, dataset, bins, score_range):
+    from .metrics import roc_curve, BinnedCounts
+
+    if bins is None:
+        arrays = query_arrays(testingData, ["score", "label"])
+        return _evaluate(roc_curve(arrays["score"], arrays["label"]))
+
+    # The same bins as BinnedCounts.update, counted by MLDB in one pass
+    low = float(score_range[0])
+    width = (float(score_range[1]) - low) / bins
+    index = "floor((%s - %r) / %r)" % (score, low, width)
+    arrays = query_arrays(
+        """
+        SELECT
+            %(index)s AS bin,
+            sum(CASE WHEN %(label)s > 0 THEN 1 ELSE 0 END) AS positives,
+            count(*) AS rows
+        FROM %(dataset)s
+        WHERE %(score)s IS NOT NULL
+        GROUP BY %(index)s""" % {
+            "index": index,
+            "score": score,
+            "label": label,
+            "dataset": dataset
+        }, ["bin", "positives", "rows"])
+    counts = BinnedCounts(bins, score_range).add(
+        arrays["bin"], arrays["positives"],
+        arrays["rows"] - arrays["positives"])
+    return _evaluate(counts.curve())
+
+
+def _unique_name(prefix):
+    return "%s_%s" % (
+        prefix, binascii.hexlify(os.urandom(6)).decode("ascii"))
+
+
+def _flatten_numbers(results, prefix=""):
+    """Numeric leaves of nested results as {"a.b.c": value}"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten_numbers(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and \
+                not isinstance(value, bool):
+            flat[prefix + key] = float(value)
+    return flat
+
+
+class ExperimentResult(object):
+    """
+    Per-fold results of a classifier.experiment run. folds maps each metric
+    of the test folds, e.g. auc or bestMcc.mcc, to an array with one value
+    per fold. error is the reason the experiment failed, None when it
+    finished, and a failed experiment has no folds.
+    """
+    def __init__(self, name, configuration, status, error=None):
+        import numpy as np
+
+        super(ExperimentResult, self).__init__()
+        self.name = name
+        self.configuration = configuration
+        self.status = status
+        self.error = error
+        folds = [_flatten_numbers(fold.get("resultsTest", {}))
+                 for fold in status.get("folds", [])]
+        keys = set(folds[0]) if folds else set()
+        for fold in folds[1:]:
+            keys &= set(fold)
+        self.folds = dict(
+            (key, np.array([fold[key] for fold in folds])) for key in keys)
+
+    def mean(self):
+        return dict((k, float(v.mean())) for k, v in self.folds.items())
+
+    def std(self):
+        return dict((k, float(v.std())) for k, v in self.folds.items())
+
+    def __repr__(self):
+        if self.error is not None:
+            return "ExperimentResult({}, failed)".format(self.name)
+        return "ExperimentResult({}, {} folds)".format(
+            self.name, len(self.status.get("folds", [])))
+
+
+def _experiment_payload(estimator, dataset, X, y, kfold, name, directory):
     trainingData = """
         SELECT
             {%(features)s} as features,
             %(label)s as label
         FROM %(campaign)s""" % {
-            "features": ",".join(X),
+            "features": compile_features(X, dataset),
             "label": y,
             "campaign": dataset
         }
-    response = mldb.connection.put("/v1/procedures/dt", {
+    return {
         "type": "classifier.experiment",
         "params": {
             "experimentName": name,
             "trainingData": trainingData,
             "kfold": kfold,
-            "modelFileUrlPattern": """file://dt_donotcare.cls""",
-            "algorithm": estimator.configuration.keys()[0],
+            # $runid is replaced by MLDB, name keeps the files of
+            # experiments running at the same time apart
+            "modelFileUrlPattern": "file://" + os.path.join(
+                directory, name + "_$runid.cls"),
+            "algorithm": list(estimator.configuration.keys())[0],
             "configuration": estimator.configuration,
             "mode": estimator._mode,
             "outputAccuracyDataset": True,
-            "runOnCreation": True
+            "runOnCreation": False
         }
-    })
+    }
+
+
+class ExperimentRunner(object):
+    """
+    Run classifier.experiment procedures concurrently. Every experiment gets
+    its own procedure, experiment and model file names, so experiments of
+    the same estimator, or from several notebooks, never overwrite each
+    other. The runs are started asynchronously and polled until they finish,
+    with at most max_running of them on the server at a time. An experiment
+    that fails does not stop the others, its result has the error.
+    """
+    def __init__(
+            self,
+            max_running=4,
+            poll_interval=0.5,
+            max_poll_interval=10.,
+            timeout=None,
+            model_directory="",
+            cleanup=True,
+            keep_models=False):
+        """
+        Paramters:
+            max_running: int (default=4)
+
+                Number of experiments running at the same time
+
+            poll_interval: float (default=0.5)
+
+                Seconds between two status checks. Doubles while nothing
+                finishes, up to max_poll_interval.
+
+            max_poll_interval: float (default=10)
+
+            timeout: float (default None)
+
+                Seconds before giving up on the experiments still running
+
+            model_directory: string (default="")
+
+                Where MLDB writes the model files
+
+            cleanup: bool (default=True)
+
+                Delete the procedures once their results are read
+
+            keep_models: bool (default=False)
+
+                Keep the model file of every fold. Otherwise they are
+                deleted once the results are read, from the disk of this
+                process, so model_directory must be the same for MLDB and
+                for this process, like the directory of the model cache.
+        """
+        super(ExperimentRunner, self).__init__()
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.model_directory = model_directory
+        self.cleanup = cleanup
+        self.keep_models = keep_models
+
+    def _start(self, experiment):
+        response = mldb.connection.put(
+            "/v1/procedures/" + experiment["procedure"], experiment["payload"])
+        if response.status_code != 201:
+            raise ProcedureError("could not create experiment.\n{}".format(
+                response.content))
+        response = mldb.connection.post(
+            "/v1/procedures/" + experiment["procedure"] + "/runs?async=true",
+            {})
+        if response.status_code not in (200, 201):
+            raise ProcedureError("could not start experiment.\n{}".format(
+                response.content))
+        experiment["run"] = json.loads(response.content)["id"]
+
+    def _poll(self, experiment):
+        """The run status once it finished, None while it runs"""
+        response = mldb.connection.get(
+            "/v1/procedures/" + experiment["procedure"] + "/runs/" +
+            experiment["run"])
+        run = json.loads(response.content)
+        state = run.get("state")
+        if state == "finished":
+            return run
+        if state == "error":
+            raise ProcedureError("experiment {} failed.\n{}".format(
+                experiment["name"], response.content))
+        return None
+
+    def _finish(self, experiment):
+        """Delete what the experiment left on the server and on disk"""
+        if self.cleanup:
+            try:
+                mldb.connection.delete(
+                    "/v1/procedures/" + experiment["procedure"])
+            except Exception:
+                pass
+        if not self.keep_models:
+            # The files of the folds, named after the procedure
+            for path in glob.glob(os.path.join(
+                    self.model_directory, experiment["procedure"] + "_*.cls")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
 
-    return response
\ No newline at end of file
+    @traced_method
+    def run(self, estimators, dataset, X=None, y=None, kfold=3):
+        """
+        Paramters:
+            estimators: list or dict of estimators
+
+                One experiment per estimator. With a dict the keys name the
+                configurations.
+
+            dataset: string or FeatureSet
+
+            X: array of strings (default None)
+
+                Features. Defaults to the features of each estimator.
+
+            y: string (default None)
+
+                Label. Defaults to the label of each estimator.
+
+            kfold: int (default=3)
+
+        Returns
+            A list of ExperimentResult in the order of the estimators. The
+            ones that failed or timed out have an error.
+        """
+        dataset, X, y = resolve(dataset, X, y)
+        if isinstance(estimators, dict):
+            names = list(estimators.keys())
+            estimators = [estimators[n] for n in names]
+        else:
+            names = [e.name for e in estimators]
+
+        pending = []
+        for i, (name, estimator) in enumerate(zip(names, estimators)):
+            # Only set once the estimator is fitted
+            features = X if X is not None else getattr(
+                estimator, "features", None)
+            label = y if y is not None else getattr(estimator, "label", None)
+            if features is None or label is None:
+                raise ArgumentError(
+                    "X and y must be provided for estimator {}".format(name))
+            unique = _unique_name(name + "_xp")
+            pending.append({
+                "index": i,
+                "name": name,
+                "procedure": unique,
+                "configuration": estimator.configuration,
+                "payload": _experiment_payload(
+                    estimator, dataset, features, label, kfold, unique,
+                    self.model_directory)
+            })
+        pending.reverse()
+
+        results = [None] * len(pending)
+        running = []
+        start = time.time()
+        interval = self.poll_interval
+
+        def fail(experiment, error):
+            results[experiment["index"]] = ExperimentResult(
+                experiment["name"], experiment["configuration"], {},
+                error=error)
+            self._finish(experiment)
+
+        try:
+            while pending or running:
+                while pending and len(running) < self.max_running:
+                    experiment = pending.pop()
+                    try:
+                        self._start(experiment)
+                    except Exception as e:
+                        fail(experiment, str(e))
+                        continue
+                    running.append(experiment)
+                if not running:
+                    continue
+
+                time.sleep(interval)
+                still_running = []
+                for experiment in running:
+                    try:
+                        run = self._poll(experiment)
+                    except Exception as e:
+                        fail(experiment, str(e))
+                        continue
+                    if run is None:
+                        still_running.append(experiment)
+                        continue
+                    results[experiment["index"]] = ExperimentResult(
+                        experiment["name"], experiment["configuration"],
+                        run.get("status", {}))
+                    self._finish(experiment)
+                if len(still_running) < len(running):
+                    interval = self.poll_interval
+                else:
+                    interval = min(2 * interval, self.max_poll_interval)
+                running = still_running
+
+                if self.timeout is not None and \
+                        time.time() - start > self.timeout:
+                    for experiment in running:
+                        fail(experiment, "still running after {} seconds"
+                             .format(self.timeout))
+                    for experiment in pending:
+                        fail(experiment, "not started after {} seconds"
+                             .format(self.timeout))
+                    running = []
+                    pending = []
+        finally:
+            for experiment in running:
+                self._finish(experiment)
+        return results
+
+
+def experiments_summary(results):
+    """
+    Mean and std over the folds of every metric, one row per configuration.
+    An error column holds the reason of the experiments that failed, when
+    any did.
+    """
+    import pandas as pd
+
+    rows = []
+    for result in results:
+        row = {}
+        if result.error is not None:
+            row["error"] = result.error
+        for key, value in result.mean().items():
+            row[key + "_mean"] = value
+        for key, value in result.std().items():
+            row[key + "_std"] = value
+        rows.append(row)
+    frame = pd.DataFrame(rows, index=[r.name for r in results])
+    return frame[sorted(frame.columns)]
+
+
+@traced
+def run_experiments(
+        estimators,
+        dataset,
+        X=None,
+        y=None,
+        kfold=3,
+        max_running=4,
+        **kwargs):
+    """
+    Cross-validate several estimators at once with classifier.experiment.
+    See ExperimentRunner for the other arguments.
+
+    Returns
+        A DataFrame indexed by configuration with the mean and std over the
+        folds of each test metric
+    """
+    runner = ExperimentRunner(max_running=max_running, **kwargs)
+    return experiments_summary(runner.run(estimators, dataset, X, y, kfold))
+
+
+@traced
+def experiment(estimator, dataset, X, y, kfold=0, name=None):
+    """
+    Run one classifier.experiment under unique names and return its
+    ExperimentResult
+    """
+    if name is None:
+        name = estimator.name
+    result = ExperimentRunner(max_running=1).run(
+        {name: estimator}, dataset, X, y, kfold)[0]
+    if result.error is not None:
+        raise ProcedureError(result.error)
+    return result
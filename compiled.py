@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-05-20 09:47:13
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-05-20 17:05:36
+# @File Name: compiled.py
+
+import json
+import numpy as np
+from multiprocessing import Pool
+from .scoring import apply_function_many
+from .tracing import traced, traced_method
+from .connection import conn
+
+mldb = conn
+
+OP_LESS = 0
+OP_EQUAL = 1
+
+
+def fetch_model(name):
+    """
+    Get the trained model of a classifier function from its details route.
+
+    Paramters:
+        name: string
+
+            Name of the classifier function
+
+    Returns
+        The model as a dict
+    """
+    response = mldb.connection.get("/v1/functions/" + name + "/details")
+    if response.status_code != 200:
+        raise Exception("could not get function details.\n{}".format(
+            response.content))
+    content = json.loads(response.content)
+    return content.get("model", content)
+
+
+def _find_trees(model):
+    """
+    Returns a list of (tree root, weight) and the bias of the model. A
+    single tree is a committee of one.
+    """
+    if "classifiers" in model:
+        weights = model.get("weights", [1.] * len(model["classifiers"]))
+        trees = []
+        for sub, weight in zip(model["classifiers"], weights):
+            sub_trees, sub_bias = _find_trees(sub)
+            if sub_bias != 0:
+                raise Exception("nested committees with a bias are not "
+                                "supported")
+            trees.extend((root, weight * w) for root, w in sub_trees)
+        return trees, model.get("bias", 0.)
+    for key in ["tree", "root"]:
+        if key in model:
+            return [(model[key], 1.)], 0.
+    if "split" in model or "pred" in model:
+        return [(model, 1.)], 0.
+    raise Exception("can not compile model of type {}, keys {}".format(
+        model.get("type"), sorted(model.keys())))
+
+
+def _check_node(node):
+    """Raises a clear error on a node that is neither a split nor a leaf"""
+    if not isinstance(node, dict):
+        raise Exception("unknown tree node: {!r}".format(node))
+    if "split" in node:
+        split = node["split"]
+        if not isinstance(split, dict) or \
+                "feature" not in split or "value" not in split:
+            raise Exception("unknown split: {!r}".format(split))
+        if split.get("op", "<") not in ["<", "=="]:
+            raise Exception("unsupported split {}".format(split))
+        for child in [("true", "left"), ("false", "right")]:
+            if node.get(child[0], node.get(child[1])) is None:
+                raise Exception("split without a {} child: {}".format(
+                    child[0], split))
+    elif "pred" not in node and "value" not in node:
+        raise Exception("unknown tree node with keys {}".format(
+            sorted(node.keys())))
+
+
+def _leaf_value(node):
+    pred = node.get("pred", node.get("value"))
+    if isinstance(pred, list):
+        # boolean mode, the score is the weight of the positive class
+        return float(pred[-1])
+    return float(pred)
+
+
+class CompiledForest(object):
+    """
+    Decision trees flattened in NumPy arrays, one entry per node. Internal
+    nodes have the index of the feature they split on, the threshold and the
+    index of their children. Leaves have a feature index of -1 and a value.
+
+    The trained model is read with the layout returned by the details route
+    of a classifier function:
+
+        tree node: {"split": {"feature": "a", "op": "<", "value": 1.5},
+                    "true": node, "false": node, "missing": node}
+        leaf: {"pred": [0.2, 0.8]}
+        forest: {"classifiers": [model, ...], "weights": [...], "bias": 0}
+
+    The score of a row is the weighted sum of the leaf values of all trees
+    plus the bias, the same way MLDB combines the bags of a forest.
+    """
+    def __init__(self, model, features=None):
+        """
+        Paramters:
+            model: dict
+
+                Model as returned by fetch_model
+
+            features: array of strings (default None)
+
+                Order of the columns of the arrays given to predict. Features
+                used by the model but missing from the list are appended.
+        """
+        super(CompiledForest, self).__init__()
+        self.features = list(features) if features is not None else []
+        self._index = dict((f, i) for i, f in enumerate(self.features))
+
+        feature, threshold, op = [], [], []
+        true_child, false_child, missing_child, value = [], [], [], []
+        roots, weights = [], []
+
+        def add(node, depth):
+            i = len(feature)
+            feature.append(-1)
+            threshold.append(np.nan)
+            op.append(OP_LESS)
+            true_child.append(i)
+            false_child.append(i)
+            missing_child.append(i)
+            value.append(0.)
+            _check_node(node)
+            if "split" not in node:
+                value[i] = _leaf_value(node)
+                return depth
+            split = node["split"]
+            feature[i] = self._feature_index(split["feature"])
+            threshold[i] = float(split["value"])
+            op[i] = OP_LESS if split.get("op", "<") == "<" else OP_EQUAL
+            t = len(feature)
+            d_true = add(node.get("true", node.get("left")), depth + 1)
+            f = len(feature)
+            d_false = add(node.get("false", node.get("right")), depth + 1)
+            true_child[i] = t
+            false_child[i] = f
+            missing_child[i] = f
+            d_missing = depth
+            if node.get("missing") is not None:
+                missing_child[i] = len(feature)
+                d_missing = add(node["missing"], depth + 1)
+            return max(d_true, d_false, d_missing)
+
+        trees, self.bias = _find_trees(model)
+        self.depth = 0
+        for root, weight in trees:
+            roots.append(len(feature))
+            weights.append(weight)
+            self.depth = max(self.depth, add(root, 0))
+
+        self.feature = np.array(feature, dtype=np.int32)
+        self.threshold = np.array(threshold, dtype=np.float64)
+        self.op = np.array(op, dtype=np.int8)
+        self.true_child = np.array(true_child, dtype=np.int32)
+        self.false_child = np.array(false_child, dtype=np.int32)
+        self.missing_child = np.array(missing_child, dtype=np.int32)
+        self.value = np.array(value, dtype=np.float64)
+        self.roots = np.array(roots, dtype=np.int32)
+        self.weights = np.array(weights, dtype=np.float64)
+
+    def _feature_index(self, name):
+        if name not in self._index:
+            self._index[name] = len(self.features)
+            self.features.append(name)
+        return self._index[name]
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    def _arrays(self):
+        return (self.feature, self.threshold, self.op, self.true_child,
+                self.false_child, self.missing_child, self.value, self.roots,
+                self.weights, self.bias, self.depth)
+
+    def to_matrix(self, X):
+        """
+        Convert rows to a float matrix with the columns in the order of
+        self.features. X can be a DataFrame, a list of dict or a 2d array
+        already in the right order. Missing features are NaN.
+        """
+        if isinstance(X, np.ndarray):
+            return X.astype(np.float64, copy=False)
+        if hasattr(X, "reindex"):
+            return X.reindex(columns=self.features).values.astype(np.float64)
+        matrix = np.full((len(X), len(self.features)), np.nan)
+        for i, row in enumerate(X):
+            for name, value in row.items():
+                j = self._index.get(name)
+                if j is not None and value is not None:
+                    matrix[i, j] = value
+        return matrix
+
+    @traced_method
+    def predict(self, X, n_jobs=1, chunk_size=100000):
+        """
+        Score all rows of X at once.
+
+        Parameters:
+            X: DataFrame, list of dict or 2d array
+
+                Rows to score. See to_matrix
+
+            n_jobs: int (default=1)
+
+                Number of processes to use. The rows are split in chunks of
+                chunk_size rows scored in parallel when there is more than
+                one chunk.
+
+            chunk_size: int (default=100000)
+
+                Number of rows per chunk when n_jobs > 1
+
+        Returns
+            A 1d array with the score of each row
+        """
+        matrix = self.to_matrix(X)
+        if n_jobs <= 1 or len(matrix) <= chunk_size:
+            return _score(self._arrays(), matrix)
+        arrays = self._arrays()
+        chunks = [
+            (arrays, matrix[i:i + chunk_size])
+            for i in range(0, len(matrix), chunk_size)]
+        pool = Pool(n_jobs)
+        try:
+            scores = pool.map(_score_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        return np.concatenate(scores)
+
+    def verify(self, name, rows, atol=1e-6):
+        """
+        Compare the local scores with the ones of the MLDB function on a few
+        rows. Raises if any score differs by more than atol.
+
+        Parameters:
+            name: string
+
+                Name of the MLDB function
+
+            rows: list of dict
+
+                Rows to score on both sides
+
+        Returns
+            The largest absolute difference
+        """
+        local = self.predict(rows)
+        server = np.array(apply_function_many(name, rows))
+        deviation = float(np.max(np.abs(local - server))) if len(rows) else 0.
+        if deviation > atol:
+            raise Exception(
+                "compiled model differs from the server by {}".format(
+                    deviation))
+        return deviation
+
+
+def _score(arrays, X):
+    """
+    Level by level traversal of every tree for every row. At each step all
+    rows that are still on an internal node move to one of its children.
+    """
+    (feature, threshold, op, true_child, false_child, missing_child, value,
+     roots, weights, bias, depth) = arrays
+    n = X.shape[0]
+    nodes = np.tile(roots, (n, 1))
+    rows = np.repeat(np.arange(n), len(roots)).reshape(nodes.shape)
+    with np.errstate(invalid="ignore"):
+        for _ in range(depth):
+            current = feature[nodes]
+            internal = current >= 0
+            if not internal.any():
+                break
+            at = nodes[internal]
+            x = X[rows[internal], current[internal]]
+            cond = np.where(
+                op[at] == OP_EQUAL, x == threshold[at], x < threshold[at])
+            nxt = np.where(cond, true_child[at], false_child[at])
+            nodes[internal] = np.where(np.isnan(x), missing_child[at], nxt)
+    return value[nodes].dot(weights) + bias
+
+
+def _score_chunk(args):
+    return _score(*args)
+
+
+@traced
+def compile_function(name, features=None):
+    """
+    Fetch the model of a trained classifier function and compile it.
+    """
+    return CompiledForest(fetch_model(name), features)
@@ -4,29 +4,300 @@
 # @Email: atremblay@datacratic.com
 # @Date:   2016-05-16 16:53:40
 # @Last Modified by:   Alexis Tremblay
-# @Last Modified time: 2016-05-17 09:01:07
+# @Last Modified time: 2016-06-15 17:26:08
 # @File Name: connection.py
 
+"""
+The connection every module talks to MLDB through. set_connection sets the
+default one, for the whole process. using_connection selects another one
+for a block, only in the current thread (or asyncio task on Python 3.7+):
+
+    with using_connection(PooledConnection("http://host-a")):
+        forest.fit("train", X, y)
+
+Threads started by the package (pools, pipelines, batchers) run with the
+connection of the thread that started them.
+"""
+
+import json
+import zlib
+import functools
+import threading
+from contextlib import contextmanager
+from .tracing import tracer, TracedConnection
+from .runstats import run_stats, StatsConnection
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+
+class _ThreadLocalVar(object):
+    """The part of contextvars.ContextVar used here, per thread"""
+    def __init__(self, name, default=None):
+        super(_ThreadLocalVar, self).__init__()
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, "value", self.default)
+
+    def set(self, value):
+        previous = self.get()
+        self._local.value = value
+        return previous
+
+    def reset(self, token):
+        self._local.value = token
+
+
+def _context_var(name):
+    if ContextVar is None:
+        return _ThreadLocalVar(name)
+    return ContextVar(name, default=None)
+
 
 class MLDB(object):
     """docstring for MLDB"""
     def __init__(self, connection):
         super(MLDB, self).__init__()
         self._connection = connection
+        self._selected = _context_var("skmldb_connection")
+
+    def current(self):
+        """The connection selected for this thread, else the default one"""
+        connection = self._selected.get()
+        if connection is None:
+            connection = self._connection
+        return connection
 
     @property
     def connection(self):
-        if self._connection is None:
+        connection = self.current()
+        if connection is None:
             msg = "Connection to MLDB has not been set."
             msg += " You must call set_connection from the connection module"
             msg += " with an MLDB connection"
             raise ConnectionError(msg)
-        return self._connection
+        if run_stats.enabled:
+            connection = StatsConnection(connection)
+        if tracer.enabled:
+            connection = TracedConnection(connection)
+        return connection
 
 
 conn = MLDB(None)
 
 
 def set_connection(connection):
+    """Default connection, used where using_connection selected none"""
     global conn
     conn._connection = connection
+
+
+@contextmanager
+def using_connection(connection):
+    """
+    Use connection for the block, in the current thread or asyncio task
+    only. Blocks can be nested.
+    """
+    token = conn._selected.set(connection)
+    try:
+        yield connection
+    finally:
+        conn._selected.reset(token)
+
+
+def bind(func):
+    """
+    func running with the connection of the caller, for functions run by
+    another thread
+    """
+    connection = conn._selected.get()
+    if connection is None:
+        # The default connection is seen by every thread
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with using_connection(connection):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# wbits of zlib for each Content-Encoding
+_WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+
+def compress_body(data, encoding, level=6):
+    """data compressed for the Content-Encoding gzip or deflate"""
+    if encoding not in _WBITS:
+        raise ValueError("encoding must be one of {}".format(
+            sorted(_WBITS)))
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+class PooledConnection(object):
+    """
+    Same interface and errors as pymldb.Connection, with one HTTP session
+    per thread. Requests of a thread reuse its kept-alive sockets instead of
+    opening a connection each, and threads do not share any session state.
+
+    Request bodies can be compressed, which MLDB must accept: it is off by
+    default. Responses are compressed when the server supports it, and
+    decompressed as they are read. bytes_sent and bytes_received count the
+    bodies as they were on the wire.
+    """
+    def __init__(self, host="http://localhost", pool_size=10, notebook=True,
+                 compress=None, compress_min_size=1024, compress_level=6,
+                 accept_encoding="gzip, deflate"):
+        """
+        Paramters:
+            host: string (default http://localhost)
+
+                URI of MLDB
+
+            pool_size: int (default=10)
+
+                Sockets kept alive by the session of each thread
+
+            notebook: bool (default=True)
+
+                Give the responses an HTML representation for notebooks,
+                which imports pymldb and pandas on the first request
+
+            compress: string (default None)
+
+                gzip or deflate to compress the request bodies, None to send
+                them as they are
+
+            compress_min_size: int (default=1024)
+
+                Smaller bodies are sent as they are, compressing them would
+                cost more time than it saves
+
+            compress_level: int (default=6)
+
+                zlib level, 1 is the fastest and 9 the smallest
+
+            accept_encoding: string (default "gzip, deflate")
+
+                Accept-Encoding of the requests, None to ask for responses
+                as they are
+        """
+        super(PooledConnection, self).__init__()
+        if not host.startswith("http"):
+            raise Exception("URIs must start with 'http'")
+        if compress is not None and compress not in _WBITS:
+            raise ValueError("compress must be one of {}".format(
+                sorted(_WBITS)))
+        self.uri = host.rstrip("/")
+        self.notebook = notebook
+        self.pool_size = pool_size
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+        self.accept_encoding = accept_encoding
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            import requests
+
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Accept-Encoding"] = \
+                self.accept_encoding or "identity"
+            self._local.session = session
+        return session
+
+    def _encode(self, payload):
+        """Body and headers of a JSON payload"""
+        headers = {"Content-Type": "application/json"}
+        data = json.dumps(payload).encode("utf-8")
+        if self.compress is not None and len(data) >= self.compress_min_size:
+            data = compress_body(data, self.compress, self.compress_level)
+            headers["Content-Encoding"] = self.compress
+        return data, headers
+
+    def _request(self, method, url, payload=None, **kwargs):
+        data = None
+        if payload is not None:
+            data, kwargs["headers"] = self._encode(payload)
+        response = self.session.request(
+            method, self.uri + url, data=data, **kwargs)
+        received = response.headers.get("Content-Length")
+        if received is None and not kwargs.get("stream"):
+            received = len(response.content)
+        with self._lock:
+            self.bytes_sent += len(data) if data is not None else 0
+            # Unknown for a streamed response without Content-Length
+            self.bytes_received += int(received or 0)
+        if self.notebook:
+            from pymldb.util import add_repr_html_to_response
+            response = add_repr_html_to_response(response)
+        if response.status_code < 200 or response.status_code >= 400:
+            from pymldb import ResourceError
+            raise ResourceError(response)
+        return response
+
+    def _params(self, kwargs):
+        params = {}
+        for key, value in kwargs.items():
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            params[str(key)] = value
+        return params
+
+    def get(self, url, data=None, **kwargs):
+        return self._request("GET", url, data, params=self._params(kwargs))
+
+    def get_stream(self, url, data=None, **kwargs):
+        """
+        GET returning as soon as the headers are read. The body is read
+        with iter_content, and the socket goes back to the pool once it is
+        read to the end or the response is closed.
+        """
+        return self._request(
+            "GET", url, data, params=self._params(kwargs), stream=True)
+
+    def put(self, url, payload=None):
+        return self._request("PUT", url, payload or {})
+
+    def post(self, url, payload=None):
+        return self._request("POST", url, payload or {})
+
+    def delete(self, url):
+        return self._request("DELETE", url)
+
+    def query(self, sql, **kwargs):
+        """Same as pymldb.Connection.query"""
+        if kwargs.get("format", "dataframe") == "dataframe":
+            import pandas as pd
+
+            rows = self.get(
+                "/v1/query", data={"q": sql, "format": "table"}).json()
+            if len(rows) == 0:
+                return pd.DataFrame()
+            return pd.DataFrame.from_records(
+                rows[1:], columns=rows[0], index="_rowName")
+        kwargs["q"] = sql
+        return self.get("/v1/query", **kwargs).json()
+
+    def close(self):
+        """Close the session of the current thread"""
+        session = getattr(self._local, "session", None)
+        if session is not None:
+            session.close()
+            self._local.session = None
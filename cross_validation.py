@@ -7,13 +7,15 @@
 # @Last Modified time: 2016-05-17 09:18:17
 # @File Name: cross_validation.py
 
-from procedures import Transform
-import uuid
-from connection import conn
+from .procedures import Transform
+from .utils import generate_random_name
+from .tracing import traced
+from .connection import conn
 
 mldb = conn
 
 
+@traced
 def train_test_split(
         dataset,
         test_size=None,
@@ -77,7 +79,7 @@ def train_test_split(
         raise ValueError(msg)
 
     if train_name is None:
-        train_name = "d"+str(uuid.uuid4().hex)
+        train_name = generate_random_name("d")
     response = mldb.connection.put(
         "/v1/procedures/train_test_split",
         Transform(
@@ -93,7 +95,7 @@ def train_test_split(
             response.content))
 
     if test_name is None:
-        test_name = "d"+str(uuid.uuid4().hex)
+        test_name = generate_random_name("d")
     response = mldb.connection.put(
         "/v1/procedures/train_test_split",
         Transform(
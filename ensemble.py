@@ -8,14 +8,20 @@
 # @File Name: ensemble.py
 
 import json
-from procedures import Transform
-from utils import generate_random_name
-from connection import conn
+import zlib
+from .procedures import Transform, Probabilizer
+from .utils import generate_random_name
+from .scoring import RowScoring
+from .cache import model_cache, dataset_fingerprint
+from .feature_set import resolve
+from .feature_spec import compile_features
+from .tracing import traced_method
+from .connection import conn, bind
 
 mldb = conn
 
 
-class RandomForestClassifier(object):
+class RandomForestClassifier(RowScoring):
     """docstring for RandomForestClassifier"""
     def __init__(
             self,
@@ -23,7 +29,10 @@ class RandomForestClassifier(object):
             max_depth=-1,
             random_feature_propn=1,
             update_alg="gentle",
-            name="RandomForestClassifier"):
+            name="RandomForestClassifier",
+            warm_start=False,
+            n_jobs=1,
+            shard_rows=False):
 
         """
         Parameters
@@ -41,6 +50,24 @@ class RandomForestClassifier(object):
 
                 The maximum depth of the tree. If -1, then nodes are expanded
                 until all leaves are pure.
+
+            warm_start : bool, optional (default=False)
+
+                When set to True, fit only trains the trees missing to reach
+                n_estimators, as a separate sub-forest, and the function
+                averages the sub-forests. The forest of a previous fit
+                without warm start is kept as the first sub-forest.
+                Otherwise the whole forest is trained again.
+
+            n_jobs : integer, optional (default=1)
+
+                Number of sub-forests trained concurrently when fit has trees
+                to add in warm start mode.
+
+            shard_rows : bool, optional (default=False)
+
+                In warm start mode, train each of the n_jobs concurrent
+                sub-forests on its own shard of the rows.
         """
 
         super(RandomForestClassifier, self).__init__()
@@ -49,6 +76,11 @@ class RandomForestClassifier(object):
         self.random_feature_propn = random_feature_propn
         self.name = name
         self.update_alg = update_alg
+        self.warm_start = warm_start
+        self.n_jobs = n_jobs
+        self.shard_rows = shard_rows
+        self.sub_forests = []
+        self.probabilizer = None
         self._mode = "boolean"
         self.configuration = {
             "rf": {
@@ -67,12 +99,14 @@ class RandomForestClassifier(object):
             }
         }
 
-    def fit(self, dataset, X, y):
+    @traced_method
+    def fit(self, dataset, X=None, y=None, connections=None):
         """
         Parameters:
-            dataset: string
+            dataset: string or FeatureSet
 
-                Dataset name to use for training
+                Dataset name to use for training. With a FeatureSet, X and y
+                default to its features and label.
 
             X: array of strings
 
@@ -81,19 +115,23 @@ class RandomForestClassifier(object):
             y: string
 
                 Name of the target to use. a.k.a. label
+
+            connections: array of MLDB connections (default None)
+
+                Only used in warm start mode. The sub-forests are trained on
+                these servers in turn, then loaded on the server of the
+                connection module from their model file. The model cache
+                directory must be shared by all servers.
         """
+        dataset, X, y = resolve(dataset, X, y)
+        if self.warm_start:
+            return self._fit_warm(dataset, X, y, connections)
+
         self.features = X
         self.label = y
+        self.sub_forests = []
 
-        trainingData = """
-            SELECT
-                {%(features)s} as features,
-                %(label)s as label
-            FROM %(campaign)s""" % {
-                "features": ",".join(X),
-                "label": y,
-                "campaign": dataset
-            }
+        trainingData = self._training_data(dataset)
 
         self.training_payload = {
             "type": "classifier.train",
@@ -102,20 +140,191 @@ class RandomForestClassifier(object):
                 "algorithm": "rf",
                 "configuration": self.configuration,
                 "mode": self._mode,
-                "modelFileUrl": "file://donotcare.cls",
                 "functionName": self.name,
                 "runOnCreation": True
             }
         }
 
-        response = mldb.connection.put(
-            "/v1/procedures/"+self.name,
-            self.training_payload)
+        response = model_cache.train(
+            self.name, self.training_payload, dataset)
 
         if response.status_code != 201:
             raise Exception("could not train random forest.\n{}".format(
                 response.content))
+        # First sub-forest if warm start is turned on later
+        self.sub_forests = [{
+            "name": self.name,
+            "n_estimators": self.configuration["rf"]["num_bags"],
+            "modelFileUrl": self.training_payload["params"]["modelFileUrl"]
+        }]
+
+    def _training_data(self, dataset, where=None):
+        trainingData = """
+            SELECT
+                {%(features)s} as features,
+                %(label)s as label
+            FROM %(campaign)s""" % {
+                "features": compile_features(self.features, dataset),
+                "label": self.label,
+                "campaign": dataset
+            }
+        if where is not None:
+            trainingData += """
+            WHERE %s""" % where
+        return trainingData
+
+    def _fit_warm(self, dataset, X, y, connections):
+        if list(X) != list(getattr(self, "features", [])) \
+                or y != getattr(self, "label", None):
+            self.sub_forests = []
+        self.features = X
+        self.label = y
+
+        trained = sum(sub["n_estimators"] for sub in self.sub_forests)
+        missing = self.n_estimators - trained
+        if missing < 0:
+            raise ValueError(
+                "n_estimators={} must be larger or equal to the {} trees "
+                "already trained when warm_start is True".format(
+                    self.n_estimators, trained))
+
+        n_parts = max(1, min(self.n_jobs, missing))
+        parts = []
+        for i in range(n_parts if missing else 0):
+            where = None
+            if self.shard_rows and n_parts > 1:
+                where = "rowHash() % {} = {}".format(n_parts, i)
+            parts.append({
+                "name": "{}_part{}".format(
+                    self.name, len(self.sub_forests) + i),
+                "n_estimators": missing // n_parts + (
+                    1 if i < missing % n_parts else 0),
+                "where": where,
+                "connection": None if not connections else connections[
+                    i % len(connections)]
+            })
+
+        if not parts:
+            return
+        if self.sub_forests and self.sub_forests[0]["name"] == self.name:
+            self._keep_cold_forest()
+
+        # Scanned once for all the parts
+        fingerprint = dataset_fingerprint(dataset)
+
+        def train(part):
+            configuration = json.loads(json.dumps(self.configuration))
+            configuration["rf"]["num_bags"] = part["n_estimators"]
+            configuration["rf"]["_note"] = "random forest, " + part["name"]
+            # Without a seed of its own each sub-forest draws the same bags
+            configuration["rf"]["random_seed"] = \
+                zlib.crc32(part["name"].encode("utf-8")) & 0x7fffffff
+            payload = {
+                "type": "classifier.train",
+                "params": {
+                    "trainingData": self._training_data(
+                        dataset, part["where"]),
+                    "algorithm": "rf",
+                    "configuration": configuration,
+                    "mode": self._mode,
+                    "functionName": part["name"],
+                    "runOnCreation": True
+                }
+            }
+            response = model_cache.train(
+                part["name"], payload, dataset, part["connection"],
+                fingerprint)
+            if response.status_code != 201:
+                return response
+            if part["connection"] is not None:
+                # Trained elsewhere, load the model on the scoring server
+                response = mldb.connection.put(
+                    "/v1/functions/" + part["name"],
+                    {
+                        "type": "classifier",
+                        "params": {
+                            "modelFileUrl":
+                                payload["params"]["modelFileUrl"]
+                        }
+                    })
+            return response
+
+        if len(parts) > 1:
+            from multiprocessing.pool import ThreadPool
+
+            pool = ThreadPool(len(parts))
+            try:
+                responses = pool.map(bind(train), parts)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            responses = [train(part) for part in parts]
+
+        for part, response in zip(parts, responses):
+            if response.status_code != 201:
+                raise Exception("could not train random forest.\n{}".format(
+                    response.content))
+            self.sub_forests.append({
+                "name": part["name"],
+                "n_estimators": part["n_estimators"]
+            })
+
+        self._combine()
+
+    def _keep_cold_forest(self):
+        """
+        The forest of a fit without warm start is the function named after
+        the estimator, which _combine replaces. Load its model under the
+        name of a sub-forest first.
+        """
+        cold = self.sub_forests[0]
+        name = "{}_part0".format(self.name)
+        response = mldb.connection.put("/v1/functions/" + name, {
+            "type": "classifier",
+            "params": {"modelFileUrl": cold["modelFileUrl"]}
+        })
+        if response.status_code != 201:
+            raise Exception("could not create function.\n{}".format(
+                response.content))
+        cold["name"] = name
+
+    def _combine(self):
+        """
+        Create the function named after the estimator as the average of the
+        sub-forests, weighted by their number of trees. The new function is
+        created under another name first, so the current one keeps scoring
+        until it is replaced, and is left as it is if the new one fails.
+        """
+        total = sum(sub["n_estimators"] for sub in self.sub_forests)
+        expression = "(%s) / %d AS score" % (
+            " + ".join(
+                "%s({features: features})[score] * %d" % (
+                    sub["name"], sub["n_estimators"])
+                for sub in self.sub_forests),
+            total)
+        config = {
+            "type": "sql.expression",
+            "params": {
+                "expression": expression
+            }
+        }
+        staged = self.name + "_" + generate_random_name("f")
+        response = mldb.connection.put("/v1/functions/" + staged, config)
+        if response.status_code != 201:
+            raise Exception("could not create function.\n{}".format(
+                response.content))
+        try:
+            # Replaced in place, it is never missing
+            response = mldb.connection.put(
+                "/v1/functions/" + self.name, config)
+        finally:
+            mldb.connection.delete("/v1/functions/" + staged)
+        if response.status_code != 201:
+            raise Exception("could not create function.\n{}".format(
+                response.content))
 
+    @traced_method
     def predict(self, dataset, predict_set_name=None):
         """
         Predict class for X.
@@ -126,7 +335,7 @@ class RandomForestClassifier(object):
         trees.
 
         Parameters:
-            dataset: string
+            dataset: string or FeatureSet
 
                 Dataset name to use for testing
 
@@ -135,6 +344,7 @@ class RandomForestClassifier(object):
                 Name to give to the dataset containing the predictions. If None,
                 a randomly generated name will be given
         """
+        dataset = resolve(dataset)[0]
 
         if predict_set_name is None:
             predict_set_name = generate_random_name()
@@ -145,7 +355,7 @@ class RandomForestClassifier(object):
                 FROM %(test)s
             """ % {
                 "func": self.name,
-                "features": ",".join(self.features),
+                "features": compile_features(self.features, dataset),
                 "test": dataset
                 },
             outputDataset=predict_set_name
@@ -159,5 +369,100 @@ class RandomForestClassifier(object):
                 response.content))
         return predict_set_name
 
+    @traced_method
+    def calibrate(self, dataset, probabilizer=None):
+        """
+        Fit a Probabilizer on the scores of this estimator and attach it for
+        predict_proba. The scores are computed inside the training procedure
+        of the probabilizer, no score dataset is created.
+
+        Parameters:
+            dataset: string or FeatureSet
+
+                Dataset name to use for the calibration
+
+            probabilizer: Probabilizer (default None)
+
+                Unfitted probabilizer to use. Defaults to a logit one named
+                after the estimator.
+        """
+        dataset = resolve(dataset)[0]
+        if probabilizer is None:
+            probabilizer = Probabilizer(name=self.name + "_proba")
+        probabilizer.fit(
+            dataset,
+            """%(func)s({{%(features)s} as features})[score]""" % {
+                "func": self.name,
+                "features": compile_features(self.features, dataset)
+            },
+            self.label)
+        self.probabilizer = probabilizer
+
+    @traced_method
+    def predict_proba(self, dataset, predict_set_name=None):
+        """
+        Calibrated probabilities with the attached probabilizer (see
+        calibrate). The estimator and the probabilizer are applied in the
+        same transform. The output is the same as Probabilizer.predict on the
+        output of predict.
+
+        Parameters:
+            dataset: string or FeatureSet
+
+                Dataset name to use for testing
+
+            predict_set_name: string (default None)
+
+                Name to give to the dataset containing the probabilities. If
+                None, a randomly generated name will be given
+        """
+        dataset = resolve(dataset)[0]
+        if self.probabilizer is None:
+            raise ValueError(
+                "No probabilizer attached. Call calibrate or set probabilizer")
+        if predict_set_name is None:
+            predict_set_name = generate_random_name()
+        self.predict_payload = Transform(
+            inputData="""
+                SELECT
+                    %(proba)s({
+                        %(func)s({{%(features)s} as features})[score] as score
+                    }) as predict
+                FROM %(test)s
+            """ % {
+                "proba": self.probabilizer.name,
+                "func": self.name,
+                "features": compile_features(self.features, dataset),
+                "test": dataset
+            },
+            outputDataset=predict_set_name
+        )()
+        response = mldb.connection.put(
+            "/v1/procedures/" + self.name + "_predict_proba",
+            self.predict_payload
+        )
+        if response.status_code != 201:
+            raise Exception("could not create dataset.\n{}".format(
+                response.content))
+        return predict_set_name
+
+    @traced_method
+    def compile(self):
+        """
+        Pull the trained model from MLDB and compile it to NumPy arrays to
+        score rows in process. See compiled.CompiledForest.
+        """
+        from .compiled import compile_function, fetch_model, CompiledForest
+
+        if not self.sub_forests:
+            return compile_function(self.name, self.features)
+        total = float(sum(sub["n_estimators"] for sub in self.sub_forests))
+        return CompiledForest({
+            "classifiers": [
+                fetch_model(sub["name"]) for sub in self.sub_forests],
+            "weights": [
+                sub["n_estimators"] / total for sub in self.sub_forests]
+        }, self.features)
+
     def __repr__(self):
         return json.dumps(self.configuration, indent=4)
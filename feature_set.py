@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-01 09:12:44
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-01 15:37:09
+# @File Name: feature_set.py
+
+import re
+import json
+import hashlib
+import threading
+from .procedures import Transform
+from .utils import OutputDataset
+from .cache import dataset_fingerprint, register_fingerprint
+from .feature_spec import compile_features
+from .tracing import traced_method
+from .connection import conn
+
+mldb = conn
+
+_ALIAS = re.compile(r"\s+as\s+([\w\"]+)\s*$", re.IGNORECASE)
+
+
+def _column_name(expression):
+    """
+    Name of the column produced by a select expression: the alias if there
+    is one, the expression itself otherwise.
+    """
+    match = _ALIAS.search(expression)
+    if match is None:
+        return expression.strip()
+    return match.group(1).strip('"')
+
+
+class FeatureSet(object):
+    """
+    The features and the label of a dataset, computed once and stored in a
+    dataset of their own. Estimators accept a FeatureSet wherever they take a
+    dataset name, and then train or predict on the stored columns instead of
+    evaluating the feature expressions on the source dataset every time.
+
+    The source dataset is fingerprinted when the features are stored. Every
+    time the FeatureSet is used the fingerprint is checked again and the
+    features are stored again if the source changed. The stored dataset
+    gets a fingerprint made from the one of the source, so the model cache
+    does not scan it again.
+    """
+    def __init__(self, dataset, X, y=None, name=None, dataset_type="tabular"):
+        """
+        Paramters:
+            dataset: string
+
+                Source dataset name
+
+            X: array of strings
+
+                Features. Either column names or expressions with an alias,
+                e.g. "log(price) AS log_price"
+
+            y: string (default None)
+
+                Label. Not needed for a FeatureSet only used to predict.
+
+            name: string (default None)
+
+                Name of the dataset holding the features. Defaults to the
+                source name followed by _features.
+
+            dataset_type: string (default=tabular)
+
+                MLDB dataset type of the stored features
+        """
+        super(FeatureSet, self).__init__()
+        self.source = dataset
+        self.X = list(X)
+        self.y = y
+        self.name = name if name is not None else dataset + "_features"
+        self.dataset_type = dataset_type
+        self.fingerprint = None
+        self._lock = threading.Lock()
+
+    @property
+    def features(self):
+        """Names of the feature columns in the stored dataset"""
+        return [_column_name(x) for x in self.X]
+
+    @property
+    def label(self):
+        """Name of the label column in the stored dataset"""
+        if self.y is None:
+            return None
+        return _column_name(self.y)
+
+    def is_stale(self):
+        return self.fingerprint != dataset_fingerprint(self.source)
+
+    @traced_method
+    def materialize(self, force=False):
+        """
+        Store the features if it was never done or if the source dataset
+        changed since. Returns the name of the stored dataset.
+        """
+        with self._lock:
+            fingerprint = dataset_fingerprint(self.source)
+            if not force and fingerprint == self.fingerprint:
+                register_fingerprint(self.name, self._stored_fingerprint())
+                return self.name
+
+            select = compile_features(self.X, self.source)
+            if self.y is not None:
+                select += "," + self.y
+            register_fingerprint(self.name, None)
+            try:
+                mldb.connection.delete("/v1/datasets/" + self.name)
+            except Exception:
+                # Never stored before
+                pass
+            response = mldb.connection.put(
+                "/v1/procedures/" + self.name,
+                Transform(
+                    inputData="""
+                        SELECT %(select)s
+                        FROM %(dataset)s
+                    """ % {
+                        "select": select,
+                        "dataset": self.source
+                    },
+                    outputDataset=OutputDataset(
+                        self.name, self.dataset_type)
+                )()
+            )
+            if response.status_code != 201:
+                raise Exception("could not create dataset.\n{}".format(
+                    response.content))
+            self.fingerprint = fingerprint
+            register_fingerprint(self.name, self._stored_fingerprint())
+            return self.name
+
+    def _stored_fingerprint(self):
+        """Fingerprint of the stored dataset, from the one of the source"""
+        description = json.dumps(
+            [self.fingerprint, self.source, self.X, self.y, self.dataset_type])
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def delete(self):
+        mldb.connection.delete("/v1/datasets/" + self.name)
+        register_fingerprint(self.name, None)
+        self.fingerprint = None
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return "FeatureSet({}, {} features, label={})".format(
+            self.source, len(self.X), self.y)
+
+
+def resolve(dataset, X=None, y=None):
+    """
+    Used by the estimators. When dataset is a FeatureSet, store its features
+    if needed and return the stored dataset name with its feature and label
+    columns. Otherwise return the arguments unchanged.
+    """
+    if not isinstance(dataset, FeatureSet):
+        return dataset, X, y
+    name = dataset.materialize()
+    if X is None:
+        X = dataset.features
+    if y is None:
+        y = dataset.label
+    return name, X, y
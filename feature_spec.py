@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-02 10:41:26
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-02 17:13:58
+# @File Name: feature_spec.py
+
+import re
+import json
+from .connection import conn
+
+mldb = conn
+
+# Below this many features the plain list is used without asking MLDB for
+# the columns of the dataset
+AUTO_THRESHOLD = 1000
+
+METHODS = ["auto", "list", "prefix", "excluding"]
+
+_WILDCARD_SAFE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# A feature given as an expression with an alias, e.g. "log(x) AS log_x"
+_EXPRESSION = re.compile(r"\s+as\s+[\w\"]+\s*$", re.IGNORECASE)
+
+
+def quote_name(name):
+    """Column name as an SQL identifier, whatever characters it has"""
+    return '"%s"' % name.replace('"', '""')
+
+
+def dataset_columns(dataset):
+    """
+    Names of the columns of a dataset, or None if dataset is not the name of
+    an existing dataset (e.g. a sample() expression).
+    """
+    try:
+        response = mldb.connection.get("/v1/datasets/" + dataset + "/columns")
+    except Exception:
+        return None
+    if response.status_code != 200:
+        return None
+    return json.loads(response.content)
+
+
+def _select_item(x):
+    """A feature in a select list: quoted name, or expression as it is"""
+    if _EXPRESSION.search(x):
+        return x
+    return quote_name(x)
+
+
+def _list_sql(X, columns):
+    return ",".join(_select_item(x) for x in X)
+
+
+def _excluding_sql(X, columns):
+    """
+    * EXCLUDING (the columns that are not features). Only valid when every
+    feature is a column of the dataset.
+    """
+    features = set(X)
+    if not features.issubset(columns):
+        return None
+    excluded = [c for c in columns if c not in features]
+    if not excluded:
+        return "*"
+    return "* EXCLUDING ({})".format(
+        ",".join(quote_name(c) for c in excluded))
+
+
+def _prefix_sql(X, columns):
+    """
+    Replace groups of features by prefix* when the prefix selects exactly
+    those features among the columns of the dataset. Each feature uses the
+    shortest such prefix, which covers the largest group.
+    """
+    in_columns = {}
+    for column in columns:
+        if not _WILDCARD_SAFE.match(column):
+            continue
+        for i in range(1, len(column) + 1):
+            prefix = column[:i]
+            in_columns[prefix] = in_columns.get(prefix, 0) + 1
+
+    column_set = set(columns)
+    in_features = {}
+    candidates = [
+        x for x in X if x in column_set and _WILDCARD_SAFE.match(x)]
+    for feature in set(candidates):
+        for i in range(1, len(feature) + 1):
+            prefix = feature[:i]
+            in_features[prefix] = in_features.get(prefix, 0) + 1
+
+    # A column with an unsafe name may still match a prefix
+    unsafe = set()
+    for column in columns:
+        if not _WILDCARD_SAFE.match(column):
+            unsafe.update(column[:i] for i in range(1, len(column) + 1))
+
+    covered = {}
+    for feature in candidates:
+        for i in range(1, len(feature) + 1):
+            prefix = feature[:i]
+            if in_features[prefix] == in_columns.get(prefix) and \
+                    prefix not in unsafe:
+                covered[feature] = prefix
+                break
+
+    parts = []
+    done = set()
+    for x in X:
+        prefix = covered.get(x)
+        if prefix is None or in_features[prefix] == 1:
+            parts.append(_select_item(x))
+        elif prefix not in done:
+            parts.append(prefix + "*")
+            done.add(prefix)
+    return ",".join(parts)
+
+
+_COMPILERS = {
+    "list": _list_sql,
+    "prefix": _prefix_sql,
+    "excluding": _excluding_sql
+}
+
+
+def compile_features(
+        X,
+        dataset=None,
+        columns=None,
+        method="auto",
+        threshold=AUTO_THRESHOLD):
+    """
+    SQL select list for a list of features. With thousands of features the
+    plain comma separated list makes statements of megabytes that MLDB has
+    to parse on every call. Depending on the columns of the dataset, the
+    same selection can often be written much shorter.
+
+    Paramters:
+        X: array of strings
+
+            Features to select
+
+        dataset: string (default None)
+
+            Dataset the features are selected from. Used to get the columns
+            when they are not given.
+
+        columns: array of strings (default None)
+
+            Columns of the dataset
+
+        method: string (default=auto)
+
+            list: "a","b","c"
+            prefix: groups of features replaced by prefix*
+            excluding: * EXCLUDING (columns that are not features)
+            auto: the shortest valid one. The plain list is used without
+                looking at the dataset below threshold features.
+
+    Returns
+        A string to use in a SELECT clause or in a row expression {...}.
+        Feature names are quoted, features given as an expression with an
+        alias are kept as they are.
+    """
+    if method not in METHODS:
+        raise ValueError("method must be one of {}".format(METHODS))
+    X = list(X)
+    if method == "list" or (method == "auto" and len(X) < threshold):
+        return _list_sql(X, columns)
+    if columns is None and dataset is not None:
+        columns = dataset_columns(dataset)
+    if columns is None:
+        if method != "auto":
+            raise ValueError("the columns of the dataset are needed for "
+                             "method {}".format(method))
+        return _list_sql(X, columns)
+
+    if method != "auto":
+        sql = _COMPILERS[method](X, columns)
+        if sql is None:
+            raise ValueError("method {} does not apply to these features"
+                             .format(method))
+        return sql
+
+    compiled = [f(X, columns) for f in _COMPILERS.values()]
+    return min([sql for sql in compiled if sql is not None], key=len)
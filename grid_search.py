@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-05-26 09:31:52
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-05-26 17:48:20
+# @File Name: grid_search.py
+
+import os
+import json
+import math
+import hashlib
+import inspect
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from .classifier import Test
+from .procedures import Transform
+from .tracing import traced_method
+from .connection import conn, bind
+
+mldb = conn
+
+_SCORINGS = ["auc", "mcc", "f"]
+
+
+def _init_args(cls):
+    getargspec = getattr(inspect, "getfullargspec", None)
+    if getargspec is None:
+        getargspec = inspect.getargspec
+    return getargspec(cls.__init__).args[1:]
+
+
+def clone(estimator, params=None, name=None):
+    """
+    New unfitted estimator of the same class with the same constructor
+    arguments, except the ones in params and the name.
+    """
+    kwargs = dict(
+        (arg, getattr(estimator, arg)) for arg in _init_args(type(estimator))
+        if hasattr(estimator, arg))
+    if params is not None:
+        kwargs.update(params)
+    if name is not None:
+        kwargs["name"] = name
+    return type(estimator)(**kwargs)
+
+
+def _params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+class GridSearch(object):
+    """
+    Exhaustive search over the constructor parameters of an estimator. Each
+    trial trains the estimator with classifier.train and scores it on a
+    validation dataset with classifier.Test. Trials run concurrently.
+
+    With successive halving, all candidates are first trained on a small
+    sample of the rows. Only the best 1/eta of them are trained again on a
+    sample eta times larger, until the survivors are trained on all rows.
+
+    Every finished trial is appended to results_path, after a header line
+    with the datasets, features and label of the search. Running the same
+    search again only runs the trials that are not in the file, or that
+    failed. Resuming from a file of another search raises a ValueError.
+    """
+    def __init__(
+            self,
+            estimator,
+            param_grid,
+            scoring="auc",
+            n_jobs=4,
+            min_fraction=None,
+            eta=3,
+            results_path=None,
+            name="GridSearch"):
+        """
+        Paramters:
+            estimator: estimator object
+
+                Estimator to tune, e.g. a DecisionTreeClassifier
+
+            param_grid: dict
+
+                Constructor parameter names as keys and lists of values to
+                try. e.g. {"max_depth": [4, 8, 12], "update_alg": ["prob"]}
+
+            scoring: string (default=auc)
+
+                Metric to maximize. One of auc, mcc or f.
+
+            n_jobs: int (default=4)
+
+                Maximum number of trials running at the same time
+
+            min_fraction: float in the range 0-1 (default None)
+
+                Smallest fraction of the rows used in the first round of
+                successive halving. If None, every candidate is trained on
+                all rows.
+
+            eta: int (default=3)
+
+                At each round, keep the best 1/eta candidates and multiply
+                the fraction of rows by eta
+
+            results_path: string (default None)
+
+                JSON lines file where the trials are saved. If None, the
+                trials are only kept in memory.
+
+            name: string (default=GridSearch)
+
+                Prefix of the names of the functions, procedures and sample
+                datasets created by the search. The names also hold a digest
+                of the datasets, features and label, so searches on other
+                data do not overwrite each other.
+        """
+        if scoring not in _SCORINGS:
+            raise ValueError("scoring must be one of {}".format(_SCORINGS))
+        if min_fraction is not None and not 0 < min_fraction <= 1:
+            raise ValueError("min_fraction must be between 0 and 1")
+        if eta < 2:
+            raise ValueError("eta must be at least 2")
+
+        super(GridSearch, self).__init__()
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.min_fraction = min_fraction
+        self.eta = eta
+        self.results_path = results_path
+        self.name = name
+        self.results_ = []
+        self._digest = None
+        self._lock = threading.Lock()
+
+    def candidates(self):
+        """
+        List of the parameter dicts to try
+        """
+        names = sorted(self.param_grid.keys())
+        return [
+            dict(zip(names, values))
+            for values in itertools.product(
+                *[self.param_grid[n] for n in names])]
+
+    def fractions(self):
+        """
+        Fraction of the rows used at each round of successive halving. The
+        last round uses all rows and each round uses eta times fewer rows
+        than the next one, down to min_fraction.
+        """
+        fractions = [1.]
+        if self.min_fraction is None:
+            return fractions
+        while fractions[0] / self.eta >= self.min_fraction:
+            fractions.insert(0, fractions[0] / self.eta)
+        return fractions
+
+    def _load_results(self, search):
+        """
+        Trials of results_path, which must be the file of the same search.
+        A new file starts with the header of search.
+        """
+        if self.results_path is None:
+            return []
+        lines = []
+        if os.path.exists(self.results_path):
+            with open(self.results_path) as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+        if not lines:
+            with open(self.results_path, "w") as f:
+                f.write(json.dumps({"search": search}, sort_keys=True) + "\n")
+            return []
+        if lines[0].get("search") != search:
+            raise ValueError(
+                "{} holds the trials of another search: {}".format(
+                    self.results_path, json.dumps(lines[0].get("search"))))
+        return lines[1:]
+
+    def _save_result(self, result):
+        with self._lock:
+            self.results_.append(result)
+            if self.results_path is not None:
+                with open(self.results_path, "a") as f:
+                    f.write(json.dumps(result, sort_keys=True) + "\n")
+
+    def _sample(self, dataset, fraction):
+        """
+        Nested samples of the training set: rows of a small sample are also
+        in the larger ones.
+        """
+        if fraction >= 1:
+            return dataset
+        per_mille = int(math.ceil(fraction * 1000))
+        sample_name = "{}_{}_sample{}".format(
+            self.name, self._digest, per_mille)
+        response = mldb.connection.put(
+            "/v1/procedures/" + sample_name,
+            Transform(
+                inputData="""
+                    SELECT * FROM {} WHERE rowHash() % 1000 < {}
+                """.format(dataset, per_mille),
+                outputDataset=sample_name
+            )()
+        )
+        if response.status_code != 201:
+            raise Exception("could not create dataset.\n{}".format(
+                response.content))
+        return sample_name
+
+    def _trial_name(self, params, fraction):
+        digest = hashlib.sha1(
+            _params_key(params).encode("utf-8")).hexdigest()[:12]
+        return "{}_{}_{}_{}".format(
+            self.name, self._digest, digest, int(math.ceil(fraction * 1000)))
+
+    def _run_trial(self, args):
+        params, fraction, sample, validation, X, y = args
+        estimator = clone(
+            self.estimator, params, self._trial_name(params, fraction))
+        result = {"params": params, "fraction": fraction,
+                  "name": estimator.name}
+        try:
+            estimator.fit(sample, X, y)
+            bestMCC, bestF, auc = Test(validation, estimator=estimator)
+            result.update({"auc": auc, "mcc": bestMCC.mcc, "f": bestF.f})
+            result["score"] = result[self.scoring]
+        except Exception as e:
+            result["score"] = None
+            result["error"] = str(e)
+        self._save_result(result)
+        return result
+
+    @traced_method
+    def fit(self, dataset, X, y, validation_dataset):
+        """
+        Parameters:
+            dataset: string
+
+                Dataset name to use for training
+
+            X: array of strings
+
+                An array of all the features to use
+
+            y: string
+
+                Name of the target to use. a.k.a. label
+
+            validation_dataset: string
+
+                Dataset name used to score the trials
+        """
+        search = {
+            "dataset": dataset,
+            "X": list(X),
+            "y": y,
+            "validation_dataset": validation_dataset
+        }
+        self._digest = hashlib.sha1(
+            _params_key(search).encode("utf-8")).hexdigest()[:8]
+        self.results_ = []
+        done = {}
+        for result in self._load_results(search):
+            self.results_.append(result)
+            if result["score"] is None:
+                # Maybe a transient error, tried again
+                continue
+            done[(_params_key(result["params"]), result["fraction"])] = result
+
+        survivors = self.candidates()
+        pool = ThreadPool(self.n_jobs)
+        try:
+            for fraction in self.fractions():
+                todo = [
+                    p for p in survivors
+                    if (_params_key(p), fraction) not in done]
+                if todo:
+                    sample = self._sample(dataset, fraction)
+                    for result in pool.map(bind(self._run_trial), [
+                            (p, fraction, sample, validation_dataset, X, y)
+                            for p in todo]):
+                        done[(_params_key(result["params"]), fraction)] = \
+                            result
+                ranked = sorted(
+                    survivors,
+                    key=lambda p: _rank(done[(_params_key(p), fraction)]),
+                    reverse=True)
+                if fraction < 1:
+                    keep = max(1, int(math.ceil(len(ranked) / float(self.eta))))
+                    survivors = ranked[:keep]
+                else:
+                    survivors = ranked
+        finally:
+            pool.close()
+            pool.join()
+
+        best = done[(_params_key(survivors[0]), 1.)]
+        if best["score"] is None:
+            raise Exception("every trial failed.\n{}".format(best["error"]))
+        self.best_params_ = best["params"]
+        self.best_score_ = best["score"]
+        self.best_estimator_ = clone(
+            self.estimator, best["params"], best["name"])
+        self.best_estimator_.features = X
+        self.best_estimator_.label = y
+        return self
+
+
+def _rank(result):
+    if result["score"] is None:
+        return -np.inf
+    return result["score"]
+
+
+class RandomizedSearch(GridSearch):
+    """
+    Same as GridSearch but tries n_iter random candidates. A parameter is
+    either a list of values to pick from or a distribution object with an
+    rvs method, like the ones of scipy.stats.
+    """
+    def __init__(
+            self,
+            estimator,
+            param_distributions,
+            n_iter=10,
+            random_state=None,
+            scoring="auc",
+            n_jobs=4,
+            min_fraction=None,
+            eta=3,
+            results_path=None,
+            name="RandomizedSearch"):
+        """
+        Paramters:
+            param_distributions: dict
+
+                Constructor parameter names as keys and lists or
+                distributions as values
+
+            n_iter: int (default=10)
+
+                Number of candidates
+
+            random_state: int (default None)
+
+                Seed of the candidate sampling. Set it to resume a search
+                from its results_path.
+
+        See GridSearch for the other parameters.
+        """
+        super(RandomizedSearch, self).__init__(
+            estimator,
+            param_distributions,
+            scoring=scoring,
+            n_jobs=n_jobs,
+            min_fraction=min_fraction,
+            eta=eta,
+            results_path=results_path,
+            name=name)
+        self.param_distributions = param_distributions
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+    def candidates(self):
+        rng = np.random.RandomState(self.random_state)
+        names = sorted(self.param_distributions.keys())
+        candidates = []
+        for _ in range(self.n_iter):
+            params = {}
+            for n in names:
+                dist = self.param_distributions[n]
+                if hasattr(dist, "rvs"):
+                    value = dist.rvs(random_state=rng)
+                else:
+                    value = dist[rng.randint(len(dist))]
+                if isinstance(value, np.generic):
+                    value = value.item()
+                params[n] = value
+            if params not in candidates:
+                candidates.append(params)
+        return candidates
@@ -8,21 +8,33 @@
 # @File Name: linear_model.py
 
 import json
-from utils import generate_random_name
-from procedures import Transform
-from connection import conn
+from .utils import generate_random_name
+from .procedures import Transform, Probabilizer
+from .scoring import RowScoring
+from .arrays import iter_pages, to_arrays
+from .cache import model_cache
+from .feature_set import resolve
+from .feature_spec import compile_features, quote_name
+from .tracing import traced_method
+from .connection import conn
 
 mldb = conn
 
 
-class LogisticRegression(object):
+class LogisticRegression(RowScoring):
     """Logistic Regression (aka logit, MaxEnt) classifier."""
     def __init__(
             self,
             fit_intercept=True,
             ridge_regression=True,
             feature_proportion=1.0,
-            name="LogisticRegression"):
+            name="LogisticRegression",
+            solver="glz",
+            alpha=0.0001,
+            learning_rate=0.1,
+            batch_size=10000,
+            n_epochs=5,
+            prefetch=2):
         """
         Paramters:
             fit_intercept: boolean (default=True)
@@ -37,16 +49,58 @@ class LogisticRegression(object):
             feature_proportion: float in the range 0-1 (default=1.0)
 
                 Use only a (random) portion of available features when training
-                classifier
+                classifier. Only used by the glz solver.
+
+            solver: string (default=glz)
+
+                glz trains in MLDB with classifier.train, which needs the
+                whole training set in memory on the server. sgd and adagrad
+                train locally on mini-batches streamed from MLDB, see
+                partial_fit.
+
+            alpha: float (default=0.0001)
+
+                Strength of the L2 penalty of the local solvers when
+                ridge_regression is True
+
+            learning_rate: float (default=0.1)
+
+                Step size of the local solvers
+
+            batch_size: int (default=10000)
+
+                Number of rows per mini-batch for the local solvers
+
+            n_epochs: int (default=5)
+
+                Number of passes over the data made by fit with a local
+                solver
+
+            prefetch: int (default=2)
+
+                Number of mini-batches read ahead while the current one is
+                processed
         """
         if feature_proportion < 0 or feature_proportion > 1:
             raise ValueError("feature_proportion must be between 0 and 1")
+        if solver not in ["glz", "sgd", "adagrad"]:
+            raise ValueError("solver must be one of glz, sgd or adagrad")
 
         super(LogisticRegression, self).__init__()
         self.fit_intercept = fit_intercept
         self.ridge_regression = ridge_regression
         self.name = name
         self.feature_proportion = feature_proportion
+        self.solver = solver
+        self.alpha = alpha
+        self.learning_rate = learning_rate
+        self.batch_size = batch_size
+        self.n_epochs = n_epochs
+        self.prefetch = prefetch
+        self.coef_ = None
+        self.intercept_ = 0.
+        self._epochs = 0
+        self.probabilizer = None
         self._mode = "boolean"
         self.configuration = {
             "logisticRegression": {
@@ -61,12 +115,14 @@ class LogisticRegression(object):
             }
         }
 
-    def fit(self, dataset, X, y):
+    @traced_method
+    def fit(self, dataset, X=None, y=None):
         """
         Parameters:
-            dataset: string
+            dataset: string or FeatureSet
 
-                Dataset name to use for training
+                Dataset name to use for training. With a FeatureSet, X and y
+                default to its features and label.
 
             X: array of strings
 
@@ -76,6 +132,14 @@ class LogisticRegression(object):
 
                 Name of the target to use. a.k.a. label
         """
+        dataset, X, y = resolve(dataset, X, y)
+        if self.solver != "glz":
+            self.coef_ = None
+            for _ in range(self.n_epochs):
+                self.partial_fit(dataset, X, y, export=False)
+            self.export_function()
+            return
+
         self.features = X
         self.label = y
 
@@ -85,7 +149,7 @@ class LogisticRegression(object):
                 %(label)s as label
             FROM %(campaign)s
         """ % {
-            "features": ",".join(X),
+            "features": compile_features(X, dataset),
             "label": y,
             "campaign": dataset
         }
@@ -97,20 +161,130 @@ class LogisticRegression(object):
                 "algorithm": "logisticRegression",
                 "configuration": self.configuration,
                 "mode": self._mode,
-                "modelFileUrl": "file://donotcare.cls",
                 "functionName": self.name,
                 "runOnCreation": True
             }
         }
 
-        response = mldb.connection.put(
-            "/v1/procedures/" + self.name,
-            self.training_payload)
+        response = model_cache.train(
+            self.name, self.training_payload, dataset)
 
         if response.status_code != 201:
             raise Exception("could not train random forest.\n{}".format(
                 response.content))
 
+    @traced_method
+    def partial_fit(self, dataset, X=None, y=None, export=True):
+        """
+        One pass of the local solver over the dataset. The rows are streamed
+        from MLDB in mini-batches of batch_size rows, in an order shuffled
+        on every pass, and the coefficients are updated after each
+        mini-batch. Calling it again continues from the current
+        coefficients, so it can be used to train on data that arrives over
+        time.
+
+        Parameters:
+            dataset: string or FeatureSet
+
+                Dataset name to use for training. With a FeatureSet, X and y
+                default to its features and label.
+
+            X: array of strings
+
+                An array of all the features to use
+
+            y: string
+
+                Name of the target to use. a.k.a. label
+
+            export: boolean (default=True)
+
+                Create or replace the MLDB function with the new coefficients
+                when done. See export_function.
+        """
+        import numpy as np
+
+        dataset, X, y = resolve(dataset, X, y)
+        if self.solver == "glz":
+            raise ValueError("partial_fit needs the sgd or adagrad solver")
+        if self.coef_ is None or list(X) != list(self.features):
+            self.features = list(X)
+            self.coef_ = np.zeros(len(X))
+            self.intercept_ = 0.
+            self._grad_sq = np.zeros(len(X) + 1)
+            self._epochs = 0
+        self.label = y
+
+        query = """
+            SELECT %(features)s, %(label)s AS __label
+            FROM %(dataset)s
+            ORDER BY hash(rowName() + '%(epoch)d')""" % {
+                "features": compile_features(self.features, dataset),
+                "label": y,
+                "dataset": dataset,
+                "epoch": self._epochs
+            }
+        self._epochs += 1
+        for columns, rows in iter_pages(query, self.batch_size, self.prefetch):
+            arrays = to_arrays(columns, rows, self.features + ["__label"])
+            features = np.column_stack(
+                [arrays[f] for f in self.features]) if self.features \
+                else np.zeros((len(rows), 0))
+            self._update(
+                np.nan_to_num(features), np.nan_to_num(arrays["__label"]) > 0)
+
+        if export:
+            self.export_function()
+
+    def _update(self, features, labels):
+        """
+        One step of the solver on a mini-batch. The intercept is not
+        penalized.
+        """
+        import numpy as np
+
+        n = float(len(labels))
+        margin = features.dot(self.coef_) + self.intercept_
+        error = 1. / (1. + np.exp(-margin)) - labels
+        grad = np.empty(len(self.coef_) + 1)
+        grad[:-1] = features.T.dot(error) / n
+        grad[-1] = error.sum() / n if self.fit_intercept else 0.
+        if self.ridge_regression:
+            grad[:-1] += self.alpha * self.coef_
+        if self.solver == "adagrad":
+            self._grad_sq += grad ** 2
+            step = self.learning_rate * grad / (np.sqrt(self._grad_sq) + 1e-8)
+        else:
+            step = self.learning_rate * grad
+        self.coef_ -= step[:-1]
+        self.intercept_ -= step[-1]
+
+    @traced_method
+    def export_function(self):
+        """
+        Create the function named after the estimator as an SQL expression
+        computing the probability from the local coefficients. Missing
+        features count as 0. predict, Test and the row scoring then work the
+        same as with the glz solver.
+        """
+        terms = [repr(float(self.intercept_))]
+        for feature, coef in zip(self.features, self.coef_):
+            if coef != 0:
+                terms.append("coalesce(features.%s, 0) * %r" % (
+                    quote_name(feature), float(coef)))
+        expression = "1 / (1 + exp(-(%s))) AS score" % " + ".join(terms)
+        # Replaced in place, it is never missing
+        response = mldb.connection.put("/v1/functions/" + self.name, {
+            "type": "sql.expression",
+            "params": {
+                "expression": expression
+            }
+        })
+        if response.status_code != 201:
+            raise Exception("could not create function.\n{}".format(
+                response.content))
+
+    @traced_method
     def predict(self, dataset, predict_set_name=None):
         """
         Predict class for X.
@@ -121,7 +295,7 @@ class LogisticRegression(object):
         trees.
 
         Parameters:
-            dataset: string
+            dataset: string or FeatureSet
 
                 Dataset name to use for testing
 
@@ -130,6 +304,7 @@ class LogisticRegression(object):
                 Name to give to the dataset containing the predictions. If None,
                 a randomly generated name will be given
         """
+        dataset = resolve(dataset)[0]
 
         if predict_set_name is None:
             predict_set_name = generate_random_name()
@@ -140,7 +315,7 @@ class LogisticRegression(object):
                 FROM %(test)s
             """ % {
                 "func": self.name,
-                "features": ",".join(self.features),
+                "features": compile_features(self.features, dataset),
                 "test": dataset
             },
             outputDataset=predict_set_name
@@ -154,5 +329,82 @@ class LogisticRegression(object):
                 response.content))
         return predict_set_name
 
+    @traced_method
+    def calibrate(self, dataset, probabilizer=None):
+        """
+        Fit a Probabilizer on the scores of this estimator and attach it for
+        predict_proba. The scores are computed inside the training procedure
+        of the probabilizer, no score dataset is created.
+
+        Parameters:
+            dataset: string or FeatureSet
+
+                Dataset name to use for the calibration
+
+            probabilizer: Probabilizer (default None)
+
+                Unfitted probabilizer to use. Defaults to a logit one named
+                after the estimator.
+        """
+        dataset = resolve(dataset)[0]
+        if probabilizer is None:
+            probabilizer = Probabilizer(name=self.name + "_proba")
+        probabilizer.fit(
+            dataset,
+            """%(func)s({{%(features)s} as features})[score]""" % {
+                "func": self.name,
+                "features": compile_features(self.features, dataset)
+            },
+            self.label)
+        self.probabilizer = probabilizer
+
+    @traced_method
+    def predict_proba(self, dataset, predict_set_name=None):
+        """
+        Calibrated probabilities with the attached probabilizer (see
+        calibrate). The estimator and the probabilizer are applied in the
+        same transform. The output is the same as Probabilizer.predict on the
+        output of predict.
+
+        Parameters:
+            dataset: string or FeatureSet
+
+                Dataset name to use for testing
+
+            predict_set_name: string (default None)
+
+                Name to give to the dataset containing the probabilities. If
+                None, a randomly generated name will be given
+        """
+        dataset = resolve(dataset)[0]
+        if self.probabilizer is None:
+            raise ValueError(
+                "No probabilizer attached. Call calibrate or set probabilizer")
+        if predict_set_name is None:
+            predict_set_name = generate_random_name()
+        self.predict_payload = Transform(
+            inputData="""
+                SELECT
+                    %(proba)s({
+                        %(func)s({{%(features)s} as features})[score] as score
+                    }) as predict
+                FROM %(test)s
+            """ % {
+                "proba": self.probabilizer.name,
+                "func": self.name,
+                "features": compile_features(self.features, dataset),
+                "test": dataset
+            },
+            outputDataset=predict_set_name
+        )()
+        response = mldb.connection.put(
+            "/v1/procedures/" + self.name + "_predict_proba",
+            self.predict_payload
+        )
+        if response.status_code != 201:
+            raise Exception("could not create dataset.\n{}".format(
+                response.content))
+        return predict_set_name
+
     def __repr__(self):
         return json.dumps(self.configuration, indent=4)
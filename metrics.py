@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-06 09:58:12
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-06 18:02:47
+# @File Name: metrics.py
+
+import numpy as np
+
+
+class Curve(object):
+    """
+    Confusion counts and metrics for every threshold, from the highest to the
+    lowest. A row is predicted positive when its score is greater or equal to
+    the threshold. The first point has an infinite threshold, nothing is
+    predicted positive.
+    """
+    def __init__(self, thresholds, tp, fp, positives, negatives):
+        super(Curve, self).__init__()
+        self.thresholds = np.concatenate([[np.inf], thresholds])
+        self.tp = np.concatenate([[0.], tp]).astype(np.float64)
+        self.fp = np.concatenate([[0.], fp]).astype(np.float64)
+        self.positives = float(positives)
+        self.negatives = float(negatives)
+        self.fn = self.positives - self.tp
+        self.tn = self.negatives - self.fp
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            predicted = self.tp + self.fp
+            self.precision = np.where(
+                predicted > 0, self.tp / predicted, 1.)
+            self.recall = self.tp / self.positives if positives else \
+                np.zeros_like(self.tp)
+            self.tpr = self.recall
+            self.fpr = self.fp / self.negatives if negatives else \
+                np.zeros_like(self.fp)
+            pr = self.precision + self.recall
+            self.f = np.where(
+                pr > 0, 2 * self.precision * self.recall / pr, 0.)
+            denominator = np.sqrt(
+                predicted * (self.tp + self.fn) *
+                (self.tn + self.fp) * (self.tn + self.fn))
+            self.mcc = np.where(
+                denominator > 0,
+                (self.tp * self.tn - self.fp * self.fn) / denominator, 0.)
+            total = self.positives + self.negatives
+            rate = self.positives / total if total else 0.
+            self.gain = self.precision / rate if rate else \
+                np.zeros_like(self.precision)
+            if not total:
+                # No rows, e.g. an empty test set or only NaN scores
+                self.mcc = np.full_like(self.tp, np.nan)
+
+    def __len__(self):
+        return len(self.thresholds)
+
+    def auc(self):
+        """
+        Area under the ROC curve with the trapezoidal rule, NaN without
+        rows
+        """
+        if self.positives + self.negatives == 0:
+            return float("nan")
+        fpr = np.concatenate([self.fpr, [1.]])
+        tpr = np.concatenate([self.tpr, [1.]])
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2.))
+
+    def point(self, i):
+        """
+        The metrics at index i in the layout of the classifier.test
+        procedure, to build a BestMCC or a BestF
+        """
+        return {
+            "pr": {
+                "recall": float(self.recall[i]),
+                "precision": float(self.precision[i]),
+                "f": float(self.f[i])
+            },
+            "mcc": float(self.mcc[i]),
+            "gain": float(self.gain[i]),
+            "threshold": float(self.thresholds[i]),
+            "counts": {
+                "falseNegatives": float(self.fn[i]),
+                "truePositives": float(self.tp[i]),
+                "trueNegatives": float(self.tn[i]),
+                "falsePositives": float(self.fp[i])
+            }
+        }
+
+    def best(self, metric):
+        """Index of the threshold maximizing a metric, mcc or f"""
+        return int(np.argmax(getattr(self, metric)))
+
+
+def _labels(label):
+    return np.nan_to_num(np.asarray(label, dtype=np.float64)) > 0
+
+
+def roc_curve(score, label):
+    """
+    Exact curve over all distinct scores, with one sort and one cumulative
+    sum.
+
+    Paramters:
+        score: array
+
+            Score of each row. Rows with a NaN score are dropped.
+
+        label: array
+
+            Label of each row, positive when greater than 0
+    """
+    score = np.asarray(score, dtype=np.float64)
+    label = _labels(label)
+    keep = ~np.isnan(score)
+    score, label = score[keep], label[keep]
+
+    order = np.argsort(-score, kind="mergesort")
+    score = score[order]
+    label = label[order]
+    tp = np.cumsum(label)
+    fp = np.arange(1, len(label) + 1) - tp
+    # Only the last row of a run of equal scores is a threshold
+    last = np.concatenate([np.nonzero(np.diff(score))[0], [len(score) - 1]]) \
+        if len(score) else np.array([], dtype=np.int64)
+    positives = tp[-1] if len(tp) else 0
+    return Curve(
+        score[last], tp[last], fp[last], positives, len(score) - positives)
+
+
+class BinnedCounts(object):
+    """
+    Histogram of the positive and negative scores in fixed bins. Memory does
+    not depend on the number of rows and the counts can be accumulated page
+    by page.
+
+    Thresholds are limited to the bin edges, so the best MCC and F are the
+    best over the edges. The AUC counts the positive and negative rows of the
+    same bin as half ordered. The exact AUC is within auc_error of the binned
+    one:
+
+        auc_error = sum(positives[b] * negatives[b]) / (2 * P * N)
+
+    which is at most 1 / (2 * bins) when the scores are spread evenly.
+    """
+    def __init__(self, bins=10000, score_range=(0., 1.)):
+        """
+        Paramters:
+            bins: int (default=10000)
+
+                Number of bins
+
+            score_range: (float, float) (default=(0, 1))
+
+                Range covered by the bins. Scores outside of it go in the
+                first or the last bin.
+        """
+        super(BinnedCounts, self).__init__()
+        self.bins = bins
+        self.score_range = score_range
+        self.edges = np.linspace(score_range[0], score_range[1], bins + 1)
+        self.positives = np.zeros(bins, dtype=np.int64)
+        self.negatives = np.zeros(bins, dtype=np.int64)
+
+    def update(self, score, label):
+        score = np.asarray(score, dtype=np.float64)
+        label = _labels(label)
+        keep = ~np.isnan(score)
+        score, label = score[keep], label[keep]
+        index = np.searchsorted(self.edges, score, side="right") - 1
+        index = np.clip(index, 0, self.bins - 1)
+        self.positives += np.bincount(index[label], minlength=self.bins)
+        self.negatives += np.bincount(index[~label], minlength=self.bins)
+        return self
+
+    def add(self, index, positives, negatives):
+        """
+        Add counts already grouped by bin index, e.g. by a GROUP BY in MLDB.
+        Indexes out of range go in the first or the last bin.
+        """
+        index = np.clip(
+            np.asarray(index, dtype=np.int64), 0, self.bins - 1)
+        np.add.at(self.positives, index,
+                  np.asarray(positives, dtype=np.int64))
+        np.add.at(self.negatives, index,
+                  np.asarray(negatives, dtype=np.int64))
+        return self
+
+    def curve(self):
+        if self.positives.sum() + self.negatives.sum() == 0:
+            return Curve([], [], [], 0, 0)
+        # From the highest bin to the lowest
+        tp = np.cumsum(self.positives[::-1])
+        fp = np.cumsum(self.negatives[::-1])
+        return Curve(
+            self.edges[:-1][::-1], tp, fp,
+            self.positives.sum(), self.negatives.sum())
+
+    def auc_error(self):
+        total = float(self.positives.sum()) * self.negatives.sum()
+        if total == 0:
+            return 0.
+        return float(np.sum(
+            self.positives.astype(np.float64) * self.negatives)) / (2 * total)
+
+
+BOOTSTRAP_METRICS = ["auc", "mcc", "f"]
+
+
+def _sort_for_curve(score, label):
+    """
+    Labels sorted by decreasing score and the index of the last row of each
+    run of equal scores. The order does not depend on the weights, so it is
+    shared by all the bootstrap replicates.
+    """
+    score = np.asarray(score, dtype=np.float64)
+    label = _labels(label)
+    keep = ~np.isnan(score)
+    score, label = score[keep], label[keep]
+    order = np.argsort(-score, kind="mergesort")
+    score = score[order]
+    if len(score) == 0:
+        return label, np.zeros(0, dtype=np.int64)
+    last = np.concatenate([np.nonzero(np.diff(score))[0], [len(score) - 1]])
+    return label[order], last
+
+
+def _weighted_metrics(label, last, weights, metrics):
+    """
+    Metrics of several weighted copies of the data at once. weights has one
+    row per replicate and one column per row of the data.
+    """
+    tp = np.cumsum(weights * label, axis=1)[:, last]
+    fp = np.cumsum(weights * ~label, axis=1)[:, last]
+    positives = tp[:, -1:]
+    negatives = fp[:, -1:]
+    fn = positives - tp
+    tn = negatives - fp
+    results = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if "auc" in metrics:
+            zeros = np.zeros((len(tp), 1))
+            tpr = np.hstack([zeros, tp / positives])
+            fpr = np.hstack([zeros, fp / negatives])
+            results["auc"] = np.sum(
+                np.diff(fpr, axis=1) * (tpr[:, 1:] + tpr[:, :-1]) / 2., axis=1)
+        if "mcc" in metrics:
+            denominator = np.sqrt(
+                (tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+            mcc = np.where(
+                denominator > 0, (tp * tn - fp * fn) / denominator, 0.)
+            results["mcc"] = mcc.max(axis=1)
+        if "f" in metrics:
+            f = np.where(
+                positives + tp + fp > 0, 2 * tp / (positives + tp + fp), 0.)
+            results["f"] = f.max(axis=1)
+    return results
+
+
+def _bootstrap_chunk(args):
+    label, last, metrics, seed, n_boot = args
+    rng = np.random.RandomState(seed)
+    weights = rng.poisson(1., size=(n_boot, len(label))).astype(np.float64)
+    return _weighted_metrics(label, last, weights, metrics)
+
+
+def bootstrap(
+        score,
+        label,
+        n_boot=1000,
+        metrics=BOOTSTRAP_METRICS,
+        ci=0.95,
+        n_jobs=1,
+        random_state=None,
+        max_cells=10000000):
+    """
+    Bootstrap confidence intervals of the AUC, best MCC and best F.
+
+    Each replicate gives every row a Poisson(1) weight instead of drawing
+    rows with replacement, which is the same in distribution for large
+    datasets. The rows are sorted once and every replicate is a weighted
+    cumulative sum over that order. Replicates are computed in chunks of at
+    most max_cells weights, so memory stays O(n).
+
+    Paramters:
+        score, label: arrays
+
+        n_boot: int (default=1000)
+
+            Number of replicates
+
+        metrics: list of strings (default=["auc", "mcc", "f"])
+
+        ci: float (default=0.95)
+
+            Coverage of the percentile interval
+
+        n_jobs: int (default=1)
+
+            Number of processes computing the chunks
+
+        random_state: int (default None)
+
+        max_cells: int (default=10000000)
+
+            Number of weights in memory for one chunk, per process
+
+    Returns
+        A dict with, for each metric, the estimate on the data, the std of
+        the replicates, the low and high bounds of the interval and the
+        replicates themselves
+    """
+    for metric in metrics:
+        if metric not in BOOTSTRAP_METRICS:
+            raise ValueError("metrics must be in {}".format(BOOTSTRAP_METRICS))
+    label, last = _sort_for_curve(score, label)
+    if len(label) == 0:
+        # No rows with a score, like an empty Curve
+        return dict((metric, {
+            "estimate": np.nan,
+            "std": np.nan,
+            "low": np.nan,
+            "high": np.nan,
+            "replicates": np.full(n_boot, np.nan)
+        }) for metric in metrics)
+    estimates = _weighted_metrics(
+        label, last, np.ones((1, len(label))), metrics)
+
+    per_chunk = max(1, int(max_cells // max(1, len(label))))
+    sizes = [per_chunk] * (n_boot // per_chunk)
+    if n_boot % per_chunk:
+        sizes.append(n_boot % per_chunk)
+    seeds = np.random.RandomState(random_state).randint(
+        np.iinfo(np.int32).max, size=len(sizes))
+    chunks = [(label, last, metrics, seed, size)
+              for seed, size in zip(seeds, sizes)]
+    if n_jobs > 1 and len(chunks) > 1:
+        # multiprocessing is slow to import
+        from multiprocessing import Pool
+
+        pool = Pool(n_jobs)
+        try:
+            parts = pool.map(_bootstrap_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parts = [_bootstrap_chunk(chunk) for chunk in chunks]
+
+    results = {}
+    for metric in metrics:
+        replicates = np.concatenate([part[metric] for part in parts])
+        low, high = np.nanpercentile(
+            replicates, [50 * (1 - ci), 50 * (1 + ci)])
+        results[metric] = {
+            "estimate": float(estimates[metric][0]),
+            "std": float(np.nanstd(replicates)),
+            "low": float(low),
+            "high": float(high),
+            "replicates": replicates
+        }
+    return results
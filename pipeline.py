@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-08 09:21:07
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-08 17:55:40
+# @File Name: pipeline.py
+
+import os
+import json
+import time
+import hashlib
+from multiprocessing.pool import ThreadPool
+from .exception import ArgumentError, ProcedureError
+from .cache import dataset_fingerprint
+from .tracing import tracer, traced_method
+from .runstats import run_stats
+from .connection import conn, bind
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+mldb = conn
+
+RAN = "ran"
+SKIPPED = "skipped"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def _exists(kind, name):
+    try:
+        response = mldb.connection.get("/v1/%s/%s" % (kind, name))
+    except Exception:
+        return None
+    if response.status_code != 200:
+        return None
+    return response
+
+
+def _fingerprint(name):
+    """
+    Fingerprint of a dataset or a function, None if neither exists. A
+    function is fingerprinted by its configuration, which holds the model
+    file path.
+    """
+    if _exists("datasets", name) is not None:
+        return dataset_fingerprint(name)
+    response = _exists("functions", name)
+    if response is not None:
+        return hashlib.sha1(response.content).hexdigest()
+    return None
+
+
+class Node(object):
+    """
+    One step of a Pipeline. step is either a payload builder like
+    Transform or ImportText, run as the procedure named after the node, or a
+    callable taking no argument, e.g. a lambda calling fit on an estimator.
+    """
+    def __init__(self, name, step, inputs=None, outputs=None, after=None,
+                 key=None, on_skip=None):
+        super(Node, self).__init__()
+        self.name = name
+        self.step = step
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.after = list(after or [])
+        self.key = key
+        self.on_skip = on_skip
+        self.result = None
+
+    def signature(self, fingerprints):
+        """
+        Identifies what the node would compute: its payload or key and the
+        content of its inputs. The outputs are up to date when the signature
+        is the one recorded when the node last ran.
+        """
+        key = self.key
+        if key is None and _is_builder(self.step):
+            key = self.step()
+        if key is None:
+            # A callable without a key can not be compared between runs
+            return None
+        return hashlib.sha1(json.dumps(
+            [key, fingerprints], sort_keys=True, default=str)
+            .encode("utf-8")).hexdigest()
+
+    def run(self):
+        if _is_builder(self.step):
+            response = mldb.connection.put(
+                "/v1/procedures/" + self.name, self.step())
+            if response.status_code != 201:
+                raise ProcedureError("could not run {}.\n{}".format(
+                    self.name, response.content))
+            return response
+        return self.step()
+
+    def __repr__(self):
+        return "Node({}, inputs={}, outputs={})".format(
+            self.name, self.inputs, self.outputs)
+
+
+def _is_builder(step):
+    """Payload builders are the classes of utils and procedures"""
+    return hasattr(step, "__call__") and hasattr(step, "runOnCreation")
+
+
+class Pipeline(object):
+    """
+    Procedures and estimator steps with declared inputs and outputs, run as
+    a DAG. A node depends on the nodes producing its inputs and on the nodes
+    listed in after. Nodes whose dependencies are done run concurrently, up to
+    max_running at a time, so independent branches such as estimators trained
+    on the same split overlap on the server.
+
+    A node is skipped when all its outputs exist and nothing it depends on
+    changed since it last ran: same payload (or key), same fingerprint of
+    every input and no upstream node ran again. The signatures are kept in
+    state_path between sessions. The report of the last run is in report_
+    and its duration in wall_time_.
+
+    p = Pipeline(max_running=3, state_path="pipeline.json")
+    p.add("import", ImportText(url, outputDataset="raw"), outputs=["raw"])
+    p.add("split", lambda: train_test_split("raw", train_name="train",
+                                            test_name="test"),
+          inputs=["raw"], outputs=["train", "test"], key="split 0.25")
+    p.add_fit("fit_dt", dt, "train", X, y)
+    p.add_test("test_dt", dt, "test")
+    report = p.run()
+    """
+    def __init__(self, max_running=4, state_path=None):
+        """
+        Paramters:
+            max_running: int (default=4)
+
+                Number of nodes running at the same time
+
+            state_path: string (default None)
+
+                JSON file keeping the signature of the nodes that ran. Without
+                it, nodes are only skipped within the same Pipeline object.
+        """
+        super(Pipeline, self).__init__()
+        self.max_running = max_running
+        self.state_path = state_path
+        self.nodes = {}
+        self._order = []
+        self.state = self._load_state()
+        self.report_ = None
+        self.wall_time_ = None
+
+    def _load_state(self):
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _save_state(self):
+        if self.state_path is None:
+            return
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.state_path)
+
+    def add(self, name, step, inputs=None, outputs=None, after=None,
+            key=None, on_skip=None):
+        """
+        Paramters:
+            name: string
+
+                Node name, also the procedure name for a payload builder
+
+            step: payload builder or callable
+
+            inputs: array of strings (default None)
+
+                Datasets or functions read by the node
+
+            outputs: array of strings (default None)
+
+                Datasets or functions created by the node
+
+            after: array of strings (default None)
+
+                Nodes to wait for besides the producers of the inputs
+
+            key: anything JSON serializable (default None)
+
+                Configuration of a callable step. A callable without a key
+                always runs since there is no way to tell if it changed.
+
+            on_skip: callable (default None)
+
+                Called instead of step when the outputs are up to date
+        """
+        if name in self.nodes:
+            raise ArgumentError("node {} already exists".format(name))
+        node = Node(name, step, inputs, outputs, after, key, on_skip)
+        self.nodes[name] = node
+        self._order.append(name)
+        return node
+
+    def add_fit(self, name, estimator, dataset, X=None, y=None, after=None):
+        """
+        Fit an estimator, the output is its function. When the function is
+        up to date the estimator only gets its features and label back, as if
+        fit had run.
+        """
+        def restore():
+            estimator.features = X if X is not None else getattr(
+                dataset, "features", None)
+            estimator.label = y if y is not None else getattr(
+                dataset, "label", None)
+
+        return self.add(
+            name, lambda: estimator.fit(dataset, X, y),
+            inputs=[str(dataset)], outputs=[estimator.name], after=after,
+            key=[type(estimator).__name__, estimator.configuration,
+                 X if X is None else list(X), y],
+            on_skip=restore)
+
+    def add_predict(self, name, estimator, dataset, output, after=None):
+        """Predict with a fitted estimator into the dataset output"""
+        return self.add(
+            name, lambda: estimator.predict(dataset, output),
+            inputs=[str(dataset), estimator.name], outputs=[output],
+            after=after,
+            key=["predict", output])
+
+    def add_test(self, name, estimator, dataset, after=None, **kwargs):
+        """
+        classifier.Test of a fitted estimator. The TestResult is in
+        pipeline.nodes[name].result. It has no output, so it always runs.
+        """
+        from .classifier import Test
+
+        return self.add(
+            name, lambda: Test(dataset, estimator=estimator, **kwargs),
+            inputs=[str(dataset), estimator.name], after=after)
+
+    def _dependencies(self):
+        producers = {}
+        for name in self._order:
+            for output in self.nodes[name].outputs:
+                if output in producers:
+                    raise ArgumentError("{} is an output of {} and {}".format(
+                        output, producers[output], name))
+                producers[output] = name
+        dependencies = {}
+        for name in self._order:
+            node = self.nodes[name]
+            for other in node.after:
+                if other not in self.nodes:
+                    raise ArgumentError("{} runs after unknown node {}".format(
+                        name, other))
+            dependencies[name] = set(
+                [producers[i] for i in node.inputs if i in producers] +
+                node.after) - set([name])
+        return dependencies
+
+    def _check_acyclic(self, dependencies):
+        visiting, done = set(), set()
+
+        def visit(name, path):
+            if name in done:
+                return
+            if name in visiting:
+                raise ArgumentError("cycle in pipeline: {}".format(
+                    " -> ".join(path + [name])))
+            visiting.add(name)
+            for dependency in dependencies[name]:
+                visit(dependency, path + [name])
+            visiting.remove(name)
+            done.add(name)
+
+        for name in self._order:
+            visit(name, [])
+
+    def _estimates(self, names):
+        """Predicted seconds of the payload builder nodes, from run_stats"""
+        estimates = {}
+        for name in names:
+            step = self.nodes[name].step
+            estimates[name] = None
+            if _is_builder(step):
+                try:
+                    estimates[name] = run_stats.estimate(step())
+                except Exception:
+                    pass
+        return estimates
+
+    def _execute(self, name, upstream_ran):
+        """Run in the pool. Returns the report row of the node."""
+        with tracer.span("node " + name, "pipeline"):
+            return self._execute_node(name, upstream_ran)
+
+    def _execute_node(self, name, upstream_ran):
+        node = self.nodes[name]
+        start = time.time()
+        row = {"node": name, "start": start}
+        try:
+            fingerprints = [_fingerprint(i) for i in node.inputs]
+            signature = node.signature(fingerprints)
+            fresh = (
+                not upstream_ran and signature is not None and
+                len(node.outputs) > 0 and
+                self.state.get(name) == signature and
+                all(_fingerprint(o) is not None for o in node.outputs))
+            if fresh:
+                if node.on_skip is not None:
+                    node.on_skip()
+                row["status"] = SKIPPED
+            else:
+                node.result = node.run()
+                row["status"] = RAN
+                if signature is not None:
+                    row["signature"] = signature
+        except Exception as e:
+            row["status"] = FAILED
+            row["error"] = "{}: {}".format(type(e).__name__, e)
+        row["seconds"] = time.time() - start
+        return row
+
+    @traced_method
+    def run(self, targets=None, raise_on_error=True):
+        """
+        Run the pipeline, or only what is needed for the nodes in targets.
+
+        Returns
+            A DataFrame indexed by node, in completion order, with the
+            status (ran, skipped, failed or cancelled), the start time in
+            seconds from the start of the run, the duration of each node and
+            its duration predicted by runstats, for payload builders
+        """
+        import pandas as pd
+
+        dependencies = self._dependencies()
+        self._check_acyclic(dependencies)
+        wanted = set(self._order)
+        if targets is not None:
+            wanted = set()
+            stack = list(targets)
+            while stack:
+                name = stack.pop()
+                if name not in self.nodes:
+                    raise ArgumentError("unknown node {}".format(name))
+                if name not in wanted:
+                    wanted.add(name)
+                    stack.extend(dependencies[name])
+
+        waiting = [n for n in self._order if n in wanted]
+        # Among the nodes ready at the same time the longest ones start
+        # first, the others keep their order
+        estimates = self._estimates(waiting)
+        waiting.sort(key=lambda n: -(estimates[n] or 0.))
+        statuses = {}
+        rows = []
+        finished = Queue()
+        running = 0
+
+        def execute(name, upstream_ran):
+            # Failures the node does not report itself end the run instead
+            # of leaving it waiting. error_callback is not in Python 2.
+            try:
+                finished.put(self._execute(name, upstream_ran))
+            except BaseException as e:
+                finished.put(e)
+
+        origin = time.time()
+        pool = ThreadPool(self.max_running)
+        try:
+            while waiting or running:
+                for name in list(waiting):
+                    deps = dependencies[name]
+                    if any(statuses.get(d) in (FAILED, CANCELLED)
+                           for d in deps):
+                        waiting.remove(name)
+                        statuses[name] = CANCELLED
+                        rows.append({
+                            "node": name, "status": CANCELLED,
+                            "start": None, "seconds": 0.,
+                            "estimate": estimates[name]})
+                        continue
+                    if running >= self.max_running:
+                        continue
+                    if all(d in statuses for d in deps):
+                        waiting.remove(name)
+                        running += 1
+                        upstream_ran = any(
+                            statuses[d] == RAN for d in deps)
+                        pool.apply_async(
+                            bind(execute), (name, upstream_ran))
+                if not running:
+                    continue
+                row = finished.get()
+                running -= 1
+                if isinstance(row, BaseException):
+                    raise row
+                statuses[row["node"]] = row["status"]
+                signature = row.pop("signature", None)
+                if signature is not None:
+                    self.state[row["node"]] = signature
+                    self._save_state()
+                row["start"] -= origin
+                row["estimate"] = estimates[row["node"]]
+                rows.append(row)
+        finally:
+            pool.close()
+            pool.join()
+
+        report = pd.DataFrame(
+            rows, columns=["node", "status", "start", "seconds", "estimate",
+                           "error"])
+        self.report_ = report.set_index("node")
+        self.wall_time_ = time.time() - origin
+        failed = [r for r in rows if r["status"] == FAILED]
+        if failed and raise_on_error:
+            raise ProcedureError("nodes failed: {}\n{}".format(
+                ", ".join(r["node"] for r in failed), failed[0]["error"]))
+        return self.report_
@@ -7,12 +7,18 @@
 # @Last Modified time: 2016-05-17 09:29:00
 # @File Name: procedures.py
 
-from utils import generate_random_name, _create_output_dataset
+from .utils import generate_random_name, _create_output_dataset
 import json
-from connection import conn
+from .tracing import traced_method
+from .connection import conn
 
 mldb = conn
 
+# Link functions of the Probabilizer. isotonic is only fitted locally, see
+# calibration, which needs NumPy.
+GLM_LINKS = ("logit", "probit", "comp_log_log", "linear", "log")
+LINKS = GLM_LINKS + ("isotonic",)
+
 
 class Transform(object):
     def __init__(self, inputData="", outputDataset="", runOnCreation=True):
@@ -60,7 +66,8 @@ class Probabilizer(object):
     def __init__(
             self,
             link="logit",
-            name="Probabilizer"):
+            name="Probabilizer",
+            local=False):
         """
         Paramters:
             link: string (default=logit)
@@ -71,18 +78,31 @@ class Probabilizer(object):
                     comp_log_log: Also good for probabilistic
                     linear: Makes it solve linear least squares (identity)
                     log: Good for transforming the output of boosting
+                    isotonic: Non-decreasing step function, always local
 
             name: string (default=Probabilizer)
 
                 Name of the function
+
+            local: bool (default=False)
+
+                Fit on the score and label arrays in this process instead of
+                with the probabilizer.train procedure, then register the fit
+                as an SQL expression function of the same name
         """
-        if link not in ["logit", "probit", "comp_log_log", "linear", "log"]:
+        if link not in LINKS:
             raise ValueError("link function value not allowed. Check doc.")
 
         super(Probabilizer, self).__init__()
         self.link = link.upper()
         self.name = name
+        self.local = local or link == "isotonic"
+        self.coef_ = None
+        self.intercept_ = None
+        self.thresholds_ = None
+        self.values_ = None
 
+    @traced_method
     def fit(self, dataset, X, y):
         """
         Parameters:
@@ -112,6 +132,10 @@ class Probabilizer(object):
             "campaign": dataset
         }
 
+        if self.local:
+            self._fit_local(trainingData)
+            return
+
         self.training_payload = {
             "type": "probabilizer.train",
             "params": {
@@ -123,6 +147,8 @@ class Probabilizer(object):
             }
         }
 
+        # Not through the model cache: the training data calls the scoring
+        # function by name, whose model the cache key can not see
         response = mldb.connection.put(
             "/v1/procedures/" + self.name,
             self.training_payload)
@@ -131,6 +157,36 @@ class Probabilizer(object):
             raise Exception("could not train probabilizer.\n{}".format(
                 response.content))
 
+    def _fit_local(self, trainingData):
+        from .arrays import query_arrays
+        from .calibration import fit_glm, fit_isotonic, inverse_link_sql, \
+            isotonic_sql
+
+        arrays = query_arrays(trainingData, ["score", "label"])
+        link = self.link.lower()
+        if link == "isotonic":
+            self.thresholds_, self.values_ = fit_isotonic(
+                arrays["score"], arrays["label"])
+            expression = isotonic_sql(self.thresholds_, self.values_)
+        else:
+            self.coef_, self.intercept_ = fit_glm(
+                arrays["score"], arrays["label"], link)
+            expression = inverse_link_sql(
+                link, "%r * score + %r" % (self.coef_, self.intercept_))
+
+        # Replaced in place, it is never missing. Same output name as the
+        # probabilizer function.
+        response = mldb.connection.put("/v1/functions/" + self.name, {
+            "type": "sql.expression",
+            "params": {
+                "expression": expression + " AS prob"
+            }
+        })
+        if response.status_code != 201:
+            raise Exception("could not create function.\n{}".format(
+                response.content))
+
+    @traced_method
     def predict(self, dataset, predict_set_name=None):
         """
         Parameters:
@@ -8,9 +8,9 @@
 # @File Name: random.py
 
 
-from utils import generate_random_name, _create_output_dataset
-from procedures import Transform
-from connection import conn
+from .utils import generate_random_name, _create_output_dataset
+from .procedures import Transform
+from .connection import conn
 
 mldb = conn
 
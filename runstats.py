@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-13 09:12:40
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-13 17:48:02
+# @File Name: runstats.py
+
+"""
+Statistics of the procedure runs done through the connection: procedure
+type, duration, rows produced and size of the input. From that history a
+linear cost model per procedure type predicts the duration of a payload
+before it is submitted.
+
+    from skmldb.runstats import run_stats, set_run_stats, estimate_cost
+
+    # Off by default, keep the history on disk
+    set_run_stats(RunStats("runs.jsonl", enabled=True))
+    ...
+    estimate_cost(Transform(inputData="SELECT * FROM big",
+                            outputDataset="copy")())
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from collections import deque, OrderedDict
+from .tracing import _find_run, _parse_time
+
+# Parameters holding the SQL the procedure reads, in order of preference
+_INPUT_PARAMS = ["inputData", "trainingData", "testingData"]
+
+_FROM = re.compile(r'\bFROM\s+("[^"]+"|[A-Za-z_][\w.]*)', re.IGNORECASE)
+
+
+def _input_dataset(payload):
+    """Name of the dataset the payload reads, None if it can not be told"""
+    params = payload.get("params", {})
+    for key in _INPUT_PARAMS:
+        data = params.get(key)
+        if isinstance(data, dict):
+            data = data.get("from")
+        if isinstance(data, dict):
+            data = data.get("id")
+        if not data:
+            continue
+        match = _FROM.search(data)
+        if match is not None:
+            return match.group(1).strip('"')
+        if re.match(r"^[A-Za-z_][\w.]*$", data):
+            return data
+    return None
+
+
+def _output_dataset(payload):
+    output = payload.get("params", {}).get("outputDataset")
+    if isinstance(output, dict):
+        output = output.get("id")
+    return output or None
+
+
+def _row_count(connection, dataset):
+    """Row count in the status of a dataset, None when not available"""
+    try:
+        response = connection.get("/v1/datasets/" + dataset)
+        if response.status_code != 200:
+            return None
+        return json.loads(response.content)["status"]["rowCount"]
+    except Exception:
+        return None
+
+
+def input_size(payload, connection):
+    """
+    (rows, bytes) read by a procedure payload. rows is the row count of the
+    dataset in its input query, bytes the size of the file it imports when
+    the file is local. Either is None when unknown.
+    """
+    rows = None
+    size = None
+    dataset = _input_dataset(payload)
+    if dataset is not None:
+        rows = _row_count(connection, dataset)
+    url = payload.get("params", {}).get("dataFileUrl") or ""
+    if url.startswith("file://") and os.path.exists(url[len("file://"):]):
+        size = os.path.getsize(url[len("file://"):])
+    return rows, size
+
+
+class RunStats(object):
+    """
+    History of the procedure runs and the cost model fitted on it. The
+    connection module passes every procedure response to record while
+    enabled is True, which it is not by default. Only the last max_records
+    runs are kept in memory.
+
+    The cost model of a procedure type is the least squares line of the
+    duration against the input size, the input rows or else the imported
+    bytes, over the last window runs of that type. With a single input
+    size it is the mean duration.
+    """
+    def __init__(self, path=None, enabled=False, measure=True, window=200,
+                 max_records=10000):
+        """
+        Paramters:
+            path: string (default None)
+
+                JSON lines file the runs are appended to and read from. The
+                history only lives in memory without it.
+
+            enabled: bool (default False)
+
+                Record the runs
+
+            measure: bool (default True)
+
+                Ask MLDB for the row count of the input and output datasets
+                of each run, one GET per dataset after the run. Without it
+                only the sizes found in the run status are recorded.
+
+            window: int (default=200)
+
+                Number of most recent runs of a type the model is fitted on
+
+            max_records: int (default=10000)
+
+                Number of most recent runs kept in memory, the file keeps
+                them all
+        """
+        super(RunStats, self).__init__()
+        self.path = path
+        self.enabled = enabled
+        self.measure = measure
+        self.window = window
+        self.max_records = max_records
+        self._records = None
+        self._model = None
+        self._types = OrderedDict()
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def records(self):
+        with self._lock:
+            if self._records is None:
+                self._records = self._load()
+            return list(self._records)
+
+    def _load(self):
+        records = deque(maxlen=self.max_records)
+        if self.path is None or not os.path.exists(self.path):
+            return records
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Line cut short by a crash while appending
+                    pass
+        return records
+
+    def _append(self, record):
+        with self._lock:
+            if self._records is None:
+                self._records = self._load()
+            self._records.append(record)
+            self._model = None
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def record(self, procedure, payload, response, connection):
+        """
+        Record the run in a procedure response, if it holds a finished one.
+        payload is None for the runs and run status of an existing
+        procedure, its type is then the one of the last payload seen for
+        it. Never raises.
+
+        Returns
+            The record, None if nothing was recorded
+        """
+        try:
+            return self._record(procedure, payload, response, connection)
+        except Exception:
+            return None
+
+    def _record(self, procedure, payload, response, connection):
+        with self._lock:
+            if payload is not None:
+                self._types.pop(procedure, None)
+                _bounded_set(self._types, procedure, payload,
+                             self.max_records)
+            else:
+                payload = self._types.get(procedure)
+        if response.status_code >= 400:
+            return None
+        run = _find_run(json.loads(response.content))
+        if run is None or run.get("state", "finished") not in (
+                "finished", "error"):
+            return None
+        started = _parse_time(run.get("runStarted"))
+        finished = _parse_time(run.get("runFinished"))
+        if started is None or finished is None:
+            return None
+        key = (procedure, run.get("id"), run.get("runStarted"))
+        with self._lock:
+            if key in self._seen:
+                # Polled again after it finished
+                return None
+            _bounded_set(self._seen, key, True, self.max_records)
+
+        status = run.get("status")
+        record = {
+            "time": time.time(),
+            "procedure": procedure,
+            "type": payload.get("type") if payload else None,
+            "state": run.get("state", "finished"),
+            "seconds": (finished - started).total_seconds(),
+            "rows": status.get("rowCount") if isinstance(status, dict)
+            else None,
+            "input_rows": None,
+            "input_bytes": None
+        }
+        if payload is not None and self.measure:
+            record["input_rows"], record["input_bytes"] = input_size(
+                payload, connection)
+            output = _output_dataset(payload)
+            if record["rows"] is None and output is not None:
+                record["rows"] = _row_count(connection, output)
+        self._append(record)
+        return record
+
+    def clear(self):
+        with self._lock:
+            self._records = deque(maxlen=self.max_records)
+            self._model = None
+            self._seen = OrderedDict()
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def summary(self):
+        """
+        DataFrame with the number of runs, the total and mean duration and
+        the rows per second of each procedure type
+        """
+        import pandas as pd
+
+        frame = pd.DataFrame(self.records, columns=[
+            "time", "procedure", "type", "state", "seconds", "rows",
+            "input_rows", "input_bytes"])
+        frame = frame[frame.state == "finished"]
+        grouped = frame.groupby("type")
+        summary = pd.DataFrame({
+            "runs": grouped.size(),
+            "seconds": grouped.seconds.sum(),
+            "mean_seconds": grouped.seconds.mean(),
+            "rows": grouped.rows.sum()
+        })
+        # Types without any row count sum to 0
+        summary.loc[summary.rows == 0, "rows"] = float("nan")
+        summary["rows_per_second"] = summary.rows / summary.seconds
+        return summary
+
+    def cost_model(self):
+        """
+        Returns
+            A dict from procedure type to the intercept in seconds, the
+            slope in seconds per input row (or byte), the unit of the slope,
+            the number of runs and the standard deviation of the residuals
+        """
+        with self._lock:
+            model = self._model
+        if model is not None:
+            return model
+
+        by_type = {}
+        for record in self.records:
+            if record.get("state") == "finished" and record.get("type"):
+                by_type.setdefault(record["type"], []).append(record)
+
+        model = {}
+        for kind, records in by_type.items():
+            records = records[-self.window:]
+            unit = "rows"
+            if all(r.get("input_rows") is None for r in records):
+                unit = "bytes"
+            points = [(r.get("input_" + unit), r["seconds"]) for r in records]
+            sized = [(x, y) for x, y in points if x is not None]
+            model[kind] = _fit_line(sized, [y for x, y in points])
+            model[kind]["unit"] = unit
+        with self._lock:
+            self._model = model
+        return model
+
+    def estimate(self, payload, size=None, connection=None):
+        """
+        Predicted duration in seconds of a payload, None when no run of its
+        type was recorded. size is the input rows, or bytes for an import,
+        and is measured on the connection when not given.
+        """
+        model = self.cost_model().get(payload.get("type"))
+        if model is None:
+            return None
+        if size is None and model["slope"]:
+            if connection is None:
+                from .connection import conn
+                connection = conn.connection
+            rows, size = input_size(payload, connection)
+            if model["unit"] == "rows":
+                size = rows
+        if size is None:
+            size = model["mean_size"]
+        return max(0., model["intercept"] + model["slope"] * size)
+
+
+def _bounded_set(entries, key, value, size):
+    """entries[key] = value, dropping the oldest entries over size"""
+    entries[key] = value
+    while len(entries) > size:
+        entries.popitem(last=False)
+
+
+def _fit_line(points, durations):
+    """Least squares duration = intercept + slope * size"""
+    mean = sum(durations) / len(durations)
+    variance = sum((y - mean) ** 2 for y in durations) / len(durations)
+    fit = {
+        "intercept": mean,
+        "slope": 0.,
+        "runs": len(durations),
+        "mean_size": None,
+        "std": variance ** 0.5
+    }
+    if not points:
+        return fit
+    n = float(len(points))
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    fit["mean_size"] = mean_x
+    sxx = sum((x - mean_x) ** 2 for x, y in points)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    if sxx == 0 or sxy <= 0:
+        # One input size, or bigger inputs were not slower
+        return fit
+    slope = sxy / sxx
+    intercept = max(0., mean_y - slope * mean_x)
+    residuals = [y - intercept - slope * x for x, y in points]
+    fit.update({
+        "intercept": intercept,
+        "slope": slope,
+        "std": (sum(r ** 2 for r in residuals) / n) ** 0.5
+    })
+    return fit
+
+
+class StatsConnection(object):
+    """
+    Wraps a pymldb Connection and records the procedure runs going through
+    it. Used by the connection module while run_stats is enabled.
+    """
+    def __init__(self, connection):
+        super(StatsConnection, self).__init__()
+        self.connection = connection
+
+    def _record(self, method, url, payload, response):
+        path = url.split("?")[0]
+        if not path.startswith("/v1/procedures/") or not run_stats.enabled:
+            return
+        parts = path[len("/v1/procedures/"):].split("/")
+        definition = payload if method == "put" and len(parts) == 1 else None
+        run_stats.record(parts[0], definition, response, self.connection)
+
+    def get(self, url, *args, **kwargs):
+        response = self.connection.get(url, *args, **kwargs)
+        self._record("get", url, None, response)
+        return response
+
+    def put(self, url, payload=None):
+        response = self.connection.put(url, payload)
+        self._record("put", url, payload, response)
+        return response
+
+    def post(self, url, payload=None):
+        response = self.connection.post(url, payload)
+        self._record("post", url, payload, response)
+        return response
+
+    def delete(self, url):
+        return self.connection.delete(url)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+run_stats = RunStats()
+
+
+def set_run_stats(stats):
+    run_stats.__dict__.update(stats.__dict__)
+    # Not shared with stats, which can still be used on its own
+    run_stats._lock = threading.Lock()
+    if stats._records is not None:
+        run_stats._records = deque(stats._records, maxlen=stats.max_records)
+    run_stats._types = OrderedDict(stats._types)
+    run_stats._seen = OrderedDict(stats._seen)
+
+
+def estimate_cost(payload, size=None):
+    """
+    Predicted duration in seconds of a procedure payload, from the runs
+    recorded so far. None when no run of its type was recorded.
+
+    Paramters:
+        payload: dict
+
+            Procedure payload, e.g. Transform(...)() or the payload of an
+            estimator
+
+        size: int (default None)
+
+            Input rows, or bytes for import.text. Measured on the current
+            connection when not given.
+    """
+    return run_stats.estimate(payload, size)
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-05-19 10:12:41
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-05-19 16:40:02
+# @File Name: scoring.py
+
+import json
+import time
+import numbers
+import threading
+from collections import deque
+from .tracing import traced_method
+from .connection import conn, using_connection
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+mldb = conn
+
+_STOP = object()
+
+
+def apply_function(name, features):
+    """
+    Call a trained MLDB function on a single row of features through its
+    application endpoint.
+    https://docs.mldb.ai/doc/#builtin/functions/Functions.md.html
+
+    Paramters:
+        name: string
+
+            Name of the function, usually the estimator name
+
+        features: dict
+
+            Mapping of feature name to value
+
+    Returns
+        The score returned by the function
+    """
+    response = mldb.connection.get(
+        "/v1/functions/" + name + "/application",
+        input={"features": features})
+    if response.status_code != 200:
+        raise Exception("could not apply function.\n{}".format(
+            response.content))
+    content = json.loads(response.content)
+    return content["output"]["score"]
+
+
+def _literal(value):
+    """SQL literal of a feature value"""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    if isinstance(value, numbers.Real):
+        value = float(value)
+        return "NULL" if value != value else repr(value)
+    try:
+        text = unicode(value)
+    except NameError:
+        text = str(value)
+    return "'%s'" % text.replace("'", "''")
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def apply_function_many(name, rows):
+    """
+    Call a trained MLDB function on several rows of features in a single
+    query, one column per row:
+
+        SELECT "name"({{0.5 AS "a"} AS features})[score] AS "0", ...
+
+    Paramters:
+        name: string
+
+            Name of the function, usually the estimator name
+
+        rows: list of dict
+
+            Mappings of feature name to value
+
+    Returns
+        The scores returned by the function, in the same order as rows
+    """
+    if len(rows) == 0:
+        return []
+    calls = []
+    for i, features in enumerate(rows):
+        row = ", ".join(
+            "%s AS %s" % (_literal(value), _quote(feature))
+            for feature, value in sorted(features.items()))
+        calls.append('%s({{%s} AS features})[score] AS "%d"' % (
+            _quote(name), row, i))
+    response = mldb.connection.get("/v1/query", data={
+        "q": "SELECT " + ", ".join(calls),
+        "format": "table",
+        "rowNames": False
+    })
+    if response.status_code != 200:
+        raise Exception("could not apply function.\n{}".format(
+            response.content))
+    columns, values = json.loads(response.content)
+    scores = dict(zip(columns, values))
+    return [scores["%d" % i] for i in range(len(rows))]
+
+
+def percentile(values, q):
+    """
+    Nearest rank percentile of a list of numbers. q is between 0 and 100.
+    """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = int(round(q / 100. * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class PendingScore(object):
+    """
+    Handle on a row submitted to a MicroBatcher. Call get to wait for the
+    score.
+    """
+    def __init__(self, features):
+        super(PendingScore, self).__init__()
+        self.features = features
+        # Scored on the connection of the caller
+        self.connection = mldb.current()
+        self.submitted = time.time()
+        self.latency = None
+        self._event = threading.Event()
+        self._score = None
+        self._error = None
+
+    def _resolve(self, score=None, error=None):
+        self._score = score
+        self._error = error
+        self.latency = time.time() - self.submitted
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def get(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise Exception("timed out waiting for score")
+        if self._error is not None:
+            raise self._error
+        return self._score
+
+
+class MicroBatcher(object):
+    """
+    Coalesces the rows submitted by concurrent callers within a small time
+    window and scores each batch with a single query (see
+    apply_function_many), sent from a pool of workers. Identical rows within
+    a batch are only scored once, and rows go to the connection their caller
+    had selected. A batch is dispatched without waiting for the previous one
+    to come back, so up to pool_size requests are in flight at any time.
+    """
+    def __init__(
+            self,
+            function_name,
+            window=0.002,
+            max_batch=64,
+            pool_size=8,
+            history=10000):
+        """
+        Paramters:
+            function_name: string
+
+                Name of the MLDB function to apply
+
+            window: float (default=0.002)
+
+                Time in seconds to wait for more rows once the first row of a
+                batch has arrived
+
+            max_batch: int (default=64)
+
+                Maximum number of rows in a batch. A full batch is dispatched
+                without waiting for the end of the window
+
+            pool_size: int (default=8)
+
+                Number of requests in flight at the same time
+
+            history: int (default=10000)
+
+                Number of latencies to keep to compute the percentiles
+        """
+        super(MicroBatcher, self).__init__()
+        self.function_name = function_name
+        self.window = window
+        self.max_batch = max_batch
+        self.pool_size = pool_size
+        self._queue = Queue()
+        self._pool = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=history)
+        self._batches = 0
+        self._requests = 0
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                # multiprocessing is slow to import, only batchers need it
+                from multiprocessing.pool import ThreadPool
+
+                self._pool = ThreadPool(self.pool_size)
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        connections = {}
+        for pending in batch:
+            # Rows of callers on different servers are scored apart
+            groups = connections.setdefault(
+                id(pending.connection), (pending.connection, {}))[1]
+            key = json.dumps(pending.features, sort_keys=True)
+            groups.setdefault(key, []).append(pending)
+        with self._lock:
+            self._batches += 1
+            self._requests += len(connections)
+        for connection, groups in connections.values():
+            self._pool.apply_async(
+                self._score_batch, (connection, list(groups.values())))
+
+    def _score_batch(self, connection, groups):
+        try:
+            with using_connection(connection):
+                scores = apply_function_many(
+                    self.function_name, [g[0].features for g in groups])
+            error = None
+        except Exception as e:
+            scores = [None] * len(groups)
+            error = e
+        for pendings, score in zip(groups, scores):
+            for pending in pendings:
+                pending._resolve(score, error)
+        with self._lock:
+            self._latencies.extend(
+                p.latency for pendings in groups for p in pendings)
+
+    def submit(self, features):
+        """
+        Queue a row for scoring and return a PendingScore right away
+        """
+        if self._thread is None:
+            self._start()
+        pending = PendingScore(features)
+        self._queue.put(pending)
+        return pending
+
+    def score(self, features, timeout=None):
+        """
+        Score a single row. Blocks until the score is available.
+        """
+        return self.submit(features).get(timeout)
+
+    def score_many(self, rows, timeout=None):
+        """
+        Score a list of rows. All rows are submitted before waiting so they
+        can share batches.
+        """
+        pendings = [self.submit(row) for row in rows]
+        return [p.get(timeout) for p in pendings]
+
+    def latency_stats(self):
+        """
+        Returns a dict with the number of scored rows, the p50 and p99
+        latencies in milliseconds, the number of batches and the number of
+        requests sent to MLDB, one per batch and connection.
+        """
+        with self._lock:
+            latencies = list(self._latencies)
+            batches = self._batches
+            requests = self._requests
+        p50 = percentile(latencies, 50)
+        p99 = percentile(latencies, 99)
+        return {
+            "count": len(latencies),
+            "p50": None if p50 is None else p50 * 1000,
+            "p99": None if p99 is None else p99 * 1000,
+            "batches": batches,
+            "requests": requests
+        }
+
+    def reset_stats(self):
+        with self._lock:
+            self._latencies.clear()
+            self._batches = 0
+            self._requests = 0
+
+    def close(self):
+        """
+        Stop the batching thread once the queued rows are dispatched and wait
+        for the requests in flight.
+        """
+        with self._lock:
+            thread = self._thread
+            pool = self._pool
+            self._thread = None
+            self._pool = None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+            pool.close()
+            pool.join()
+
+
+class RowScoring(object):
+    """
+    Mixin of the estimators scoring single rows with their trained function
+    through a MicroBatcher. The estimator has a name and a features list.
+    """
+
+    @property
+    def batcher(self):
+        """
+        MicroBatcher used by predict_rows and score_one. Assign a new
+        MicroBatcher to change the batching window or the pool size.
+        """
+        if getattr(self, "_batcher", None) is None:
+            self._batcher = MicroBatcher(self.name)
+        return self._batcher
+
+    @batcher.setter
+    def batcher(self, batcher):
+        self._batcher = batcher
+
+    @traced_method
+    def predict_rows(self, rows):
+        """
+        Score rows one by one with the trained function instead of
+        transforming a whole dataset. Rows from concurrent callers are
+        coalesced by the batcher.
+
+        Parameters:
+            rows: list of dict
+
+                Each row maps a feature name to its value
+
+        Returns
+            A list of scores in the same order as rows
+        """
+        return self.batcher.score_many(
+            [self._row_features(row) for row in rows])
+
+    @traced_method
+    def score_one(self, features):
+        """
+        Score a single row. See predict_rows.
+        """
+        return self.batcher.score(self._row_features(features))
+
+    def _row_features(self, row):
+        """
+        The features of the estimator in row. A feature missing from row is
+        passed as null, the way MLDB sees a missing column, and columns that
+        are not features are left out.
+        """
+        return dict((f, row.get(f)) for f in self.features)
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016, 2016 Datacratic Inc.  All rights reserved.
+# @Author: Alexis Tremblay
+# @Email: atremblay@datacratic.com
+# @Date:   2016-06-10 09:40:18
+# @Last Modified by:   Alexis Tremblay
+# @Last Modified time: 2016-06-10 18:12:56
+# @File Name: tracing.py
+
+"""
+Nested timing spans around the public entry points and every call to
+MLDB. Recording is off by default and costs one attribute check per call
+when off.
+
+    from skmldb.tracing import tracer
+
+    with tracer.recording():
+        forest.fit("train", X, y)
+        Test("test", forest)
+    tracer.export_chrome("trace.json")  # open in chrome://tracing
+    print(tracer.summary())
+
+The self time of an entry point is what it spent outside of its children,
+e.g. building SQL and parsing responses. Procedure responses carry the
+runStarted and runFinished of the run, which are attached to the span of
+the request along with a nested "server run" span of the same duration.
+"""
+
+import os
+import json
+import datetime
+import threading
+import functools
+from timeit import default_timer
+from contextlib import contextmanager
+
+
+class _Span(object):
+    __slots__ = ["name", "category", "start", "end", "thread", "parent",
+                 "args"]
+
+    def __init__(self, name, category, start, thread, parent, args):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end = None
+        self.thread = thread
+        self.parent = parent
+        self.args = args
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def path(self):
+        names = []
+        span = self
+        while span is not None:
+            names.append(span.name)
+            span = span.parent
+        return tuple(reversed(names))
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL = _NullContext()
+
+
+class Tracer(object):
+    """
+    Collects spans from every thread. Spans nest per thread: a span opened
+    while another one is open in the same thread is its child.
+    """
+    def __init__(self, max_spans=1000000):
+        super(Tracer, self).__init__()
+        self.enabled = False
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self.origin = default_timer()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+            self.dropped = 0
+            self.origin = default_timer()
+
+    @contextmanager
+    def recording(self, clear=True):
+        """Record the spans of the block"""
+        if clear:
+            self.clear()
+        self.start()
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def open(self, name, category="skmldb", args=None):
+        stack = self._stack()
+        span = _Span(
+            name, category, default_timer(), threading.current_thread().ident,
+            stack[-1] if stack else None, args or {})
+        stack.append(span)
+        return span
+
+    def close(self, span):
+        span.end = default_timer()
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        self.add(span)
+
+    def add(self, span):
+        with self._lock:
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def span(self, name, category="skmldb", **args):
+        """Context manager timing a block. The span is None when off."""
+        if not self.enabled:
+            return _NULL
+        return _SpanContext(self, name, category, args)
+
+    def export_chrome(self, path):
+        """
+        Write the spans in the Chrome trace event format, for
+        chrome://tracing or Perfetto
+        """
+        pid = os.getpid()
+        events = []
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": (span.start - self.origin) * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": pid,
+                "tid": span.thread,
+                "args": dict((k, _jsonable(v)) for k, v in span.args.items())
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def _tree(self):
+        """Total time, self time and count per call path"""
+        with self._lock:
+            spans = list(self.spans)
+        stats = {}
+        for span in spans:
+            path = span.path()
+            entry = stats.setdefault(path, [0., 0., 0])
+            entry[0] += span.duration
+            entry[1] += span.duration
+            entry[2] += 1
+            if span.parent is not None:
+                parent = stats.setdefault(path[:-1], [0., 0., 0])
+                parent[1] -= span.duration
+        return stats
+
+    def summary(self, min_fraction=0.001):
+        """
+        Plain text flame summary: one line per call path, indented under its
+        parent, with the total and self time in ms and the number of calls.
+        Paths under min_fraction of the total time are left out.
+        """
+        stats = self._tree()
+        if not stats:
+            return "no spans recorded"
+        total = sum(v[0] for k, v in stats.items() if len(k) == 1)
+        children = {}
+        for path in stats:
+            children.setdefault(path[:-1], []).append(path)
+
+        lines = ["{:>10} {:>10} {:>7}  {}".format(
+            "total ms", "self ms", "calls", "span")]
+
+        def visit(parent, depth):
+            for path in sorted(children.get(parent, []),
+                               key=lambda p: -stats[p][0]):
+                span_total, span_self, count = stats[path]
+                if total and span_total / total < min_fraction:
+                    continue
+                lines.append("{:>10.1f} {:>10.1f} {:>7}  {}{}".format(
+                    span_total * 1000, span_self * 1000, count,
+                    "  " * depth, path[-1]))
+                visit(path, depth + 1)
+        visit((), 0)
+        if self.dropped:
+            lines.append("{} spans dropped over max_spans".format(
+                self.dropped))
+        return "\n".join(lines)
+
+    def collapsed(self):
+        """Self time in microseconds per path, in the folded format of
+        flamegraph.pl"""
+        return "\n".join(
+            "{} {}".format(";".join(path), int(v[1] * 1e6))
+            for path, v in sorted(self._tree().items()) if v[1] > 0)
+
+
+class _SpanContext(object):
+    __slots__ = ["tracer", "name", "category", "args", "span"]
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.span = None
+
+    def __enter__(self):
+        self.span = self.tracer.open(self.name, self.category, self.args)
+        return self.span
+
+    def __exit__(self, kind, value, traceback):
+        if kind is not None:
+            self.span.args["error"] = "{}: {}".format(kind.__name__, value)
+        self.tracer.close(self.span)
+        return False
+
+
+def _jsonable(value):
+    if isinstance(value, (int, float, bool, type(None))):
+        return value
+    return str(value)
+
+
+tracer = Tracer()
+
+
+def traced(func):
+    """Span named after the function around every call"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+            return func(*args, **kwargs)
+        with tracer.span(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def traced_method(func):
+    """Span named Class.method around every call"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not tracer.enabled:
+            return func(self, *args, **kwargs)
+        with tracer.span(type(self).__name__ + "." + name):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def _parse_time(value):
+    for time_format in ["%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"]:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def _find_run(content):
+    """The run with runStarted and runFinished in a procedure response"""
+    if not isinstance(content, dict):
+        return None
+    if "runStarted" in content:
+        return content
+    run = content.get("status")
+    if isinstance(run, dict):
+        run = run.get("firstRun")
+        if isinstance(run, dict) and "runStarted" in run:
+            return run
+    return None
+
+
+def server_timing(response):
+    """
+    (runStarted, runFinished, seconds) of the run in a procedure response,
+    None when there is none
+    """
+    try:
+        content = json.loads(response.content)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    run = _find_run(content)
+    if run is None:
+        return None
+    started = _parse_time(run.get("runStarted"))
+    finished = _parse_time(run.get("runFinished"))
+    if started is None or finished is None:
+        return None
+    return (run["runStarted"], run["runFinished"],
+            (finished - started).total_seconds())
+
+
+class TracedConnection(object):
+    """
+    Wraps a pymldb Connection with a span around each request. Used by the
+    connection module while the tracer records.
+    """
+    def __init__(self, connection):
+        super(TracedConnection, self).__init__()
+        self.connection = connection
+
+    def _call(self, method, url, *args, **kwargs):
+        span_name = "{} {}".format(method.upper(), url.split("?")[0])
+        with tracer.span(span_name, "http") as span:
+            response = getattr(self.connection, method)(url, *args, **kwargs)
+            if span is None:
+                # The tracer was disabled after the connection was wrapped
+                return response
+            span.args["status"] = getattr(response, "status_code", None)
+            content = getattr(response, "content", None)
+            if content is not None:
+                span.args["bytes"] = len(content)
+            if url.startswith("/v1/procedures"):
+                timing = server_timing(response)
+                if timing is not None:
+                    self._server_span(span, timing)
+        return response
+
+    def _server_span(self, span, timing):
+        started, finished, seconds = timing
+        span.args["runStarted"] = started
+        span.args["runFinished"] = finished
+        span.args["server_ms"] = seconds * 1000
+        # The server clock is not ours, the run is placed in the middle of
+        # the request
+        now = default_timer()
+        seconds = min(seconds, now - span.start)
+        server = _Span(
+            "server run", "server",
+            span.start + (now - span.start - seconds) / 2., span.thread,
+            span, {"runStarted": started, "runFinished": finished})
+        server.end = server.start + seconds
+        tracer.add(server)
+
+    def get(self, url, *args, **kwargs):
+        return self._call("get", url, *args, **kwargs)
+
+    def put(self, url, *args, **kwargs):
+        return self._call("put", url, *args, **kwargs)
+
+    def post(self, url, *args, **kwargs):
+        return self._call("post", url, *args, **kwargs)
+
+    def delete(self, url, *args, **kwargs):
+        return self._call("delete", url, *args, **kwargs)
+
+    def get_stream(self, url, *args, **kwargs):
+        # The span ends with the headers, the body is read by the caller
+        with tracer.span("GET " + url.split("?")[0], "http", stream=True):
+            return self.connection.get_stream(url, *args, **kwargs)
+
+    def query(self, sql, *args, **kwargs):
+        with tracer.span("query", "http"):
+            return self.connection.query(sql, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
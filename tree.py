@@ -8,14 +8,19 @@
 # @File Name: tree.py
 
 import json
-from procedures import Transform
-from utils import generate_random_name
-from connection import conn
+from .procedures import Transform, Probabilizer
+from .utils import generate_random_name
+from .scoring import RowScoring
+from .cache import model_cache
+from .feature_set import resolve
+from .feature_spec import compile_features
+from .tracing import traced_method
+from .connection import conn
 
 mldb = conn
 
 
-class DecisionTreeClassifier(object):
+class DecisionTreeClassifier(RowScoring):
     """docstring for DecisionTreeClassifier"""
     def __init__(
             self,
@@ -29,6 +34,7 @@ class DecisionTreeClassifier(object):
         self.random_feature_propn = random_feature_propn
         self.name = name
         self.update_alg = update_alg
+        self.probabilizer = None
         self._mode = "boolean"
         self.configuration = {
             "dt": {
@@ -42,12 +48,14 @@ class DecisionTreeClassifier(object):
             }
         }
 
-    def fit(self, dataset, X, y):
+    @traced_method
+    def fit(self, dataset, X=None, y=None):
         """
         Parameters:
-            dataset: string
+            dataset: string or FeatureSet
 
-                Dataset name to use for training
+                Dataset name to use for training. With a FeatureSet, X and y
+                default to its features and label.
 
             X: array of strings
 
@@ -57,6 +65,7 @@ class DecisionTreeClassifier(object):
 
                 Name of the target to use. a.k.a. label
         """
+        dataset, X, y = resolve(dataset, X, y)
         self.features = X
         self.label = y
 
@@ -65,7 +74,7 @@ class DecisionTreeClassifier(object):
                 {%(features)s} as features,
                 %(label)s as label
             FROM %(campaign)s""" % {
-                "features": ",".join(X),
+                "features": compile_features(X, dataset),
                 "label": y,
                 "campaign": dataset
             }
@@ -77,20 +86,19 @@ class DecisionTreeClassifier(object):
                 "algorithm": "dt",
                 "configuration": self.configuration,
                 "mode": self._mode,
-                "modelFileUrl": "file://donotcare.cls",
                 "functionName": self.name,
                 "runOnCreation": True
             }
         }
 
-        response = mldb.connection.put(
-            "/v1/procedures/"+self.name,
-            self.training_payload)
+        response = model_cache.train(
+            self.name, self.training_payload, dataset)
 
         if response.status_code != 201:
             raise Exception("could not train random forest.\n{}".format(
                 response.content))
 
+    @traced_method
     def predict(self, dataset, predict_set_name=None):
         """
         Predict class for X.
@@ -101,7 +109,7 @@ class DecisionTreeClassifier(object):
         trees.
 
         Parameters:
-            dataset: string
+            dataset: string or FeatureSet
 
                 Dataset name to use for testing
 
@@ -110,6 +118,7 @@ class DecisionTreeClassifier(object):
                 Name to give to the dataset containing the predictions. If None,
                 a randomly generated name will be given
         """
+        dataset = resolve(dataset)[0]
         if predict_set_name is None:
             predict_set_name = generate_random_name()
         self.predict_payload = Transform(
@@ -119,7 +128,7 @@ class DecisionTreeClassifier(object):
                 FROM %(test)s
             """ % {
                 "func": self.name,
-                "features": ",".join(self.features),
+                "features": compile_features(self.features, dataset),
                 "test": dataset
                 },
             outputDataset=predict_set_name
@@ -133,5 +142,92 @@ class DecisionTreeClassifier(object):
                 response.content))
         return predict_set_name
 
+    @traced_method
+    def calibrate(self, dataset, probabilizer=None):
+        """
+        Fit a Probabilizer on the scores of this estimator and attach it for
+        predict_proba. The scores are computed inside the training procedure
+        of the probabilizer, no score dataset is created.
+
+        Parameters:
+            dataset: string or FeatureSet
+
+                Dataset name to use for the calibration
+
+            probabilizer: Probabilizer (default None)
+
+                Unfitted probabilizer to use. Defaults to a logit one named
+                after the estimator.
+        """
+        dataset = resolve(dataset)[0]
+        if probabilizer is None:
+            probabilizer = Probabilizer(name=self.name + "_proba")
+        probabilizer.fit(
+            dataset,
+            """%(func)s({{%(features)s} as features})[score]""" % {
+                "func": self.name,
+                "features": compile_features(self.features, dataset)
+            },
+            self.label)
+        self.probabilizer = probabilizer
+
+    @traced_method
+    def predict_proba(self, dataset, predict_set_name=None):
+        """
+        Calibrated probabilities with the attached probabilizer (see
+        calibrate). The estimator and the probabilizer are applied in the
+        same transform. The output is the same as Probabilizer.predict on the
+        output of predict.
+
+        Parameters:
+            dataset: string or FeatureSet
+
+                Dataset name to use for testing
+
+            predict_set_name: string (default None)
+
+                Name to give to the dataset containing the probabilities. If
+                None, a randomly generated name will be given
+        """
+        dataset = resolve(dataset)[0]
+        if self.probabilizer is None:
+            raise ValueError(
+                "No probabilizer attached. Call calibrate or set probabilizer")
+        if predict_set_name is None:
+            predict_set_name = generate_random_name()
+        self.predict_payload = Transform(
+            inputData="""
+                SELECT
+                    %(proba)s({
+                        %(func)s({{%(features)s} as features})[score] as score
+                    }) as predict
+                FROM %(test)s
+            """ % {
+                "proba": self.probabilizer.name,
+                "func": self.name,
+                "features": compile_features(self.features, dataset),
+                "test": dataset
+            },
+            outputDataset=predict_set_name
+        )()
+        response = mldb.connection.put(
+            "/v1/procedures/" + self.name + "_predict_proba",
+            self.predict_payload
+        )
+        if response.status_code != 201:
+            raise Exception("could not create dataset.\n{}".format(
+                response.content))
+        return predict_set_name
+
+    @traced_method
+    def compile(self):
+        """
+        Pull the trained model from MLDB and compile it to NumPy arrays to
+        score rows in process. See compiled.CompiledForest.
+        """
+        from .compiled import compile_function
+
+        return compile_function(self.name, self.features)
+
     def __repr__(self):
         return json.dumps(self.configuration, indent=4)
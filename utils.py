@@ -8,10 +8,14 @@
 # @File Name: utils.py
 
 import os
+import re
 import json
-import uuid
+import binascii
 import tempfile
-from connection import conn
+import datetime
+import threading
+from .tracing import traced, traced_method
+from .connection import conn, bind
 
 mldb = conn
 
@@ -240,14 +244,100 @@ class OutputDataset(object):
         return payload
 
 
+_TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M",
+                 "%Y-%m-%d"]
+
+
+def _parse_time(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    for time_format in _TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.rstrip("Z"), time_format)
+        except ValueError:
+            pass
+    raise ValueError("could not parse time {}".format(value))
+
+
+def _format_time(value):
+    if value.time() == datetime.time(0):
+        return value.strftime("%Y-%m-%d")
+    return value.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _window_key(start, end):
+    return _format_time(start) + "/" + _format_time(end)
+
+
+def _time_windows(start, end, window):
+    """[from, to) windows of length window covering start to end"""
+    if not isinstance(window, datetime.timedelta):
+        window = datetime.timedelta(days=window)
+    if window <= datetime.timedelta(0):
+        raise ValueError("window must be positive")
+    windows = []
+    current = start
+    while current < end:
+        windows.append((current, min(current + window, end)))
+        current += window
+    return windows
+
+
 class MLDBrtbopt(object):
     """docstring for MLDBrtbopt"""
     def __init__(
             self,
-            s3LogHost="http://rtbindexer.ops.datacratic.com:17000"):
+            s3LogHost="http://rtbindexer.ops.datacratic.com:17000",
+            manifest_directory=None):
+        """
+        Paramters:
+            s3LogHost: string
+
+                Log host used by the rtbopt procedures
+
+            manifest_directory: string (default None)
+
+                Where the import manifests are kept. Defaults to
+                skmldb_imports in the working directory.
+        """
         super(MLDBrtbopt, self).__init__()
         self.s3LogHost = s3LogHost
+        if manifest_directory is None:
+            manifest_directory = os.path.join(os.getcwd(), "skmldb_imports")
+        self.manifest_directory = manifest_directory
+        self._manifest_lock = threading.Lock()
+
+    def _manifest_path(self, name):
+        return os.path.join(self.manifest_directory, name + ".json")
 
+    def _load_manifest(self, name, **source):
+        """
+        Manifest of name. It is only kept if it was recorded for the same
+        source (slug, columnNames, ...), the windows of another source would
+        mix their data in the output.
+        """
+        path = self._manifest_path(name)
+        manifest = {"windows": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if any(manifest.get(key) != value
+                   for key, value in source.items()):
+                manifest = {"windows": {}}
+        manifest.update(source)
+        return manifest
+
+    def _save_manifest(self, name, manifest):
+        if not os.path.isdir(self.manifest_directory):
+            os.makedirs(self.manifest_directory)
+        path = self._manifest_path(name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.rename(path + ".tmp", path)
+
+    @traced_method
     def mw_import(
             self,
             slug,
@@ -257,12 +347,75 @@ class MLDBrtbopt(object):
             outputDataset=None,
             runOnCreation=True,
             threads=16,
-            print_config=False):
+            print_config=False,
+            window=None,
+            parallel=4,
+            merge="view",
+            incremental=False):
+        """
+        Import the logs of a slug with rtbopt.import.
+
+        Without window the whole range is imported by one procedure. With a
+        window, start to end is split in windows, each imported in a part
+        dataset by its own procedure. Up to parallel windows run at the same
+        time and share the threads between them. Every completed window is
+        recorded in a local manifest, so running the same import again after
+        a failure only imports the missing windows. The parts are then merged
+        into outputDataset.
+
+        With incremental, the manifest also keeps a high-water mark, the end
+        of the last import. Each call imports from the mark to end (default:
+        the start of today, UTC) in new parts and outputDataset becomes the
+        merge of every part imported so far. A daily refresh then only
+        imports one day of logs.
+
+        Paramters:
+            slug: string
+
+            start, end: string, date or datetime (default None)
+
+                Range to import. Both are needed with window.
+
+            columnNames: array of strings (default None)
+
+            outputDataset: string, dict or OutputDataset (default None)
+
+                Defaults to a tabular dataset named after the slug
+
+            runOnCreation: bool (default=True)
+
+            threads: int (default=16)
+
+                Total number of threads, split between the running windows
+
+            print_config: bool (default=False)
+
+            window: timedelta or number of days (default None)
 
+                Length of each window
+
+            parallel: int (default=4)
+
+                Number of windows imported at the same time
+
+            merge: string (default=view)
+
+                view: outputDataset is a merged dataset over the parts
+                copy: the parts are copied in outputDataset, not
+                      allowed with incremental
+
+            incremental: bool (default=False)
+
+                Only import what is newer than the high-water mark
+
+        Returns
+            The response of the import, or of the merge with window
+        """
+        output = _create_output_dataset(outputDataset, slug)
         params = {
             "slug": slug,
             "s3LogHost": self.s3LogHost,
-            "outputDataset": _create_output_dataset(outputDataset, slug),
+            "outputDataset": output,
             "runOnCreation": runOnCreation,
             "threads": threads
         }
@@ -278,22 +431,189 @@ class MLDBrtbopt(object):
             'type': 'rtbopt.import',
             'params': params
         }
-        if print_config:
-            print(json.dumps(payload, indent=4))
-
-        return mldb.connection.put("/v1/procedures/rtbimport", payload)
-
+        if window is None and not incremental:
+            if print_config:
+                print(json.dumps(payload, indent=4))
+            return mldb.connection.put("/v1/procedures/rtbimport", payload)
+
+        if merge not in ["view", "copy"]:
+            raise ValueError("merge must be view or copy")
+        name = output["id"]
+        if incremental and merge == "copy":
+            raise ValueError(
+                "merge must be view with incremental, a copy would copy "
+                "every part imported so far on each refresh")
+        if columnNames is not None:
+            columnNames = list(columnNames)
+        manifest = self._load_manifest(
+            name, slug=slug, columnNames=columnNames)
+
+        if incremental:
+            if manifest.get("watermark") is not None:
+                start = manifest["watermark"]
+            if end is None:
+                # Only complete days
+                end = datetime.datetime.combine(
+                    datetime.datetime.utcnow().date(), datetime.time(0))
+        if start is None or end is None:
+            raise ValueError(
+                "start and end are needed to import by window. With "
+                "incremental, start is only needed the first time.")
+        start, end = _parse_time(start), _parse_time(end)
+        if window is None:
+            window = max(end - start, datetime.timedelta(seconds=1))
+        windows = _time_windows(start, end, window)
+        self._import_windows(
+            name, output, params, manifest, windows, threads, parallel,
+            print_config)
+
+        if incremental:
+            if windows:
+                manifest["watermark"] = _format_time(end)
+                self._save_manifest(name, manifest)
+            parts = [manifest["windows"][key]["dataset"]
+                     for key in sorted(manifest["windows"])]
+        else:
+            parts = [manifest["windows"][_window_key(*w)]["dataset"]
+                     for w in windows]
+        if not parts:
+            raise ValueError("nothing imported between {} and {}".format(
+                start, end))
+        return self._merge(output, parts, merge)
+
+    def _import_windows(self, name, output, params, manifest, windows,
+                        threads, parallel, print_config):
+        """
+        Import the windows missing from the manifest, each in its own part
+        dataset, parallel at a time
+        """
+        if not windows:
+            return
+        parallel = max(1, min(parallel, len(windows)))
+        threads_per_window = max(1, threads // parallel)
+
+        todo = []
+        for window_start, window_end in windows:
+            key = _window_key(window_start, window_end)
+            done = manifest["windows"].get(key)
+            if done is not None and _dataset_exists(done["dataset"]):
+                continue
+            part = dict(output)
+            part["id"] = "%s_%s" % (
+                name, window_start.strftime("%Y%m%dT%H%M%S"))
+            part_params = dict(params)
+            part_params.update({
+                "from": _format_time(window_start),
+                "to": _format_time(window_end),
+                "outputDataset": part,
+                "runOnCreation": True,
+                "threads": threads_per_window
+            })
+            todo.append((key, {
+                'type': 'rtbopt.import',
+                'params': part_params
+            }))
+
+        def run(args):
+            key, part_payload = args
+            if print_config:
+                print(json.dumps(part_payload, indent=4))
+            dataset = part_payload["params"]["outputDataset"]["id"]
+            try:
+                mldb.connection.delete("/v1/datasets/" + dataset)
+            except Exception:
+                # No leftover of a failed run
+                pass
+            try:
+                response = mldb.connection.put(
+                    "/v1/procedures/rtbimport_" + dataset, part_payload)
+            except Exception as e:
+                return key, str(e)
+            if response.status_code != 201:
+                return key, response.content
+            with self._manifest_lock:
+                manifest["windows"][key] = {
+                    "dataset": dataset,
+                    "from": part_payload["params"]["from"],
+                    "to": part_payload["params"]["to"]
+                }
+                self._save_manifest(name, manifest)
+            return key, None
+
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(parallel)
+        try:
+            errors = [(key, error) for key, error in pool.map(bind(run), todo)
+                      if error is not None]
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise Exception(
+                "could not import {} of {} windows, run again to resume.\n"
+                "{}: {}".format(len(errors), len(windows), *errors[0]))
+
+    def _merge(self, output, parts, merge):
+        # Put over the current output, it stays readable until it is
+        # replaced and is kept if the merge fails
+        if merge == "view":
+            response = mldb.connection.put(
+                "/v1/datasets/" + output["id"], {
+                    "type": "merged",
+                    "params": {
+                        "datasets": [{"id": part} for part in parts]
+                    }
+                })
+        else:
+            response = mldb.connection.put(
+                "/v1/procedures/rtbimport_merge_" + output["id"],
+                Transform(
+                    inputData="SELECT * FROM merge(%s)" % ", ".join(parts),
+                    outputDataset=output
+                )())
+        if response.status_code != 201:
+            raise Exception("could not merge the imported windows.\n{}"
+                            .format(response.content))
+        return response
+
+    @traced_method
     def indexer(
             self,
             slug,
             outputDataset=None,
             runOnCreation=True,
-            print_config=False):
+            print_config=False,
+            incremental=False):
+        """
+        Index the logs of a slug with rtbopt.indexer.
+
+        rtbopt.indexer has no time range, so with incremental the index is
+        built in a staging dataset and only the rows with a timestamp past
+        the high-water mark of the last refresh are kept, in a new part.
+        outputDataset is then a merged dataset over all the parts. The index
+        is small next to the logs, what is saved is storing it all again.
+
+        Paramters:
+            slug: string
+
+            outputDataset: string, dict or OutputDataset (default None)
+
+                Defaults to a tabular dataset named after the slug
+
+            runOnCreation: bool (default=True)
+
+            print_config: bool (default=False)
 
+            incremental: bool (default=False)
+
+                Only keep the rows newer than the high-water mark
+        """
+        output = _create_output_dataset(outputDataset, slug)
         params = {
             "slug": slug,
             "indexerHost": self.s3LogHost,
-            "outputDataset": _create_output_dataset(outputDataset, slug),
+            "outputDataset": output,
             "runOnCreation": runOnCreation
         }
 
@@ -302,10 +622,63 @@ class MLDBrtbopt(object):
             'params': params
         }
 
+        if not incremental:
+            if print_config:
+                print(json.dumps(payload, indent=4))
+            return mldb.connection.put("/v1/procedures/indexerdata", payload)
+
+        name = output["id"]
+        manifest_name = name + ".indexer"
+        manifest = self._load_manifest(manifest_name, slug=slug)
+        watermark = manifest.get("watermark")
+
+        staging = dict(output)
+        staging["id"] = name + "_staging"
+        params["outputDataset"] = staging
+        params["runOnCreation"] = True
         if print_config:
             print(json.dumps(payload, indent=4))
+        try:
+            mldb.connection.delete("/v1/datasets/" + staging["id"])
+        except Exception:
+            # No leftover of a failed run
+            pass
+        response = mldb.connection.put(
+            "/v1/procedures/indexerdata_" + name, payload)
+        if response.status_code != 201:
+            raise Exception("could not index {}.\n{}".format(
+                slug, response.content))
+
+        latest = _latest_timestamp(staging["id"])
+        if latest is not None and latest != watermark:
+            part = dict(output)
+            part["id"] = "%s_%s" % (name, re.sub(r"\W", "", latest))
+            where = "true" if watermark is None else \
+                "latest_timestamp({*}) > to_timestamp('%s')" % watermark
+            response = mldb.connection.put(
+                "/v1/procedures/indexerdata_" + part["id"],
+                Transform(
+                    inputData="SELECT * FROM %s WHERE %s" % (
+                        staging["id"], where),
+                    outputDataset=part
+                )())
+            if response.status_code != 201:
+                raise Exception("could not create dataset.\n{}".format(
+                    response.content))
+            manifest["windows"][latest] = {
+                "dataset": part["id"],
+                "from": watermark,
+                "to": latest
+            }
+            manifest["watermark"] = latest
+            self._save_manifest(manifest_name, manifest)
+        mldb.connection.delete("/v1/datasets/" + staging["id"])
 
-        return mldb.connection.put("/v1/procedures/indexerdata", payload)
+        parts = [manifest["windows"][key]["dataset"]
+                 for key in sorted(manifest["windows"])]
+        if not parts:
+            raise ValueError("nothing indexed for {}".format(slug))
+        return self._merge(output, parts, "view")
 
 
 class Dataset(object):
@@ -339,6 +712,7 @@ class Dataset(object):
     def exists_on_disk(self):
         return os.path.exists(self.file_path)
 
+    @traced_method
     def to_csv(
             self,
             sep=";",
@@ -417,6 +791,7 @@ class Dataset(object):
                 print("Could not delete {}".format(self.path))
             raise
 
+    @traced_method
     def from_csv(
             self,
             sep=';',
@@ -496,6 +871,33 @@ class Dataset(object):
             return True
 
 
+def _latest_timestamp(dataset):
+    """Latest timestamp of a dataset as a string, None when it is empty"""
+    response = mldb.connection.get(
+        "/v1/query",
+        q="SELECT max(latest_timestamp({*})) AS latest FROM %s" % dataset,
+        format="aos")
+    if response.status_code != 200:
+        raise Exception("could not query {}.\n{}".format(
+            dataset, response.content))
+    rows = json.loads(response.content)
+    if not rows:
+        return None
+    latest = rows[0].get("latest")
+    if isinstance(latest, dict):
+        # {"ts": "..."}
+        latest = latest.get("ts")
+    return latest
+
+
+def _dataset_exists(name):
+    try:
+        response = mldb.connection.get("/v1/datasets/" + name)
+    except Exception:
+        return False
+    return response.status_code == 200
+
+
 def _create_output_dataset(outputDataset, dataset_name=None):
     if isinstance(outputDataset, OutputDataset):
         return outputDataset()
@@ -507,6 +909,7 @@ def _create_output_dataset(outputDataset, dataset_name=None):
         return outputDataset
 
 
+@traced
 def dataset_from_dataframe(df, name=None, index_name=None):
     """
     Paramters:
@@ -588,4 +991,5 @@ def generate_random_name(prefix="d"):
     if not first.isalpha():
         raise ValueError("prefix must start with a lower or upper case letter")
 
-    return prefix + str(uuid.uuid4().hex)
+    # Same as uuid4().hex without importing uuid, which loads ctypes
+    return prefix + binascii.hexlify(os.urandom(16)).decode("ascii")